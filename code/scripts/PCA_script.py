@@ -21,9 +21,9 @@ import pandas as pd
 import numpy.linalg as npl
 import matplotlib
 import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
 
 sys.path.append("code/utils")
+from decomposition import *
 from make_class import *
 
 '''
@@ -45,12 +45,9 @@ The first principal component vector defines the line that is as close as possib
 to the data. 
 '''
 
-# Use filtered data 
-sub = ds005('006', '001').filtered
-# Check the data type
-sub.data.dtype
-# Convert to float if necessary
-data = sub.data.astype(float)
+# Use filtered data, in single precision to halve the memory footprint
+sub = ds005('006', '001', dtype=np.float32).filtered
+data = sub.data
 data.dtype
 
 vol_shape, n_trs = sub.data.shape[:-1], sub.data.shape[-1]
@@ -137,14 +134,13 @@ plt.show()
 
 # The number of Eigenvalues greater than 1 is one, and it 
 # explains 25.943916% 
-#[ 9.99901225e-01   1.72152618e-05   1.52364491e-05   1.04407335e-05 7.20936171e-06]
-pca = PCA(n_components=5)
-pca.fit(data2d)
-print(pca.explained_variance_ratio_) 
+# Only the voxels inside the brain are analyzed, and only the top components are
+# computed, one block of voxels at a time, rather than fitting
+# sklearn.decomposition.PCA to all 902629 voxels
+spatial_maps, time_courses, explained_variance, explained_variance_ratio = \
+    randomized_pca(data, 5, sub.brain_mask(), center="volume")
+print(explained_variance_ratio)
 
 
-# Fit the model with X and apply the dimensionality reduction on X
-X = pca.fit_transform(C)
-
-
-  
\ No newline at end of file
+# Project the voxels onto the components to reduce the dimension of the data
+X = spatial_maps[sub.brain_mask()]
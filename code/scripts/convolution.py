@@ -5,10 +5,11 @@ This script allows production, for each run of each subject, of convolved
 hemodynamic response function predictions for the three conditions given in the
 original data: parametric gain, parametric loss, and distance from indifference.
 
-It should generate four files per run: one figure that contains six plots (one
-depicting the hemodynamic response and one depicting the neural prediction, for
-each run and condition), and one plaintext file that contains the convolved
-hemodynamic response function predictions for each of the three conditions.
+It should generate one figure per run that contains six plots (one depicting the
+hemodynamic response and one depicting the neural prediction, for each run and
+condition). The convolved hemodynamic response function predictions for the
+three conditions of every run are saved together to a single binary file
+`results/designs.npz`.
 """
 from __future__ import absolute_import, division, print_function
 import matplotlib.pyplot as plt
@@ -16,21 +17,28 @@ import numpy as np
 import os, sys
 
 sys.path.append("code/utils")
+from design import *
 from make_class import *
+from run_tool import *
 
 
-# Define some parameters
-num_volumes, time_res, TR_subdivs = 240, 2, 100
+# Define some parameters: neural time courses are plotted at a resolution of
+# step_size seconds, and predictions are computed as if they had been convolved
+# at that same resolution
+time_res, TR_subdivs = 2, 100
 step_size = time_res / TR_subdivs
-volumes_to_keep = np.arange(0, num_volumes * TR_subdivs, TR_subdivs)
 
 
 # Create a collection of all subject IDs and all run IDs
-run_IDs = [str(i).zfill(3) for i in range(1, 4)]
-subject_IDs = [str(i).zfill(3) for i in range(1, 17)]
-IDs = list(zip([run_ID for _ in range(16) for run_ID in run_IDs],
-               [subject_ID for _ in range(3) for subject_ID in subject_IDs]))
-IDs.sort()
+IDs = run_IDs()
+
+# Collect the predictions of every run in one store, along with the parameters
+# of the canonical hemodynamic response function used to compute them
+designs = design_store("results/designs.npz", ("gain", "loss", "dist2indiff"),
+                       time_res=time_res, step_size=step_size,
+                       hrf={"peak_shape": 6, "undershoot_shape": 12,
+                            "undershoot_ratio": 0.35, "peak_value": 0.6,
+                            "duration": 30})
 
 # We perform the procedure outlined in this script for each run of each subject:
 for ID in IDs:
@@ -41,7 +49,7 @@ for ID in IDs:
     # and filtered datasets are equal in the dimension of time. We can therefore
     # simply consider one:
     obj = ds005(subject, run)
-    time_len = obj.raw.data.shape[3]
+    time_len = obj.raw.shape[3]
 
 
     # Create neural time courses for each regressor of interest
@@ -51,14 +59,15 @@ for ID in IDs:
 
 
     # Compute the predicted hemodynamic response function signals for each
-    # regressor of interest
-    neural_gain = obj.convolution("gain", step_size)
-    neural_loss = obj.convolution("loss", step_size)
-    neural_dist2indiff = obj.convolution("dist2indiff", step_size)
+    # regressor of interest, directly at the acquisition time of each volume
+    neural_gain = obj.regressor("gain", step_size)
+    neural_loss = obj.regressor("loss", step_size)
+    neural_dist2indiff = obj.regressor("dist2indiff", step_size)
 
 
     # Create figures plotting the predicted HRF signal on time:
     time = np.arange(0, time_res * time_len, step_size)
+    volume_time = np.arange(0, time_res * time_len, time_res)
 
     plt.figure(figsize=(15, 10), dpi=100)
     plt.subplot(231)
@@ -80,19 +89,19 @@ for ID in IDs:
     plt.title("Condition 3: Distance from Indifference")
 
     plt.subplot(234)
-    plt.plot(time, neural_gain)
+    plt.plot(volume_time, neural_gain)
     plt.xlabel("Time")
     plt.ylabel("Neural Prediction")
     plt.title("Condition 1: Gain")
 
     plt.subplot(235)
-    plt.plot(time, neural_loss)
+    plt.plot(volume_time, neural_loss)
     plt.xlabel("Time")
     plt.ylabel("Neural Prediction")
     plt.title("Condition 2: Loss")
 
     plt.subplot(236)
-    plt.plot(time, neural_dist2indiff)
+    plt.plot(volume_time, neural_dist2indiff)
     plt.xlabel("Time")
     plt.ylabel("Neural Prediction")
     plt.title("Condition 3: Distance from Indifference")
@@ -112,8 +121,10 @@ for ID in IDs:
     plt.close()
 
 
-    # Save txt files to results directory
-    np.savetxt(path_result + "conv_gain.txt", neural_gain[volumes_to_keep])
-    np.savetxt(path_result + "conv_loss.txt", neural_loss[volumes_to_keep])
-    np.savetxt(path_result + "conv_dist2indiff.txt",
-               neural_dist2indiff[volumes_to_keep])
+    # Add the predictions to the store
+    designs.append(ID, np.column_stack([neural_gain, neural_loss,
+                                        neural_dist2indiff]))
+
+
+# Save the predictions of all runs to the results directory
+designs.save()
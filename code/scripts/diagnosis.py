@@ -5,7 +5,8 @@ This script runs a diagnostic analysis in bulk on the raw BOLD data of all runs
 contained in the ds005 dataset. It preforms the task of finding outlier volumes,
 with respect to the standard deviation among voxels in individual volumes.
 
-It should export a total of six files:
+It should export a total of seven files:
+- `vol_stats.npz`
 - `vol_std_values.txt`
 - `vol_std_outliers.txt`
 - `vol_std.png`
@@ -24,18 +25,39 @@ from diagnostics import *
 from hypothesis import *
 from make_class import *
 from plot_tool import *
+from run_tool import *
 
 
 # Create a collection of all subject IDs and all run IDs
-run_IDs = [str(i).zfill(3) for i in range(1, 4)]
-subject_IDs = [str(i).zfill(3) for i in range(1, 17)]
-IDs = list(zip([run_ID for _ in range(16) for run_ID in run_IDs],
-               [subject_ID for _ in range(3) for subject_ID in subject_IDs]))
-IDs.sort()
-
-# We perform the procedure outlined in this script for each run of each subject:
-for ID in IDs:
+IDs = run_IDs()
+
+# We first compute the statistics of each run of each subject, loading the next
+# run in the background in the meantime:
+all_stats = []
+for ID, obj in iter_ds005(IDs):
+
+
+    # Compute the statistics of every volume in a single pass over the data:
+    # standard deviation over all voxels, root-mean-square differences between
+    # sequential volumes, global signal, and statistics of each slice
+    all_stats.append(vol_stats(obj.filtered.data))
+    obj.release()
+
+
+# Identify the outliers of every run at once, for both the volume standard
+# deviations and the root-mean-square differences
+all_std = np.array([stats["std"] for stats in all_stats])
+all_rmsd = np.array([stats["dvars"] for stats in all_stats])
+std_idx, std_offsets, std_thresh = iqr_outliers_batch(all_std)
+rmsd_idx, rmsd_offsets, rmsd_thresholds = iqr_outliers_batch(all_rmsd)
+edo_all_idx, edo_offsets = extend_diff_outliers_batch(rmsd_idx, rmsd_offsets,
+                                                      all_rmsd.shape[1])
+
+
+# We then save and plot the results of each run of each subject:
+for i, ID in enumerate(IDs):
     run, subject = ID
+    stats = all_stats[i]
 
 
     # Create a directory to which the results will be saved
@@ -47,17 +69,15 @@ for ID in IDs:
             raise
 
 
-    # Extract all relevant data stored within the ds005 files:
-    data = ds005(subject, run).filtered.data
-
-
-    # Compute the standard deviation over all voxels for each volume
-    vol_std_values = vol_std(data)
+    # Save the statistics of every volume
+    np.savez(path_result + "vol_stats.npz", **stats)
+    vol_std_values = stats["std"]
     np.savetxt(path_result + "vol_std_values.txt", vol_std_values)
 
     
     # Extract the indices of outlier volumes
-    outlier_idx, lo_hi_thresh = iqr_outliers(vol_std_values)
+    outlier_idx = std_idx[std_offsets[i]:std_offsets[i + 1]]
+    lo_hi_thresh = std_thresh[i]
     np.savetxt(path_result + "vol_std_outliers.txt", outlier_idx)
 
 
@@ -80,8 +100,9 @@ for ID in IDs:
 
     # We make a new plot of the root-mean-square values, once again marking
     # each outlier with an 'o' and the thresholds with horizontal dashed lines
-    rmsd = vol_rms_diff(data)
-    rmsd_outlier_idx, rmsd_thresh = iqr_outliers(rmsd)
+    rmsd = stats["dvars"]
+    rmsd_outlier_idx = rmsd_idx[rmsd_offsets[i]:rmsd_offsets[i + 1]]
+    rmsd_thresh = rmsd_thresholds[i]
     plt.plot(rmsd, c="b")
     rmsd_outliers = plt.scatter(rmsd_outlier_idx, rmsd[rmsd_outlier_idx], c="r")
     lo_rmsd_thresh = plt.axhline(rmsd_thresh[0], color="c", ls="--")
@@ -100,7 +121,7 @@ for ID in IDs:
     # each outlier marked with an 'o' and horizontal dashed lines at the
     # thresholds. Notice that we must append a 0 to the root-mean-square
     # differences so that its length will be equal to the number of volumes.
-    edo_idx = extend_diff_outliers(rmsd_outlier_idx)
+    edo_idx = edo_all_idx[edo_offsets[i]:edo_offsets[i + 1]]
     extd_rmsd = np.append(rmsd, 0)
     plt.plot(extd_rmsd, c="b")
     extd_rmsd_outlier = plt.scatter(edo_idx, extd_rmsd[edo_idx], c="r")
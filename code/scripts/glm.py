@@ -4,23 +4,56 @@ Purpose
 This script contains code to fit and assess the use of generalized linear model
 on the smoothed data. This analysis cannot be performed before `convolution` and
 also follows the logic obtained from `diagnosis` in that it refuses to drop
-outlier volumes.
-
-It should produce a total of three figures and six .nii files per run:
+outlier volumes from its main results. As a sensitivity check, it also fits the
+model without the extended difference outliers found by `diagnosis` (if it has
+been run) and saves the resulting t-statistics to `t_stat_censored_*.nii.gz`.
+If `prewhiten` is set, it also fits the model under AR(1) noise and saves its
+t-statistics and p-values, along with the AR(1) coefficient of each voxel, to
+separate `*_ar1*.nii.gz` files; every other output comes from the ordinary
+least squares fit.
+
+It should produce a total of three figures and twenty-four .nii files per run:
+- `ar1_coefficient.nii.gz`
+- `F_stat_drift.nii.gz`
+- `p_value_fwe_dist2indiff.nii.gz`
+- `p_value_fwe_gain.nii.gz`
+- `p_value_fwe_loss.nii.gz`
+- `p_value_fwe_loss_aversion.nii.gz`
+- `p_value_ar1_dist2indiff.nii.gz`
+- `p_value_ar1_gain.nii.gz`
+- `p_value_ar1_loss.nii.gz`
 - `p_value_dist2indiff.nii.gz`
+- `p_value_drift.nii.gz`
 - `p_value_gain.nii.gz`
 - `p_value_loss.nii.gz`
+- `p_value_loss_aversion.nii.gz`
 - `regr_coef_by_voxel_dist2indiff.png`
 - `regr_coef_by_voxel_gain.png`
 - `regr_coef_by_voxel_loss.png`
+- `t_stat_ar1_dist2indiff.nii.gz`
+- `t_stat_ar1_gain.nii.gz`
+- `t_stat_ar1_loss.nii.gz`
+- `t_stat_censored_dist2indiff.nii.gz`
+- `t_stat_censored_gain.nii.gz`
+- `t_stat_censored_loss.nii.gz`
+- `t_stat_dist2indiff.nii.gz`
+- `t_stat_gain.nii.gz`
+- `t_stat_loss.nii.gz`
+- `t_stat_loss_aversion.nii.gz`
+It also saves all relevant neural loss aversion data (the contrast of negative
+gain and loss coefficients, with its t-statistic and p-value) to a single
+plaintext file `results/neural_loss_aversion.txt`.
+
+Finally, it fits a fixed-effects model to the three runs of each subject and
+saves four .nii files per subject to `results/fixed_effects/`:
 - `t_stat_dist2indiff.nii.gz`
 - `t_stat_gain.nii.gz`
 - `t_stat_loss.nii.gz`
-It also saves all relevant neural loss aversion data to a single plaintext file
-`results/neural_loss_aversion.txt`.
+- `t_stat_loss_aversion.nii.gz`
 """
 from __future__ import division, print_function, absolute_import
 from matplotlib import colors
+from multiprocessing import cpu_count
 import matplotlib.pyplot as plt
 import nibabel as nib
 import numpy as np
@@ -28,43 +61,64 @@ import numpy.linalg as npl
 import os, sys
 
 sys.path.append("code/utils")
+from design import *
 from diagnostics import *
 from hypothesis import *
 from make_class import *
 from plot_tool import *
+from run_tool import *
 from stat_utils import *
 
 
+# Number of permutations of the volumes used to correct p-values for the
+# family-wise error rate over voxels
+n_permutations = 1000
+
+# Number of voxels read from the smoothed data and fitted at a time
+block_size = 16384
+
+# Whether to also save t-statistics and p-values of the regressors that account
+# for AR(1) autocorrelation of the noise, by prewhitening voxels with similar
+# estimates of the autocorrelation together
+prewhiten = True
+
+
 # Create a file to use as a repository for neural loss aversion data
 with open("results/neural_loss_aversion.txt", "w") as outfile:
-    outfile.write("run\tsubject\tneural_loss_aversion\n")
+    outfile.write("run\tsubject\tneural_loss_aversion\tt_stat\tp_value\n")
 
 
 # Create a collection of all subject IDs and all run IDs
-run_IDs = [str(i).zfill(3) for i in range(1, 4)]
-subject_IDs = [str(i).zfill(3) for i in range(1, 17)]
-IDs = list(zip([run_ID for _ in range(16) for run_ID in run_IDs],
-               [subject_ID for _ in range(3) for subject_ID in subject_IDs]))
-IDs.sort()
-
-# We perform the procedure outlined in this script for each run of each subject:
-for ID in IDs:
+IDs = run_IDs()
+
+# Load the convolution data of every run at once
+designs = load_designs("results/designs.npz")
+
+# Keep the design matrix of each run for the fixed-effects analysis
+design_matrices = {}
+
+# We perform the procedure outlined in this script for each run of each subject,
+# loading the next run in the background in the meantime. Runs are kept in the
+# process-wide cache of get_ds005() for the fixed-effects analysis below:
+for ID, obj in iter_ds005(IDs, cache=True):
     run, subject = ID
 
 
-    # Extract the data of interest
-    obj = ds005(subject, run)
-    smoothed_data = obj.filtered.smooth()
+    # Identify which voxels are inside the brain: voxels whose mean smoothed
+    # signal is above the 80th percentile. The mask is saved after the first
+    # time it is computed for a run.
+    voxels_in_brain = obj.filtered.brain_mask()
+
+    # Extract the data of interest, smoothing only the part of each volume that
+    # surrounds the brain
+    smoothed_data = obj.filtered.smooth(n_threads=cpu_count(),
+                                        mask=voxels_in_brain, cache=True)
     affine = obj.filtered.affine
-    volume_shape = smoothed_data.shape[:3]
     num_volumes = smoothed_data.shape[3]
 
     
-    # Load convolution data
-    path_convolution = "results/run%s/convolution/sub%s/" % ID
-    conv_gain = np.loadtxt(path_convolution + "conv_gain.txt")
-    conv_loss = np.loadtxt(path_convolution + "conv_loss.txt")
-    conv_dist2indiff = np.loadtxt(path_convolution + "conv_dist2indiff.txt")
+    # Extract the convolution data of this run
+    conv_gain, conv_loss, conv_dist2indiff = designs.get(ID).T
 
 
     # Define results directories to which to save the figures produced
@@ -91,25 +145,66 @@ for ID in IDs:
     design_matrix[:, 3] = conv_dist2indiff
     design_matrix[:, 4] = linear_drift
     design_matrix[:, 5] = quadratic_drift 
-
-
-    # Compute a threshold for identifying which voxels are inside the brain
-    voxel_means = np.mean(smoothed_data, axis=3)
-    voxels_in_brain = voxel_means > np.percentile(voxel_means, 80)
-
-    
-    # Compute regression coefficients for all voxels over time
-    response = smoothed_data[voxels_in_brain].T
-    regr_coef, df, MRSS = glm_util(design_matrix, response)
-    regr_coef_by_voxel = np.zeros(volume_shape + (num_regressors,))
-    regr_coef_by_voxel[voxels_in_brain] = regr_coef.T
-
-    # Assess statistical significance of regressors by voxel
-    t_stat_by_voxel = np.zeros(regr_coef_by_voxel.shape)
-    p_value_by_voxel = np.zeros(regr_coef_by_voxel.shape)
-    t_stat, p_value = ttest(design_matrix, regr_coef, response.T)
-    t_stat_by_voxel[voxels_in_brain] = t_stat.T
-    p_value_by_voxel[voxels_in_brain] = p_value.T
+    design_matrices[ID] = design_matrix
+
+
+    # Load the extended difference outliers found by `diagnosis`, if any. The
+    # main results keep every volume; the censored model leaves the outliers
+    # out, as a check of how sensitive the results are to them.
+    path_outliers = ("results/run%s/diagnosis/sub%s/"
+                     "extended_vol_rms_outliers.txt" % ID)
+    outliers = np.array([], dtype=int)
+    if os.path.isfile(path_outliers):
+        outliers = np.atleast_1d(np.loadtxt(path_outliers)).astype(int)
+
+    # Fit the model to all voxels in the brain, with and without the outliers,
+    # reading the smoothed data one block of voxels at a time. The design
+    # matrix is factorized only once (the censored factorization is a downdate
+    # of it), and each block is fitted once by both models. The prewhitened fit
+    # reuses the ordinary least squares coefficients of the block.
+    model = glm_model(design_matrix)
+    censored = model.censored(outliers)
+    contrasts = [[0, 1, 0, 0, 0, 0], [0, 0, 1, 0, 0, 0], [0, 0, 0, 1, 0, 0],
+                 [0, -1, -1, 0, 0, 0]]
+    num_in_brain = int(voxels_in_brain.sum())
+    regr_coef = np.empty((num_regressors, num_in_brain))
+    regr_coef_censored = np.empty((num_regressors, num_in_brain))
+    MRSS, MRSS_censored = np.empty(num_in_brain), np.empty(num_in_brain)
+    t_stat_ar1 = np.empty((num_regressors, num_in_brain))
+    p_value_ar1 = np.empty((num_regressors, num_in_brain))
+    rho = np.empty(num_in_brain)
+    start = 0
+    for block, response in voxel_blocks(smoothed_data, voxels_in_brain,
+                                        block_size):
+        position = slice(start, start + len(block))
+        start += len(block)
+        fits = fit_models([model, censored], response)
+        regr_coef[:, position], MRSS[position] = fits[0][0], fits[0][2]
+        regr_coef_censored[:, position] = fits[1][0]
+        MRSS_censored[position] = fits[1][2]
+        if prewhiten:
+            t_stat_ar1[:, position], p_value_ar1[:, position], \
+                rho[position] = model.fit_ar1(
+                    response, regression_coefficients=fits[0][0])[2:]
+
+    t_stat, p_value = model.ttest(regr_coef, MRSS)
+    regr_coef_by_voxel = obj.filtered.unmask(regr_coef.T, voxels_in_brain)
+    t_stat_by_voxel = obj.filtered.unmask(t_stat.T, voxels_in_brain)
+    p_value_by_voxel = obj.filtered.unmask(p_value.T, voxels_in_brain)
+
+    # Save the t-statistics and p-values of the prewhitened model, along with
+    # the AR(1) coefficients, as separate outputs
+    if prewhiten:
+        t_stat_ar1 = obj.filtered.unmask(t_stat_ar1.T, voxels_in_brain)
+        p_value_ar1 = obj.filtered.unmask(p_value_ar1.T, voxels_in_brain)
+        for i, name in enumerate(["gain", "loss", "dist2indiff"], 1):
+            nib.save(nib.Nifti1Image(t_stat_ar1[..., i], affine),
+                     path_result + "t_stat_ar1_%s.nii.gz" % name)
+            nib.save(nib.Nifti1Image(p_value_ar1[..., i], affine),
+                     path_result + "p_value_ar1_%s.nii.gz" % name)
+        nib.save(nib.Nifti1Image(obj.filtered.unmask(rho, voxels_in_brain),
+                                 affine),
+                 path_result + "ar1_coefficient.nii.gz")
 
 
     # Save the t-statistics as .nii files
@@ -132,8 +227,54 @@ for ID in IDs:
     nib.save(p_value_dist2indiff, path_result + "p_value_dist2indiff.nii.gz")
 
 
-    # Set up our color utilities
-    voxel_means[~voxels_in_brain] = np.nan
+    # Save the t-statistics of the model without the outlier volumes
+    t_stat_censored = censored.ttest(regr_coef_censored, MRSS_censored)[0]
+    t_stat_censored = obj.filtered.unmask(t_stat_censored.T, voxels_in_brain)
+    for i, name in enumerate(["gain", "loss", "dist2indiff"], 1):
+        nib.save(nib.Nifti1Image(t_stat_censored[..., i], affine),
+                 path_result + "t_stat_censored_%s.nii.gz" % name)
+
+
+    # Test the neural loss aversion contrast and, jointly, the drift terms,
+    # reusing the factorization of the design matrix
+    loss_aversion, t_stat_aversion, p_value_aversion = model.t_contrast(
+        [0, -1, -1, 0, 0, 0], regr_coef, MRSS)
+    effect_drift, F_stat_drift, p_value_drift = model.f_contrast(
+        [[0, 0, 0, 0, 1, 0], [0, 0, 0, 0, 0, 1]], regr_coef, MRSS)
+
+    loss_aversion_by_voxel = obj.filtered.unmask(loss_aversion,
+                                                 voxels_in_brain, np.nan)
+    t_stat_aversion = obj.filtered.unmask(t_stat_aversion, voxels_in_brain)
+    p_value_aversion = obj.filtered.unmask(p_value_aversion, voxels_in_brain)
+    F_stat_drift = obj.filtered.unmask(F_stat_drift, voxels_in_brain)
+    p_value_drift = obj.filtered.unmask(p_value_drift, voxels_in_brain)
+
+    nib.save(nib.Nifti1Image(t_stat_aversion, affine),
+             path_result + "t_stat_loss_aversion.nii.gz")
+    nib.save(nib.Nifti1Image(p_value_aversion, affine),
+             path_result + "p_value_loss_aversion.nii.gz")
+    nib.save(nib.Nifti1Image(F_stat_drift, affine),
+             path_result + "F_stat_drift.nii.gz")
+    nib.save(nib.Nifti1Image(p_value_drift, affine),
+             path_result + "p_value_drift.nii.gz")
+
+
+    # Correct the p-values of the three conditions and of the neural loss
+    # aversion for the family-wise error rate over the whole brain with a
+    # permutation test, which streams through the smoothed data itself and
+    # starts its processes once per run
+    p_value_fwe = permutation_test(design_matrix, smoothed_data, contrasts,
+                                   n_permutations, block_size=block_size,
+                                   n_jobs=cpu_count(),
+                                   mask=voxels_in_brain)[1]
+    p_value_fwe = obj.filtered.unmask(p_value_fwe.T, voxels_in_brain, 1)
+    names = ["gain", "loss", "dist2indiff", "loss_aversion"]
+    for i, name in enumerate(names):
+        nib.save(nib.Nifti1Image(p_value_fwe[..., i], affine),
+                 path_result + "p_value_fwe_%s.nii.gz" % name)
+
+
+    # Set up our color utilities, leaving out voxels outside the brain
     regr_coef_by_voxel[~voxels_in_brain] = np.nan
     nice_cmap_values = np.loadtxt("code/scripts/actc.txt")
     nice_cmap = colors.ListedColormap(nice_cmap_values, "actc")
@@ -166,16 +307,55 @@ for ID in IDs:
     plt.close()
 
 
-    # Compute the neural loss aversion
-    neural_loss_aversion = -loss_coef_by_voxel - gain_coef_by_voxel
-    
-    # Inspect specifically the B ventral striatum
+    # Inspect the neural loss aversion specifically in the B ventral striatum
     mm_to_voxels = npl.inv(affine)
     BVS = nib.affines.apply_affine(mm_to_voxels, [3.6, 6.3, 3.9]).round()
     BVS = tuple(int(coordinate) for coordinate in BVS)
-    neural_loss_aversion = neural_loss_aversion[BVS]
+    values = [loss_aversion_by_voxel[BVS], t_stat_aversion[BVS],
+              p_value_aversion[BVS]]
  
     # Save the results to the neural loss aversion repository file
     with open("results/neural_loss_aversion.txt", "a") as outfile:
-        newline = run + "\t" + subject + "\t" + str(neural_loss_aversion) + "\n"
+        newline = "\t".join([run, subject] + [str(v) for v in values]) + "\n"
         outfile.write(newline)
+
+
+# Fit a fixed-effects model to the three runs of each subject, in which gain,
+# loss, and distance from indifference have one coefficient per subject and the
+# intercept and drift terms have one coefficient per run. Brain masks and
+# smoothed data were saved to the cache during the first pass, and the runs
+# themselves are reused from it.
+subject_IDs = run_IDs(order="subject")
+for first in range(0, len(subject_IDs), 3):
+    IDs_subject = subject_IDs[first:(first + 3)]
+    subject = IDs_subject[0][1]
+    objs = [get_ds005(subject, run) for run, subject in IDs_subject]
+    masks = [obj.filtered.brain_mask() for obj in objs]
+    voxels_in_brain = np.logical_and.reduce(masks)
+    responses = [obj.filtered.mask_data(obj.filtered.smooth(
+                     n_threads=cpu_count(), mask=mask, cache=True),
+                     voxels_in_brain)
+                 for obj, mask in zip(objs, masks)]
+    model, regr_coef, MRSS = fixed_effects(
+        [design_matrices[ID] for ID in IDs_subject],
+        [response.T for response in responses], [1, 2, 3])
+    t_stat = model.ttest(regr_coef, MRSS)[0][:3]
+    contrast = np.zeros(regr_coef.shape[0])
+    contrast[:2] = -1
+    t_stat_aversion = model.t_contrast(contrast, regr_coef, MRSS)[1]
+
+
+    # Save the t-statistics as .nii files
+    path_result = "results/fixed_effects/sub%s/" % subject
+    try:
+        os.makedirs(path_result)
+    except OSError:
+        if not os.path.isdir(path_result):
+            raise
+    affine = objs[0].filtered.affine
+    names = ["gain", "loss", "dist2indiff"]
+    for name, values in zip(names + ["loss_aversion"],
+                            list(t_stat) + [t_stat_aversion]):
+        t_stat_by_voxel = objs[0].filtered.unmask(values, voxels_in_brain)
+        nib.save(nib.Nifti1Image(t_stat_by_voxel, affine),
+                 path_result + "t_stat_%s.nii.gz" % name)
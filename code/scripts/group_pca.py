@@ -0,0 +1,92 @@
+"""
+Purpose
+-------
+This script performs principal component analysis on the filtered data of all
+runs at once, to find the spatial patterns shared by every subject. Since all
+runs together do not fit in memory, each run is reduced to its own top
+components as soon as it is loaded, and the group components are updated with
+them before the next run is read. Only the voxels inside the brain of every run
+are analyzed.
+
+It should output three files to `results/group_pca/`:
+- `eigenvalues.txt`
+- `scree_plot.png`
+- `spatial_maps.nii.gz`
+and one file per run, the time course of each group component in that run:
+- `time_courses.txt`
+"""
+from __future__ import absolute_import, division, print_function
+import matplotlib.pyplot as plt
+import nibabel as nib
+import numpy as np
+import os, sys
+
+sys.path.append("code/utils")
+from decomposition import *
+from make_class import *
+from run_tool import *
+
+
+# Number of group components that are kept
+n_components = 20
+
+# Number of components to which each run is reduced
+n_run_components = 30
+
+
+# Create a collection of all subject IDs and all run IDs
+IDs = run_IDs()
+
+# Identify the voxels inside the brain of every run. Brain masks are saved after
+# the first time they are computed for a run, so this is usually quick.
+voxels_in_brain = None
+for ID, obj in iter_ds005(IDs, images=()):
+    mask = obj.filtered.brain_mask()
+    if voxels_in_brain is None:
+        voxels_in_brain, affine = mask, obj.filtered.affine
+    else:
+        voxels_in_brain = voxels_in_brain & mask
+    obj.release()
+
+
+# Reduce each run and update the group components with it, loading the next run
+# in the background in the meantime. Only the runs being read and reduced are
+# ever held in memory.
+group = group_pca(voxels_in_brain, n_components, n_run_components)
+for ID, obj in iter_ds005(IDs):
+    group.add_run(obj.filtered.data, ID)
+    obj.release()
+
+
+# Save the group spatial maps, the fractions of variance they explain, and a
+# scree plot of the latter
+path_result = "results/group_pca/"
+try:
+    os.makedirs(path_result)
+except OSError:
+    if not os.path.isdir(path_result):
+        raise
+nib.save(nib.Nifti1Image(group.spatial_maps, affine),
+         path_result + "spatial_maps.nii.gz")
+explained_variance_ratio = group.explained_variance_ratio
+np.savetxt(path_result + "eigenvalues.txt", explained_variance_ratio)
+
+fig = plt.figure(figsize=(8, 5))
+components = np.arange(len(explained_variance_ratio)) + 1
+plt.plot(components, explained_variance_ratio, "ro-", linewidth=2)
+plt.title("Scree Plot (Group)")
+plt.xlabel("Principal Component")
+plt.ylabel("Fraction of Variance Explained")
+plt.savefig(path_result + "scree_plot.png")
+plt.close()
+
+
+# Save the projection of each run onto the group spatial maps
+for ID, time_courses in zip(group.IDs, group.projections()):
+    path_result = "results/run%s/group_pca/sub%s/" % ID
+    try:
+        os.makedirs(path_result)
+    except OSError:
+        if not os.path.isdir(path_result):
+            raise
+    np.savetxt(path_result + "time_courses.txt", time_courses)
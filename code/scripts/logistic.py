@@ -19,6 +19,7 @@ import sys
 sys.path.append("code/utils")
 from hypothesis import *
 from make_class import *
+from run_tool import *
 
 
 # Create plaintext files in which to store Lambdas
@@ -29,11 +30,7 @@ with open("results/lambda_no_dist2indiff.txt", "w") as outfile:
 
 
 # Create a collection of all subject IDs and all run IDs
-run_IDs = [str(i).zfill(3) for i in range(1, 4)]
-subject_IDs = [str(i).zfill(3) for i in range(1, 17)]
-IDs = list(zip([run_ID for _ in range(16) for run_ID in run_IDs],
-               [subject_ID for _ in range(3) for subject_ID in subject_IDs]))
-IDs.sort()
+IDs = run_IDs()
 
 # We perform the procedure outlined in this script for each run of each subject:
 for ID in IDs:
@@ -11,6 +11,7 @@ one of which is the image before smoothing and the other the image after
 smoothing.
 """
 from __future__ import absolute_import, division, print_function
+from multiprocessing import cpu_count
 import matplotlib.pyplot as plt
 import numpy as np
 import os, sys
@@ -18,24 +19,18 @@ import os, sys
 sys.path.append("code/utils")
 from make_class import *
 from plot_tool import *
+from run_tool import *
 
 
 # Create a collection of all subject IDs and all run IDs
-run_IDs = [str(i).zfill(3) for i in range(1, 4)]
-subject_IDs = [str(i).zfill(3) for i in range(1, 17)]
-IDs = list(zip([run_ID for _ in range(16) for run_ID in run_IDs],
-               [subject_ID for _ in range(3) for subject_ID in subject_IDs]))
-IDs.sort()
+IDs = run_IDs()
 
-# We perform the procedure outlined in this script for each run of each subject:
-for ID in IDs:
+# We perform the procedure outlined in this script for each run of each subject,
+# loading the next run in the background in the meantime:
+for ID, obj in iter_ds005(IDs, images=("raw", "filtered")):
     run, subject = ID
 
 
-    # Extract the data of interest
-    obj = ds005(subject, run)
-
-
     # Define results directories to which to save the figures produced
     path_result = "results/run%s/smoothing/sub%s/" % ID
     try:
@@ -54,7 +49,10 @@ for ID in IDs:
     plt.savefig(path_result + "raw_original.png")
     plt.close()
 
-    raw_smoothed = plot_volume(obj.raw.smooth(), 50)
+    # Smoothed data are saved to the cache the first time they are computed, so
+    # that running this script again only reads them
+    raw_smoothed = plot_volume(obj.raw.smooth(n_threads=cpu_count(),
+                                              cache=True), 50)
     plt.imshow(raw_smoothed)
     plt.colorbar()
     plt.title("Raw Data: After Smoothing")
@@ -68,7 +66,8 @@ for ID in IDs:
     plt.savefig(path_result + "filtered_original.png")
     plt.close()
 
-    filtered_smoothed = plot_volume(obj.filtered.smooth(), 50)
+    filtered_smoothed = plot_volume(obj.filtered.smooth(n_threads=cpu_count(),
+                                                        cache=True), 50)
     plt.imshow(filtered_smoothed)
     plt.colorbar()
     plt.title("Filtered Data: After Smoothing")
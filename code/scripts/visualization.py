@@ -40,25 +40,21 @@ sys.path.append("code/utils")
 
 from make_class import *
 from plot_tool import *
+from run_tool import *
 
 # Create a collection of all subject IDs and all run IDs
-run_IDs = [str(i).zfill(3) for i in range(1, 4)]
-subject_IDs = [str(i).zfill(3) for i in range(1, 17)]
-IDs = list(zip([run_ID for _ in range(16) for run_ID in run_IDs],
-               [subject_ID for _ in range(3) for subject_ID in subject_IDs]))
-IDs.sort()
+IDs = run_IDs()
 
 # Do this for all subjects/runs:
-for ID in IDs:
+for ID, sub in iter_ds005(IDs):
     run, subject = ID
 
 
-    # Extract necessary data
-    sub = ds005(subject, run)
+    # Extract necessary data. The smoothed data are saved to the cache the first
+    # time they are computed, so that running this script again only reads them
     data = sub.filtered.data
     affine = sub.filtered.affine
-    img = sub.filtered.img
-    smooth_img = image.smooth_img(img, 6) # smoothed image
+    smooth_img = nib.Nifti1Image(sub.filtered.smooth(6, cache=True), affine)
 
 
     # Save paths for input and output
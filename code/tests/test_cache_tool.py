@@ -0,0 +1,101 @@
+"""
+Tests functionality of the cache_tool module
+
+Tests can be run from the project main directory with:
+    nosetests code/tests/test_cache_tool.py
+"""
+from __future__ import absolute_import, division, print_function
+from numpy.testing import assert_array_equal
+import nibabel as nib
+import numpy as np
+import os, shutil, sys, tempfile, threading
+
+sys.path.append("code/utils")
+import cache_tool
+
+
+def setup_module():
+    # Redirect the cache to a temporary directory
+    global cache_dir
+    cache_dir = cache_tool.cache_dir
+    cache_tool.cache_dir = tempfile.mkdtemp() + "/"
+
+def teardown_module():
+    shutil.rmtree(cache_tool.cache_dir)
+    cache_tool.cache_dir = cache_dir
+
+def test_file_hash():
+
+    # Hashes are computed from the files themselves
+    path = tempfile.mkstemp(dir=cache_tool.cache_dir)[1]
+    with open(path, "w") as outfile:
+        outfile.write("first")
+    expected = cache_tool.generate_file_md5(path)
+    assert cache_tool.file_hash(path) == expected
+    assert cache_tool.cache_path(path, "_tag").endswith(expected + "_tag.npy")
+
+    # Other processes read the hash from the index instead of hashing the file
+    # again, for as long as the file is unchanged
+    cache_tool._indices.clear()
+    generate_file_md5 = cache_tool.generate_file_md5
+    cache_tool.generate_file_md5 = None
+    try:
+        assert cache_tool.file_hash(path) == expected
+    finally:
+        cache_tool.generate_file_md5 = generate_file_md5
+
+    # A file that changes gets a new hash, and thus new cache files
+    with open(path, "w") as outfile:
+        outfile.write("second")
+    os.utime(path, (0, 0))
+    assert cache_tool.file_hash(path) != expected
+    assert cache_tool.file_hash(path) == generate_file_md5(path)
+    os.remove(path)
+
+def test_threads():
+
+    # Threads that hash files and save the same cache file at the same time
+    # neither lose entries of the index nor share temporary files
+    paths = []
+    for i in range(8):
+        path = tempfile.mkstemp(dir=cache_tool.cache_dir)[1]
+        with open(path, "w") as outfile:
+            outfile.write(str(i))
+        paths.append(path)
+    path_cache = cache_tool.cache_dir + "shared.npy"
+
+    def work(path):
+        cache_tool.file_hash(path)
+        cache_tool.save_cache(path_cache, np.arange(1000))
+
+    threads = [threading.Thread(target=work, args=(path,)) for path in paths]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cache_tool._indices.clear()
+    assert set(paths) <= set(cache_tool._load_index())
+    assert_array_equal(np.load(path_cache), np.arange(1000))
+    assert not [name for name in os.listdir(cache_tool.cache_dir)
+                if name.endswith(".tmp")]
+    for path in paths:
+        os.remove(path)
+
+def test_cache_image():
+
+    path = "data/ds005/subtest/BOLD/task001_run001/bold.nii.gz"
+    expected = nib.load(path).get_data()
+
+    # The uncompressed copy is created once and then reused
+    path_cache = cache_tool.cache_image(path)
+    assert os.path.isfile(path_cache)
+    assert_array_equal(np.load(path_cache), expected)
+    os.utime(path_cache, (0, 0))
+    assert cache_tool.cache_image(path) == path_cache
+    assert os.path.getmtime(path_cache) == 0
+
+    # Cached data are memory-mapped and read-only
+    data = cache_tool.load_image(path)
+    assert isinstance(data, np.memmap)
+    assert not data.flags.writeable
+    assert_array_equal(data, expected)
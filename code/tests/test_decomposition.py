@@ -0,0 +1,114 @@
+"""
+Tests functions in decomposition.py
+
+Run with:
+    nosetests code/tests/test_decomposition.py
+in the main project directory
+"""
+
+from __future__ import absolute_import, division, print_function
+from nose.tools import assert_raises
+from numpy.testing import assert_allclose
+from sklearn.decomposition import PCA
+import numpy as np
+import sys
+
+sys.path.append("code/utils")
+from decomposition import *
+
+def test_randomized_pca():
+
+    # Simulate voxels driven by three time courses plus a little noise
+    np.random.seed(10)
+    sources = np.random.normal(size=(40, 3)) * [5, 3, 2]
+    arr_2d = np.random.normal(size=(300, 3)).dot(sources.T)
+    arr_2d += 0.01 * np.random.normal(size=(300, 40)) + 7
+    maps, courses, variance, ratio = randomized_pca(arr_2d, 3,
+                                                    center="volume",
+                                                    block_size=64)
+    assert maps.shape == (300, 3) and courses.shape == (40, 3)
+    assert_allclose(courses.T.dot(courses), np.eye(3), atol=1e-12)
+
+    # The components match those of a full PCA, up to their signs
+    pca = PCA(n_components=3, svd_solver="full").fit(arr_2d)
+    signs = np.sign(np.sum(pca.components_ * courses.T, 1))
+    assert_allclose(courses, pca.components_.T * signs, atol=1e-6)
+    assert_allclose(maps, pca.transform(arr_2d) * signs, atol=1e-6)
+    assert_allclose(variance, pca.explained_variance_, rtol=1e-6)
+    assert_allclose(ratio, pca.explained_variance_ratio_, rtol=1e-6)
+    assert ratio.sum() > 0.99
+
+    # A mask selects the voxels of 4-D data, and "both" also centers voxels
+    arr_4d = arr_2d.reshape(5, 6, 10, 40)
+    mask = np.zeros((5, 6, 10), dtype=bool)
+    mask[1:4] = True
+    masked = randomized_pca(arr_4d, 2, mask, block_size=50, seed=3)
+    assert masked[0].shape == (5, 6, 10, 2)
+    assert np.all(masked[0][~mask] == 0)
+    centered = arr_4d[mask] - arr_4d[mask].mean(0)
+    centered -= centered.mean(1)[:, np.newaxis]
+    U, S, Vt = np.linalg.svd(centered, full_matrices=False)
+    signs = np.sign(np.sum(Vt[:2] * masked[1].T, 1))
+    assert_allclose(masked[1], Vt[:2].T * signs, atol=1e-6)
+    assert_allclose(masked[0][mask], U[:, :2] * S[:2] * signs, atol=1e-6)
+    assert_allclose(masked[3], S[:2] ** 2 / np.sum(S ** 2), rtol=1e-6)
+
+    # Results are reproducible and invalid inputs are rejected
+    again = randomized_pca(arr_4d, 2, mask, block_size=50, seed=3)
+    for result, expected in zip(again, masked):
+        assert_allclose(result, expected)
+    assert_raises(AssertionError, randomized_pca, arr_2d, 41)
+    assert_raises(AssertionError, randomized_pca, arr_2d, center="time")
+    assert_raises(AssertionError, randomized_pca, arr_4d, mask=mask[0])
+
+def test_group_pca():
+
+    # Simulate three runs that share their spatial sources but not their time
+    # courses, in slightly different brain masks
+    np.random.seed(11)
+    sources = np.random.normal(size=(5, 6, 10, 3)) * [4, 2, 1]
+    runs = [sources.dot(np.random.normal(size=(3, 30))) +
+            0.1 * np.random.normal(size=(5, 6, 10, 30)) for run in range(3)]
+    mask = np.ones((5, 6, 10), dtype=bool)
+    mask[0] = False
+    group = group_pca(mask, n_components=12, n_run_components=4)
+    for i, data in enumerate(runs):
+        group.add_run(data, ("00%d" % (i + 1), "001"), block_size=64)
+    assert len(group) == 3 and group.IDs[2] == ("003", "001")
+
+    # Without truncation, the group components match the SVD of the reduced
+    # runs placed side by side
+    reduced = [randomized_pca(data, 4, mask, block_size=64) for data in runs]
+    G = np.column_stack([maps[mask] for maps, courses, var, ratio in reduced])
+    U, S, Vt = np.linalg.svd(G, full_matrices=False)
+    maps = group.spatial_maps
+    assert maps.shape == (5, 6, 10, 12) and np.all(maps[~mask] == 0)
+    assert_allclose(np.abs(maps[mask][:, :3]), np.abs(U[:, :3] * S[:3]),
+                    atol=1e-6)
+    assert_allclose(group.explained_variance_ratio[:3],
+                    S[:3] ** 2 / np.sum(S ** 2), rtol=1e-6)
+
+    # Each run's projection matches projecting its centered data onto the maps
+    unit_maps = maps[mask][:, :3] / np.sqrt(np.sum(maps[mask][:, :3] ** 2, 0))
+    for data, projection in zip(runs, group.projections()):
+        centered = data[mask] - data[mask].mean(0)
+        centered -= centered.mean(1)[:, np.newaxis]
+        assert projection.shape == (30, 12)
+        assert_allclose(projection[:, :3], centered.T.dot(unit_maps),
+                        atol=0.05)
+
+    # Keeping fewer components still finds the dominant ones
+    small = group_pca(mask, n_components=3, n_run_components=4)
+    for data in runs:
+        small.add_run(data)
+    assert small.spatial_maps.shape == (5, 6, 10, 3)
+    assert_allclose(small.spatial_maps[mask], maps[mask][:, :3], atol=0.05)
+    assert small.projections()[0].shape == (30, 3)
+
+    # Runs without noise span only three dimensions, and so does the group
+    exact = group_pca(mask, n_components=12, n_run_components=4)
+    for run in range(3):
+        exact.add_run(sources.dot(np.random.normal(size=(3, 30))))
+    assert exact.spatial_maps.shape == (5, 6, 10, 3)
+    unit_maps = exact.spatial_maps[mask] / exact._S
+    assert_allclose(unit_maps.T.dot(unit_maps), np.eye(3), atol=1e-12)
@@ -0,0 +1,104 @@
+"""
+Tests functionality of the design module
+
+Tests can be run from the project main directory with:
+    nosetests code/tests/test_design.py
+"""
+from __future__ import absolute_import, division, print_function
+from nose.tools import assert_raises
+from numpy.testing import assert_allclose, assert_array_equal
+import numpy as np
+import os, sys, tempfile
+
+sys.path.append("code/utils")
+from design import *
+
+
+def loop_time_course(condition, n_samples, step_size):
+    # Reference implementation that paints one trial at a time
+    time_course = np.zeros(n_samples)
+    for onset, duration, amplitude in condition:
+        start = int(np.floor(onset / step_size))
+        stop = start + int(np.ceil(duration / step_size))
+        time_course[start:stop] = amplitude
+    return time_course
+
+def test_stack_conditions():
+
+    # Tables of different lengths are padded with rows of zeros
+    conditions = stack_conditions([[[[0, 2, 1]], np.zeros((0, 3))],
+                                   [[[0, 2, 1], [4, 2, 3]], [[2, 1, 5]]]])
+    assert conditions.shape == (2, 2, 2, 3)
+    assert_array_equal(conditions[0, 0], [[0, 2, 1], [0, 0, 0]])
+    assert_array_equal(conditions[1, 0], [[0, 2, 1], [4, 2, 3]])
+    assert_raises(AssertionError, stack_conditions, [[[[0, 2, 1]]], []])
+
+def test_time_courses():
+
+    # Compare with painting trials one at a time for random, disjoint trials
+    np.random.seed(0)
+    tables = []
+    for run in range(3):
+        run_tables = []
+        for regressor in range(2):
+            n_events = np.random.randint(1, 20)
+            onsets = 8 * np.arange(n_events) + np.random.uniform(0, 4, n_events)
+            table = np.column_stack([onsets, np.full(n_events, 3),
+                                     np.random.normal(size=n_events)])
+            run_tables.append(table)
+        tables.append(run_tables)
+    conditions = stack_conditions(tables)
+    for step_size in [2, 0.5, 0.1]:
+        n_samples = int(160 / step_size)
+        dense = time_courses(conditions, n_samples, step_size)
+        assert dense.shape == (3, 2, n_samples)
+        # Samples between events are exactly 0, and samples during an event
+        # exactly equal its amplitude
+        for i in range(3):
+            for j in range(2):
+                expected = loop_time_course(tables[i][j], n_samples, step_size)
+                assert_array_equal(dense[i, j], expected)
+                assert np.all(dense[i, j][expected == 0] == 0)
+        matrix = time_courses(conditions, n_samples, step_size, sparse=True)
+        assert matrix.shape == (6, n_samples)
+        assert_array_equal(matrix.toarray(), dense.reshape(6, -1))
+
+    # Overlapping events add up, and events are clipped to the time course
+    conditions = stack_conditions([[[[0, 4, 1], [2, 4, 2], [6, 10, 3]]]])
+    expected = [1, 3, 2, 3]
+    assert_allclose(time_courses(conditions, 4)[0, 0], expected)
+    assert_allclose(time_courses(conditions, 4, sparse=True).toarray()[0],
+                    expected)
+    assert_raises(AssertionError, time_courses, np.zeros((2, 3)), 4)
+
+def test_design_store():
+
+    # Test appending, replacing, and indexing designs
+    path = os.path.join(tempfile.mkdtemp(), "designs.npz")
+    store = design_store(path, ("gain", "loss"), step_size=0.02,
+                         hrf={"duration": 30})
+    assert len(store) == 0 and store.designs.shape == (0, 0, 2)
+    design = np.arange(6.0).reshape(3, 2)
+    store.append(("001", "001"), design)
+    store.append(("001", "002"), -design)
+    store.append(("001", "001"), 2 * design)
+    assert len(store) == 2 and ("001", "002") in store
+    assert_array_equal(store.get(("001", "001")), 2 * design)
+    assert_array_equal(store.get(("001", "002"), "loss"), -design[:, 1])
+    assert_array_equal(store.get(("001", "002"), u"loss"), -design[:, 1])
+    assert_array_equal(store.get(("001", "002"), ["loss", "gain"]),
+                       -design[:, ::-1])
+    assert_raises(AssertionError, store.append, ("002", "001"), design[:2])
+    assert_raises(AssertionError, store.append, ("002", "001"), design[:, :1])
+    assert_raises(AssertionError, store.get, ("002", "001"))
+
+    # Test saving and loading, without loss of precision
+    store.append(("002", "001"), design / 3)
+    store.save()
+    loaded = load_designs(path)
+    assert loaded.IDs == store.IDs and loaded.names == ["gain", "loss"]
+    assert loaded.metadata == {"step_size": 0.02, "hrf": {"duration": 30}}
+    assert_array_equal(loaded.designs, store.designs)
+    assert loaded.designs.shape == (3, 3, 2)
+    assert [name for name in os.listdir(os.path.dirname(path))] == \
+           ["designs.npz"]
@@ -29,6 +29,18 @@ def test_vol_std():
     actual_stds = diagnostics.vol_std(arr_4d)
     assert_almost_equal(expected_stds, actual_stds)
 
+def test_vol_std_dtype():
+    # Single-precision data should give single-precision results that agree
+    # with those computed in double precision
+    arr_4d = np.random.normal(size=(2, 3, 4, 10)) + 100
+    stds_64 = diagnostics.vol_std(arr_4d)
+    stds_32 = diagnostics.vol_std(arr_4d.astype(np.float32))
+    assert stds_32.dtype == np.float32
+    assert_almost_equal(stds_32, stds_64, decimal=4)
+    rms_32 = diagnostics.vol_rms_diff(arr_4d.astype(np.float32))
+    assert rms_32.dtype == np.float32
+    assert_almost_equal(rms_32, diagnostics.vol_rms_diff(arr_4d), decimal=4)
+
 def test_iqr_outliers():
     # Test with simplest possible array
     arr = np.arange(101)  # percentile same as value
@@ -106,3 +118,49 @@ def test_sequential_input():
     indices = np.array([3, 7, 8, 12, 20])
     assert_array_equal(diagnostics.extend_diff_outliers(indices),
                        [3, 4, 7, 8, 9, 12, 13, 20, 21])
+
+def test_vol_stats():
+    # Compare the single-pass statistics with direct computations
+    arr_4d = np.random.normal(size=(5, 3, 4, 10)) * 10 + 1000
+    mask = np.random.uniform(size=(5, 3, 4)) > 0.5
+    for chunk_size in [1, 2, 5, 8]:
+        stats = diagnostics.vol_stats(arr_4d, chunk_size, mask)
+        assert_almost_equal(stats["mean"], arr_4d.mean((0, 1, 2)))
+        assert_almost_equal(stats["std"], diagnostics.vol_std(arr_4d))
+        assert_almost_equal(stats["dvars"], diagnostics.vol_rms_diff(arr_4d))
+        assert_almost_equal(stats["global_signal"], arr_4d[mask].mean(0))
+        assert_almost_equal(stats["slice_mean"], arr_4d.mean((0, 1)))
+        assert_almost_equal(stats["slice_std"], arr_4d.std((0, 1)))
+    stats = diagnostics.vol_stats(arr_4d)
+    assert_almost_equal(stats["global_signal"], stats["mean"])
+    stats_32 = diagnostics.vol_stats(arr_4d.astype(np.float32))
+    assert stats_32["std"].dtype == np.float64
+    stats_32 = diagnostics.vol_stats(arr_4d, dtype=np.float32)
+    assert stats_32["std"].dtype == np.float32
+
+def test_iqr_outliers_batch():
+    # Each series gives the same results as iqr_outliers() on its own
+    arr_2d = np.random.normal(size=(6, 50))
+    arr_2d[1, [3, 4, 40]] = 10
+    arr_2d[4, 0] = -10
+    arr_2d[5] = 0
+    indices, offsets, thresholds = diagnostics.iqr_outliers_batch(arr_2d, 1)
+    assert offsets.shape == (7,) and thresholds.shape == (6, 2)
+    for row in range(6):
+        expected, lo_hi = diagnostics.iqr_outliers(arr_2d[row], 1)
+        assert_array_equal(indices[offsets[row]:offsets[row + 1]], expected)
+        assert_almost_equal(thresholds[row], lo_hi)
+    assert offsets[6] - offsets[5] == 0
+
+def test_extend_diff_outliers_batch():
+    # Each series gives the same results as extend_diff_outliers() on its own
+    series = [np.array([3, 7, 8, 12, 20]), np.array([], dtype=int),
+              np.array([0, 21])]
+    indices = np.concatenate(series)
+    offsets = np.append(0, np.cumsum([len(s) for s in series]))
+    extended, extended_offsets = diagnostics.extend_diff_outliers_batch(
+        indices, offsets, 22)
+    for row in range(3):
+        assert_array_equal(
+            extended[extended_offsets[row]:extended_offsets[row + 1]],
+            diagnostics.extend_diff_outliers(series[row]))
@@ -29,3 +29,52 @@ def test_hrf():
     for i in range(5, 10): assert hr[i] > hr[i + 1]
     for i in range(15, 29): assert hr[i] < hr[i + 1]
 
+def test_hrf_integral():
+    # The integral is 0 before onset and constant after the response ends
+    times = np.arange(-5, 40, 0.001)
+    integral = hrf_integral(times)
+    assert (integral[times <= 0] == 0).all()
+    assert (integral[times >= 30] == integral[-1]).all()
+
+    # Its derivative is the hemodynamic response function, which peaks at 0.6
+    derivative = np.diff(integral) / 0.001
+    assert np.allclose(derivative[5000:34000], hrf(times[5000:34000] + 0.0005),
+                       atol=1e-3)
+    assert abs(derivative.max() - 0.6) < 1e-3
+
+    # Sums over a grid of time points agree with their closed form
+    grid = np.arange(0, 30, 0.1)
+    sums = np.cumsum(hrf(grid)) * 0.1
+    assert np.allclose(hrf_integral(grid, step_size=0.1), sums, atol=1e-3)
+
+def test_hrf_kernel():
+    # Kernels are computed once and cannot be modified
+    kernel = hrf_kernel(0.5)
+    assert np.allclose(kernel, hrf(np.arange(0, 30, 0.5)))
+    assert hrf_kernel(0.5, 30) is kernel
+    assert hrf_kernel(0.25) is not kernel
+    assert not kernel.flags.writeable
+
+def test_convolve():
+    # Both methods agree with np.convolve() for one or many signals
+    np.random.seed(0)
+    kernel = hrf_kernel(0.1)
+    signals = np.random.normal(size=(2, 3, 500))
+    expected = np.array([[np.convolve(signal, kernel)[:500] for signal in row]
+                         for row in signals])
+    for method in ["auto", "direct", "fft"]:
+        assert np.allclose(convolve(signals, kernel, method), expected)
+        assert np.allclose(convolve(signals[0, 0], kernel, method),
+                           expected[0, 0])
+    short = np.arange(5.0)
+    assert np.array_equal(convolve(short, [1, 1]), [0, 1, 3, 5, 7])
+
+    # The transforms leave no rounding residue where the convolution is 0
+    impulses = np.zeros((3, 2000))
+    impulses[1, 700:750] = 1e4
+    impulses[2, 1200] = -3
+    convolution = convolve(impulses, kernel, "fft")
+    assert np.all(convolution[0] == 0)
+    assert np.all(convolution[1, :700] == 0)
+    assert np.all(convolution[2, :1200] == 0)
+    assert np.allclose(convolution[2, 1200:1500], -3 * kernel[:300])
@@ -60,6 +60,26 @@ def test_ttest():
     os.remove("ds114_sub009_t2r1.nii")
     os.remove("ds114_sub009_t2r1_conv.txt")
 
+def test_ttest_dtype():
+
+    # Fit the same model to single- and double-precision responses
+    np.random.seed(0)
+    design = np.ones((60, 2))
+    design[:, 0] = np.random.normal(size=60)
+    data_2d = np.random.normal(size=(1, 60)) + 0.5 * design[:, 0]
+    betas = npl.pinv(design).dot(data_2d.T)
+    t_64, p_64 = ttest(design, betas, data_2d)
+    t_32, p_32 = ttest(design, betas.astype(np.float32),
+                       data_2d.astype(np.float32), dtype=np.float32)
+
+    # Single precision is used only when it is asked for
+    assert [t_32.dtype, p_32.dtype] == [np.float32, np.float32]
+    t_default = ttest(design, betas.astype(np.float32),
+                      data_2d.astype(np.float32))[0]
+    assert t_default.dtype == np.float64
+    assert np.allclose(t_32, t_64, rtol=1e-4)
+    assert np.allclose(p_32, p_64, rtol=1e-3, atol=1e-6)
+
 def test_waldtest():
 
     # Load the dummy dataset into the Python environment
@@ -80,3 +100,112 @@ def test_waldtest():
     # Expect none to be statistically significant
     p_values = waldtest(design_matrix, beta_hat, probability_estimates)
     for p_value in p_values: assert p_value > 0.05
+
+def test_ttest_many_voxels():
+
+    # Each voxel keeps its own standard errors when there are several voxels
+    # and several regressors
+    np.random.seed(1)
+    design = np.ones((30, 3))
+    design[:, :2] = np.random.normal(size=(30, 2))
+    data_2d = np.random.normal(size=(5, 30)) * np.arange(1, 6)[:, np.newaxis]
+    betas = npl.pinv(design).dot(data_2d.T)
+    t_stat, p_value = ttest(design, betas, data_2d)
+    for voxel in range(5):
+        t_voxel, p_voxel = ttest(design, betas[:, voxel:voxel + 1],
+                                 data_2d[voxel:voxel + 1])
+        assert np.allclose(t_stat[:, voxel], t_voxel.ravel())
+        assert np.allclose(p_value[:, voxel], p_voxel.ravel())
+
+def test_ttest_censor():
+
+    # Censored volumes are left out of the residuals and degrees of freedom
+    np.random.seed(2)
+    design = np.ones((30, 2))
+    design[:, 0] = np.random.normal(size=30)
+    data_2d = np.random.normal(size=(4, 30))
+    data_2d[:, 7] += 50
+    censor = [7, 12]
+    kept = np.setdiff1d(np.arange(30), censor)
+    betas = npl.pinv(design[kept]).dot(data_2d[:, kept].T)
+    t_stat, p_value = ttest(design, betas, data_2d, censor)
+    t_kept, p_kept = ttest(design[kept], betas, data_2d[:, kept])
+    assert np.allclose(t_stat, t_kept)
+    assert np.allclose(p_value, p_kept)
+
+def test_permutation_test():
+
+    # One voxel responds to the first regressor, the others are noise
+    np.random.seed(4)
+    design = np.ones((40, 2))
+    design[:, 0] = np.random.normal(size=40)
+    data_2d = np.random.normal(size=(40, 30))
+    data_2d[:, 0] += 3 * design[:, 0]
+    t_stat, p_value, max_null = permutation_test(design, data_2d, [[1, 0]],
+                                                 n_permutations=99,
+                                                 batch_size=25, block_size=7)
+    assert t_stat.shape == p_value.shape == (1, 30)
+    assert max_null.shape == (99, 1)
+    assert p_value[0, 0] == 0.01
+    assert np.all(p_value[0, 1:] > 0.01) and np.all(p_value <= 1)
+
+    # The observed statistics match the parametric t-test
+    betas = npl.pinv(design).dot(data_2d)
+    assert np.allclose(t_stat[0], ttest(design, betas, data_2d.T)[0][0])
+
+    # Each permuted maximum matches refitting the permuted residuals of the
+    # model without the first regressor, with its fitted values added back
+    random = np.random.RandomState([0, 0])
+    order = random.permutation(40)
+    fitted = np.tile(data_2d.mean(0), (40, 1))
+    permuted_data = (data_2d - fitted)[order] + fitted
+    permuted = ttest(design, npl.pinv(design).dot(permuted_data),
+                     permuted_data.T)[0][0]
+    assert np.isclose(max_null[0, 0], abs(permuted).max())
+    assert np.array_equal(fwe_p_value(t_stat, max_null), p_value)
+
+    # 4-D data are tested one block of the voxels inside the mask at a time,
+    # with the same results as the masked 2-D data
+    data_4d = data_2d.T.reshape(5, 3, 2, 40)
+    mask = np.random.uniform(size=(5, 3, 2)) > 0.3
+    expected = permutation_test(design, data_4d[mask].T, [[1, 0]],
+                                n_permutations=20)
+    actual = permutation_test(design, data_4d, [[1, 0]], n_permutations=20,
+                              block_size=4, mask=mask)
+    for expected_output, actual_output in zip(expected, actual):
+        assert np.allclose(expected_output, actual_output)
+    assert_raises(AssertionError, permutation_test, design, data_2d,
+                  mask=mask)
+
+    # Results are reproducible and do not depend on the number of processes
+    for sign_flip in [False, True]:
+        results = [permutation_test(design, data_2d, n_permutations=20,
+                                    sign_flip=sign_flip, batch_size=8,
+                                    n_jobs=n_jobs) for n_jobs in [1, 2]]
+        assert results[0][2].shape == (20, 2)
+        for expected, actual in zip(*results):
+            assert np.allclose(expected, actual)
+
+def test_permutation_test_calibration():
+
+    # Under the null hypothesis, with a large baseline and a drift that is
+    # correlated with the tested regressor, the family-wise error rate of the
+    # test stays at its nominal level
+    n_volumes, n_voxels, n_datasets = 40, 10, 100
+    drift = np.linspace(-1, 1, n_volumes)
+    regressor = np.tile([1.0, 1, 1, 1, 0, 0, 0, 0], 5) + drift
+    design = np.column_stack([regressor, drift, np.ones(n_volumes)])
+    random = np.random.RandomState(0)
+    for sign_flip in [False, True]:
+        rejections = 0
+        for i in range(n_datasets):
+            data_2d = (1e4 + 50 * random.normal(size=n_voxels) +
+                       20 * np.outer(drift, random.normal(size=n_voxels)) +
+                       random.normal(size=(n_volumes, n_voxels)))
+            p_value = permutation_test(design, data_2d, [[1, 0, 0]],
+                                       n_permutations=99, seed=i,
+                                       sign_flip=sign_flip)[1]
+            rejections += p_value.min() <= 0.05
+        # The number of rejections is binomial with mean 5 and standard
+        # deviation of about 2.2
+        assert rejections <= 12
@@ -6,23 +6,37 @@ Tests can be run from the project main directory with:
 """
 from __future__ import absolute_import, division, print_function
 from nose.tools import assert_almost_equal, assert_raises
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_allclose, assert_array_equal
 import numpy as np
-import sys
+import os, shutil, sys, tempfile
 
 sys.path.append("code/utils")
 from make_class import *
+import cache_tool
 
 
+def setup_module():
+    # Redirect the cache of the fMRI data to a temporary directory
+    global cache_dir
+    cache_dir = cache_tool.cache_dir
+    cache_tool.cache_dir = tempfile.mkdtemp() + "/"
+
+def teardown_module():
+    shutil.rmtree(cache_tool.cache_dir)
+    cache_tool.cache_dir = cache_dir
+
 def test_img():
     
     # Import test data from raw and filtered data files
     assert_raises(AssertionError, img, "data/ds005/sub000/BOLD/" +
                   "task001_run000/bold.nii.gz")
     image = img("data/ds005/subtest/BOLD/task001_run001/bold.nii.gz")
+    assert image._data is None
     data, affine, voxels_per_mm = image.data, image.affine, image.voxels_per_mm
 
     # Test attribute .data
+    assert image.data is data
+    assert image.shape == (3, 3, 3, 3)
     assert data.shape == (3, 3, 3, 3)
     assert [data.min(), data.max(), data.mean()] == [0, 11, 3]
     assert_array_equal(data[..., 2] - data[..., 1], data[..., 1] - data[..., 0])
@@ -41,6 +55,71 @@ def test_img():
     assert smooth.shape == (3, 3, 3, 3)
     assert [smooth.min(), smooth.max(), smooth.sum()] == [0, 5, 108]
 
+    # Test that smoothed data are only saved to the cache when asked for, and
+    # then read from it
+    path = cache_path(image.file_path, "_smooth_5_%s" % data.dtype.str[1:])
+    assert not os.path.isfile(path)
+    assert not isinstance(smooth, np.memmap) and smooth.flags.writeable
+    assert_array_equal(image.smooth(cache=True), smooth)
+    assert os.path.isfile(path)
+    os.utime(path, (0, 0))
+    smooth_again = image.smooth(cache=True)
+    assert isinstance(smooth_again, np.memmap)
+    assert_array_equal(smooth_again, smooth)
+    assert os.path.getmtime(path) == 0
+    mask = np.zeros((3, 3, 3), dtype=bool)
+    mask[1, 1, 1] = True
+    assert_array_equal(image.smooth(mask=mask, cache=True)[mask], smooth[mask])
+    assert os.path.getmtime(path) == 0
+
+    # Test method .brain_mask(), which should agree with a threshold on the
+    # mean of the smoothed data
+    assert_raises(AssertionError, image.brain_mask, "five")
+    mask = image.brain_mask(percentile=50)
+    assert mask.shape == (3, 3, 3) and mask.dtype == bool
+    voxel_means = np.mean(image.smooth(5.0), axis=3)
+    assert_array_equal(mask, voxel_means > np.percentile(voxel_means, 50))
+    assert image.brain_mask(percentile=50) is mask
+    assert os.path.isfile(cache_path(image.file_path, "_mask_5_50"))
+    reloaded = img("data/ds005/subtest/BOLD/task001_run001/bold.nii.gz")
+    assert_array_equal(reloaded.brain_mask(percentile=50), mask)
+
+    # Test methods .mask_data() and .unmask()
+    masked = image.mask_data(mask=mask)
+    assert masked.shape == (mask.sum(), 3) and masked.flags.c_contiguous
+    assert_array_equal(masked, data[mask])
+    assert_array_equal(image.unmask(masked, mask)[mask], data[mask])
+    assert_array_equal(image.unmask(masked, mask)[~mask], 0)
+    assert np.isnan(image.unmask(masked, mask, np.nan)[~mask]).all()
+    assert image.unmask(masked[:, 0], mask).shape == (3, 3, 3)
+    assert image.mask_data().shape[0] == image.brain_mask().sum()
+
+    # Test method .release()
+    image.release()
+    assert image._data is None
+    assert_array_equal(image.data, data)
+
+    # Test that cached and uncached images hold the same data
+    uncached = img("data/ds005/subtest/BOLD/task001_run001/bold.nii.gz", False)
+    assert isinstance(image.data, np.memmap)
+    assert not isinstance(uncached.data, np.memmap)
+    assert_array_equal(uncached.data, data)
+    assert_array_equal(uncached.smooth(cache=True), smooth)
+
+    # Test numerical parity of single- and double-precision data
+    image_32 = img("data/ds005/subtest/BOLD/task001_run001/bold.nii.gz",
+                   dtype=np.float32)
+    image_64 = img("data/ds005/subtest/BOLD/task001_run001/bold.nii.gz",
+                   dtype="float64")
+    assert image_32.data.dtype == np.float32
+    assert image_64.data.dtype == np.float64
+    assert_array_equal(image_32.data, data)
+    smooth_32, smooth_64 = image_32.smooth(), image_64.smooth()
+    assert smooth_32.dtype == np.float32
+    assert_allclose(smooth_32, smooth_64, rtol=1e-5, atol=1e-5)
+    assert image_64.smooth(dtype=np.float32, n_threads=2).dtype == np.float32
+    assert_allclose(image_64.smooth(dtype=np.float32), smooth_64, atol=1e-5)
+
 
 def test_ds005():
     
@@ -52,6 +131,7 @@ def test_ds005():
     # Save test data and expected results to global environment
     ds005_1 = ds005("test", "001")
     ds005_2 = ds005("test", "001", rm_nonresp=False)
+    assert [ds005_1._raw, ds005_1._filtered] == [None, None]
 
     # Test consistency of .raw attributes and methods
     assert_array_equal(ds005_1.raw.data, ds005_2.raw.data)
@@ -78,6 +158,16 @@ def test_ds005():
     assert_array_equal(ds005_1.filtered.voxels_per_mm, voxels_per_mm)
     assert_array_equal(ds005_1.filtered.smooth(), smooth)
 
+    # Test method .release()
+    ds005_1.release()
+    assert [ds005_1._raw, ds005_1._filtered] == [None, None]
+    assert_array_equal(ds005_1.filtered.data, data)
+    assert ds005_1._raw is None
+
+    # Test the data type of the fMRI data
+    ds005_3 = ds005("test", "001", dtype=np.float32)
+    assert ds005_3.raw.data.dtype == ds005_3.filtered.data.dtype == np.float32
+
     # Test .behav attribute
     assert [ds005_1.behav.shape, ds005_2.behav.shape] == [(2, 7), (3, 7)]
     assert_array_equal(ds005_1.behav[:, 0], np.array([0, 4]))
@@ -118,4 +208,68 @@ def test_ds005():
     convolution = ds005_1.convolution("loss")
     assert_array_equal(convolution, ds005_2.convolution("loss"))
     assert_array_equal(convolution, np.array([0, 0, 0]))
-    
\ No newline at end of file
+
+    convolutions = ds005_1.convolution(["gain", "loss"], 0.01)
+    assert convolutions.shape == (2, 600)
+    assert_allclose(convolutions[0], ds005_1.convolution("gain", 0.01))
+    assert_allclose(convolutions[1], 0, atol=1e-12)
+
+    # Test method .regressor() against .convolution() on a fine time grid
+    assert_raises(AssertionError, ds005_1.regressor, "GAIN")
+    assert_array_equal(ds005_1.regressor("loss"), np.zeros(3))
+    for step_size in [0.01, 0.1]:
+        convolution = ds005_1.convolution("gain", step_size)
+        expected = convolution[::int(round(2 / step_size))]
+        assert_allclose(ds005_1.regressor("gain", step_size), expected,
+                        atol=1e-3 / step_size)
+    exact = ds005_1.regressor("gain")
+    assert_allclose(exact, ds005_1.regressor("gain", 0.001) * 0.001, atol=1e-3)
+    assert exact[0] == 0 and exact[2] < exact[1] < 0
+    
+
+def test_ds005_cache():
+
+    # Test hits and misses
+    cache = ds005_cache()
+    obj = cache.get("test", "001")
+    assert cache.get("test", "001") is obj
+    assert cache.get("test", "001", rm_nonresp=False) is not obj
+    stats = cache.stats()
+    assert [stats["hits"], stats["misses"], stats["runs"]] == [1, 2, 2]
+
+    # Test that data held in memory count toward the bytes held, unlike data
+    # memory-mapped from the cache
+    nbytes = cache.nbytes
+    obj.filtered.data
+    assert cache.nbytes == nbytes
+    obj_32 = cache.get("test", "001", dtype=np.float32)
+    obj_32.filtered.data
+    assert cache.nbytes == nbytes + obj_32.nbytes
+    assert obj_32.nbytes == obj.nbytes + obj_32.filtered.data.nbytes
+
+    # Test eviction of the least recently used runs once over budget
+    cache.max_bytes = obj_32.nbytes
+    assert cache.get("test", "001", dtype=np.float32) is obj_32
+    stats = cache.stats()
+    assert [stats["evictions"], stats["runs"]] == [2, 1]
+    assert stats["bytes"] == obj_32.nbytes
+    assert ("test", "001", True, np.dtype(np.float32)) in cache.runs
+    obj = obj_32
+
+    # The most recently used run is kept even if it exceeds the budget
+    cache.max_bytes = 0
+    assert cache.get("test", "001", dtype=np.float32) is obj
+    assert cache.stats()["runs"] == 1
+
+    # Test method .clear()
+    cache.clear()
+    assert cache.stats() == {"hits": 0, "misses": 0, "evictions": 0,
+                             "runs": 0, "bytes": 0}
+
+    # Test the process-wide cache
+    assert get_ds005("test", "001") is get_ds005("test", "001")
+    obj_32 = get_ds005("test", "001", dtype="float32")
+    assert obj_32 is get_ds005("test", "001", dtype=np.float32)
+    assert obj_32 is not get_ds005("test", "001")
+    assert obj_32.filtered.data.dtype == np.float32
+    run_cache.clear()
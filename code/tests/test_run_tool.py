@@ -0,0 +1,81 @@
+"""
+Tests functionality of the run_tool module
+
+Tests can be run from the project main directory with:
+    nosetests code/tests/test_run_tool.py
+"""
+from __future__ import absolute_import, division, print_function
+from nose.tools import assert_raises
+from numpy.testing import assert_array_equal
+import numpy as np
+import shutil, sys, tempfile
+
+sys.path.append("code/utils")
+from make_class import get_ds005, run_cache
+from run_tool import *
+import cache_tool, run_tool
+
+
+def setup_module():
+    # Redirect the cache of the fMRI data to a temporary directory
+    global cache_dir
+    cache_dir = cache_tool.cache_dir
+    cache_tool.cache_dir = tempfile.mkdtemp() + "/"
+
+def teardown_module():
+    shutil.rmtree(cache_tool.cache_dir)
+    cache_tool.cache_dir = cache_dir
+
+def test_run_IDs():
+
+    # The default order matches the sorted (run, subject) pairs
+    IDs = run_IDs()
+    assert len(IDs) == 48
+    assert IDs == sorted(IDs)
+    assert IDs[:2] == [("001", "001"), ("001", "002")]
+
+    # Runs of a subject can also be kept together
+    IDs = run_IDs(subjects=[1, 2], order="subject")
+    assert IDs == [("001", "001"), ("002", "001"), ("003", "001"),
+                   ("001", "002"), ("002", "002"), ("003", "002")]
+    assert_raises(AssertionError, run_IDs, order="volume")
+
+def test_iter_ds005():
+
+    # Every run is yielded in order, with or without prefetching
+    IDs = [("001", "test")] * 3
+    for prefetch in [0, 1, 2]:
+        runs = list(iter_ds005(IDs, prefetch, dtype=np.float32))
+        assert [ID for ID, obj in runs] == IDs
+        for ID, obj in runs:
+            assert obj._filtered._data is not None and obj._raw is None
+            assert obj.filtered.data.dtype == np.float32
+
+    # Every page of the memory-mapped data of each image is read ahead of time.
+    # This is checked before any prefetching thread is left running
+    touched = []
+    touch, run_tool._touch = run_tool._touch, touched.append
+    try:
+        next(iter_ds005(IDs, prefetch=0, images=("raw", "filtered")))
+    finally:
+        run_tool._touch = touch
+    assert len(touched) == 2
+    assert all(isinstance(data, np.memmap) for data in touched)
+    for data in touched + [np.zeros(3), np.zeros(0)]:
+        run_tool._touch(data)
+
+    # Data of the requested images are loaded ahead of time
+    ID, obj = next(iter_ds005(IDs, images=("raw", "filtered")))
+    assert_array_equal(obj._raw._data, obj._filtered._data)
+
+    # Errors raised while loading are passed on to the caller
+    runs = iter_ds005([("001", "test"), ("001", "000")])
+    assert next(runs)[0] == ("001", "test")
+    assert_raises(IOError, next, runs)
+    assert_raises(AssertionError, list, iter_ds005(IDs, images=("smooth",)))
+
+    # Cached runs are reused by later passes and by get_ds005()
+    runs = list(iter_ds005(IDs, cache=True))
+    assert all(obj is runs[0][1] for ID, obj in runs)
+    assert get_ds005("test", "001") is runs[0][1]
+    run_cache.clear()
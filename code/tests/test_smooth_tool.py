@@ -0,0 +1,61 @@
+"""
+Tests functionality of the smooth_tool module
+
+Tests can be run from the project main directory with:
+    nosetests code/tests/test_smooth_tool.py
+"""
+from __future__ import absolute_import, division, print_function
+from nose.tools import assert_raises
+from numpy.testing import assert_allclose, assert_array_equal
+from scipy.ndimage.filters import gaussian_filter
+import numpy as np
+import sys
+
+sys.path.append("code/utils")
+from smooth_tool import *
+
+
+def test_mask_bounds():
+
+    # The bounding box is padded by the kernel radius, but stays in the array
+    mask = np.zeros((10, 10, 10), dtype=bool)
+    mask[4:6, 1, 8] = True
+    bounds = mask_bounds(mask, np.array([0.5, 1, 0]))
+    assert bounds == (slice(2, 8), slice(0, 6), slice(8, 9))
+    assert mask_bounds(np.zeros((2, 2, 2), bool), [1, 1, 1])[0] == slice(0, 0)
+
+def test_smooth_4d():
+
+    # Results match those of a single call to gaussian_filter()
+    np.random.seed(0)
+    data = np.random.normal(size=(9, 10, 11, 13))
+    sigma = np.array([1.5, 1, 0.5, 0])
+    expected = gaussian_filter(data, sigma)
+    for n_threads, chunk_size in [(1, 8), (3, 1), (2, 20)]:
+        smooth = smooth_4d(data, sigma, n_threads=n_threads,
+                           chunk_size=chunk_size)
+        assert_array_equal(smooth, expected)
+    assert_array_equal(smooth_4d(data, sigma[:3]), expected)
+    assert_array_equal(smooth_4d(data, np.zeros(4)), data)
+
+    # Integer data are smoothed to integers, as by gaussian_filter()
+    int_data = (data * 10).astype(int)
+    assert_array_equal(smooth_4d(int_data, sigma), gaussian_filter(int_data,
+                                                                  sigma))
+
+    # Single-precision output
+    smooth_32 = smooth_4d(data, sigma, dtype=np.float32, n_threads=2)
+    assert smooth_32.dtype == np.float32
+    assert_allclose(smooth_32, expected, rtol=1e-5, atol=1e-6)
+
+    # Restricting work to a mask leaves the voxels in the mask unchanged
+    mask = np.zeros(data.shape[:3], dtype=bool)
+    mask[3:6, 4:8, 5] = True
+    masked = smooth_4d(data, sigma, mask=mask)
+    assert_array_equal(masked[mask], expected[mask])
+    assert (masked[:, :, :3] == 0).all() and (masked[:, :, 8:] == 0).all()
+
+    # Invalid inputs
+    assert_raises(AssertionError, smooth_4d, data, [1, 1, 1, 1])
+    assert_raises(AssertionError, smooth_4d, data[0], sigma)
+    assert_raises(AssertionError, smooth_4d, data, sigma, mask=mask[0])
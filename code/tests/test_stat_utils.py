@@ -6,13 +6,25 @@ Tests can be run from the project main directory with:
 """
 from __future__ import absolute_import, division, print_function
 from nose.tools import assert_almost_equal, assert_raises
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_allclose, assert_array_equal
 import numpy as np
-import sys
+import numpy.linalg as npl
+import shutil, sys, tempfile
 
 sys.path.append("code/utils")
 from stat_utils import *
 from make_class import *
+import cache_tool
+
+def setup_module():
+    # Redirect the cache of the fMRI data to a temporary directory
+    global cache_dir
+    cache_dir = cache_tool.cache_dir
+    cache_tool.cache_dir = tempfile.mkdtemp() + "/"
+
+def teardown_module():
+    shutil.rmtree(cache_tool.cache_dir)
+    cache_tool.cache_dir = cache_dir
 
 def test_correlation():
 
@@ -28,6 +40,34 @@ def test_correlation():
     expected = np.ones((3, 3, 3))
     assert_array_equal(corr, expected)
 
+def test_correlation_map():
+
+    # Compare with np.corrcoef() on random data, for several regressors and
+    # with a mask
+    obj = ds005("test", "001")
+    time_course = obj.time_course("gain")
+    assert_raises(AssertionError, correlation_map, obj.raw.data[0],
+                  time_course)
+    assert_raises(AssertionError, correlation_map, obj.raw.data,
+                  time_course[1:])
+    np.random.seed(9)
+    data = np.random.normal(size=obj.filtered.data.shape)
+    mask = np.random.uniform(size=(3, 3, 3)) > 0.3
+    time_courses = obj.time_course(["gain", "dist2indiff"]).T
+    corr = correlation_map(data, time_courses, mask, 4)
+    assert corr.shape == (3, 3, 3, 2)
+    assert np.all(np.isnan(corr[~mask]))
+    for index in zip(*np.nonzero(mask)):
+        assert_almost_equal(corr[index][0],
+                            np.corrcoef(data[index], time_course)[0, 1])
+    assert_array_equal(corr[..., 0][mask],
+                       correlation_map(data, time_course)[mask])
+
+    # Lists of regressor names are correlated at once through correlation()
+    corr = correlation(obj, "raw", ["gain", "dist2indiff"], mask)
+    assert_array_equal(corr, correlation_map(obj.raw.data, time_courses,
+                                             mask))
+
 def test_glm_util():
 
     # Define an instance of class ds005
@@ -44,4 +84,350 @@ def test_glm_util():
     assert_almost_equal(regression_coefficients[0], 0.5)
     assert df == 1
     assert MRSS == 0.5
-    
\ No newline at end of file
+    
+def test_glm_util_dtype():
+
+    # Fit the same model to single- and double-precision responses
+    np.random.seed(0)
+    design_matrix = np.ones((50, 3))
+    design_matrix[:, 1] = np.linspace(-1, 1, 50)
+    design_matrix[:, 2] = np.random.normal(size=50)
+    response = np.random.normal(size=(50, 20)) + 100
+    coef_64, df_64, MRSS_64 = glm_util(design_matrix, response)
+    coef_32, df_32, MRSS_32 = glm_util(design_matrix,
+                                       response.astype(np.float32),
+                                       dtype=np.float32)
+
+    # Models are fitted in double precision unless single precision is asked
+    # for, whatever the data type of the response
+    assert [coef_32.dtype, MRSS_32.dtype] == [np.float32, np.float32]
+    for data_type in [np.float32, np.int16]:
+        outputs = glm_util(design_matrix, response.astype(data_type))
+        assert [outputs[0].dtype, outputs[2].dtype] == [np.float64] * 2
+    assert_raises(AssertionError, glm_util, design_matrix, response,
+                  dtype=np.float16)
+    assert df_32 == df_64 == 47
+    assert_allclose(coef_32, coef_64, rtol=1e-4, atol=1e-4)
+    assert_allclose(MRSS_32, MRSS_64, rtol=1e-3)
+
+def test_glm_model():
+
+    # Fit many voxels with several regressors
+    np.random.seed(0)
+    design_matrix = np.ones((40, 4))
+    design_matrix[:, 1:] = np.random.normal(size=(40, 3))
+    response = np.random.normal(size=(40, 25))
+    model = glm_model(design_matrix)
+    assert [model.rank, model.df] == [4, 36]
+    assert_allclose(model.pinv, npl.pinv(design_matrix), atol=1e-12)
+    assert_allclose(model.cov_diag, np.diag(npl.inv(design_matrix.T.dot(
+                                                            design_matrix))))
+
+    # Results do not depend on the size of the blocks
+    beta, RSS, MRSS = model.fit(response)
+    for block_size in [1, 7]:
+        for expected, actual in zip([beta, RSS, MRSS],
+                                    model.fit(response, block_size)):
+            assert_allclose(actual, expected)
+    assert_allclose(MRSS, RSS / 36)
+
+    # Compare with the textbook formulas, one voxel at a time
+    XtX_inv = npl.inv(design_matrix.T.dot(design_matrix))
+    t_stat, p_value = model.ttest(beta, MRSS)
+    assert t_stat.shape == p_value.shape == (4, 25)
+    for voxel in range(25):
+        coef = npl.lstsq(design_matrix, response[:, voxel], rcond=None)[0]
+        resid = response[:, voxel] - design_matrix.dot(coef)
+        var = resid.dot(resid) / 36 * XtX_inv
+        assert_allclose(beta[:, voxel], coef)
+        assert_allclose(t_stat[:, voxel], coef / np.sqrt(np.diag(var)))
+    assert np.all((p_value >= 0) & (p_value <= 1))
+
+    # Rank-deficient designs lose degrees of freedom
+    model = glm_model(np.column_stack([design_matrix, design_matrix[:, 1]]))
+    assert [model.rank, model.df] == [4, 36]
+    assert_allclose(model.fit(response)[2], MRSS)
+
+def test_glm_model_fit_volume():
+
+    # Fit a small volume, inside and outside of a mask
+    np.random.seed(2)
+    design_matrix = np.ones((30, 3))
+    design_matrix[:, 1:] = np.random.normal(size=(30, 2))
+    data = np.random.normal(size=(4, 3, 2, 30))
+    mask = np.random.uniform(size=(4, 3, 2)) > 0.5
+    model = glm_model(design_matrix)
+    beta, MRSS = model.fit(data.reshape(-1, 30).T)[::2]
+    t_stat, p_value = model.ttest(beta, MRSS)
+    for block_size in [1, 5, 100]:
+        maps = model.fit_volume(data, mask, block_size, fill=np.nan)
+        assert [m.shape for m in maps] == [(4, 3, 2, 3), (4, 3, 2),
+                                           (4, 3, 2, 3), (4, 3, 2, 3)]
+        for actual, expected in zip(maps, [beta.T, MRSS, t_stat.T, p_value.T]):
+            assert_allclose(actual[mask], expected[mask.ravel()])
+            assert np.all(np.isnan(actual[~mask]))
+
+    # The blocks of voxels that are fitted cover the mask in order
+    blocks = list(voxel_blocks(data, mask, 5))
+    assert all(response.shape == (30, len(block)) for block, response in blocks)
+    assert_array_equal(np.concatenate([block for block, _ in blocks]),
+                       np.flatnonzero(mask))
+    assert_array_equal(np.column_stack([response for _, response in blocks]),
+                       data[mask].T)
+
+    # Without a mask, every voxel is fitted
+    assert_allclose(model.fit_volume(data)[1], MRSS.reshape(4, 3, 2))
+    assert_raises(AssertionError, model.fit_volume, data[..., 1:])
+    assert_raises(AssertionError, model.fit_volume, data, mask[:2])
+
+def test_glm_model_contrasts():
+
+    # Fit many voxels with several regressors
+    np.random.seed(3)
+    design_matrix = np.ones((50, 4))
+    design_matrix[:, 1:] = np.random.normal(size=(50, 3))
+    response = np.random.normal(size=(50, 10)) + design_matrix[:, [1]]
+    model = glm_model(design_matrix)
+    beta, RSS, MRSS = model.fit(response)
+
+    # Contrasts that pick single coefficients reproduce the t-tests
+    t_stat, p_value = model.ttest(beta, MRSS)
+    effect, t_contrast, p_contrast = model.t_contrast(np.eye(4), beta, MRSS)
+    assert_allclose(effect, beta)
+    assert_allclose(t_contrast, t_stat)
+    assert_allclose(p_contrast, p_value)
+    assert_raises(AssertionError, model.t_contrast, [1, 0], beta, MRSS)
+
+    # A difference of coefficients equals the t-test of the reparametrized model
+    effect, t_diff, p_diff = model.t_contrast([0, 1, -1, 0], beta, MRSS)
+    assert effect.shape == t_diff.shape == p_diff.shape == (10,)
+    reparam = design_matrix.copy()
+    reparam[:, 2] += reparam[:, 1]
+    beta_reparam, RSS_reparam, MRSS_reparam = glm_model(reparam).fit(response)
+    assert_allclose(effect, beta_reparam[1])
+    assert_allclose(t_diff, glm_model(reparam).ttest(beta_reparam,
+                                                     MRSS_reparam)[0][1])
+
+    # The F-test of a single contrast is the square of its t-test
+    effect, F_stat, p_F = model.f_contrast([[0, 1, -1, 0]], beta, MRSS)
+    assert effect.shape == (1, 10) and F_stat.shape == (10,)
+    assert_allclose(F_stat, t_diff ** 2)
+    assert_allclose(p_F, p_diff)
+
+    # The F-test of several coefficients compares nested models
+    effect, F_stat, p_F = model.f_contrast([[0, 0, 1, 0], [0, 0, 0, 1]], beta,
+                                           MRSS)
+    RSS_reduced = glm_model(design_matrix[:, :2]).fit(response)[1]
+    assert_allclose(F_stat, (RSS_reduced - RSS) / 2 / MRSS)
+    assert np.all((p_F >= 0) & (p_F <= 1))
+
+    # Redundant rows do not count toward the numerator degrees of freedom
+    F_redundant = model.f_contrast([[0, 0, 1, 0], [0, 0, 0, 1],
+                                    [0, 0, 1, 1]], beta, MRSS)[1]
+    assert_allclose(F_redundant, F_stat)
+
+def test_online_glm():
+
+    # Stream the volumes of a small run, one at a time
+    np.random.seed(5)
+    design_matrix = np.ones((60, 4))
+    design_matrix[:, 1:] = np.random.normal(size=(60, 3))
+    data = np.random.normal(size=(60, 3, 2, 2)) + 100
+    response = data.reshape(60, -1)
+    model = online_glm(4)
+    assert_raises(AssertionError, model.results)
+    assert_raises(AssertionError, model.update, np.ones(3), data[0])
+    for volume in range(60):
+        model.update(design_matrix[volume], data[volume])
+        if volume == 3:
+            # Four volumes determine the coefficients but leave no residual
+            assert model.df == 0
+            assert_raises(AssertionError, model.results)
+            assert_raises(AssertionError, model.ttest)
+        if volume == 9:
+            beta_10, df_10, MRSS_10 = glm_util(design_matrix[:10],
+                                               response[:10])
+            assert_allclose(model.results()[0], beta_10)
+            assert_allclose(model.results()[2], MRSS_10)
+
+    # The results match those of fitting the whole run at once
+    beta, df, MRSS = glm_util(design_matrix, response)
+    online_beta, online_df, online_MRSS = model.results()
+    assert online_df == df == 56
+    assert_allclose(online_beta, beta)
+    assert_allclose(online_MRSS, MRSS)
+    t_stat, p_value = glm_model(design_matrix).ttest(beta, MRSS)
+    online_t, online_p = model.ttest()
+    assert_allclose(online_t, t_stat)
+    assert_allclose(online_p, p_value, atol=1e-12)
+
+    # Rank-deficient designs fall back to the minimum-norm solution
+    deficient = np.column_stack([design_matrix, design_matrix[:, 1]])
+    model = online_glm(5)
+    for volume in range(60):
+        model.update(deficient[volume], response[volume])
+    beta, df, MRSS = glm_util(deficient, response)
+    assert model.df == df == 56
+    assert_allclose(model.results()[0], beta, atol=1e-10)
+    assert_allclose(model.results()[2], MRSS)
+
+def test_glm_model_fit_ar1():
+
+    # Simulate voxels with different amounts of AR(1) noise
+    np.random.seed(6)
+    design_matrix = np.ones((200, 3))
+    design_matrix[:, 1] = np.sin(np.arange(200) / 5)
+    design_matrix[:, 2] = np.linspace(-1, 1, 200)
+    true_rho = np.repeat([0, 0.3, 0.6], 20)
+    noise = np.random.normal(size=(200, 60))
+    for time in range(1, 200):
+        noise[time] += true_rho * noise[time - 1]
+    response = design_matrix.dot(np.ones((3, 60))) + noise
+    model = glm_model(design_matrix)
+    beta, MRSS, t_stat, p_value, rho = model.fit_ar1(response, 0.05)
+    assert beta.shape == t_stat.shape == p_value.shape == (3, 60)
+    assert MRSS.shape == rho.shape == (60,)
+
+    # Ordinary least squares coefficients can be reused rather than refitted
+    reused = model.fit_ar1(response, 0.05,
+                           regression_coefficients=model.fit(response)[0])
+    for actual, expected in zip(reused, [beta, MRSS, t_stat, p_value, rho]):
+        assert_allclose(actual, expected)
+
+    # Estimates are binned and close to the truth
+    assert_allclose(rho / 0.05, np.round(rho / 0.05))
+    assert np.all(abs(rho - true_rho) < 0.25)
+    assert np.mean(rho[40:]) > np.mean(rho[:20]) + 0.3
+
+    # Each voxel matches an explicit GLS fit with its own coefficient
+    for voxel in [0, 25, 59]:
+        r = rho[voxel]
+        W = np.eye(200) - r * np.eye(200, k=-1)
+        W[0, 0] = np.sqrt(1 - r ** 2)
+        whitened = glm_model(W.dot(design_matrix))
+        coef, RSS_w, MRSS_w = whitened.fit(W.dot(response[:, voxel]))
+        assert_allclose(beta[:, voxel], coef)
+        assert_allclose(MRSS[voxel], MRSS_w)
+        assert_allclose(t_stat[:, voxel], whitened.ttest(coef, MRSS_w)[0])
+
+    # Residuals that are nearly a unit root are kept in the last bin below 1,
+    # where the whitened design is still of full rank
+    slow = (np.cos(np.arange(200) / 20)[:, np.newaxis] +
+            0.01 * np.random.normal(size=(200, 2)))
+    near_unit = model.fit_ar1(slow, 0.02)
+    assert_allclose(near_unit[4], 0.98)
+    assert all(np.isfinite(output).all() for output in near_unit)
+
+    # Without autocorrelation, the fit reduces to ordinary least squares
+    white = model.fit_ar1(response[:, :1], 10)
+    assert white[4][0] == 0
+    assert_allclose(white[2], model.ttest(*model.fit(response[:, :1])[::2])[0])
+
+def test_glm_runs():
+
+    # Simulate three runs that share their column layout
+    np.random.seed(7)
+    designs = np.ones((3, 40, 4))
+    designs[:, :, 1:] = np.random.normal(size=(3, 40, 3))
+    designs[2, :, 3] = designs[2, :, 2]
+    responses = np.random.normal(size=(3, 40, 12))
+    runs = glm_runs(designs)
+    assert list(runs.rank) == [4, 4, 3] and list(runs.df) == [36, 36, 37]
+
+    # Stacked, listed, and pooled fits match fitting each run on its own
+    stacked = runs.fit(responses, block_size=5)
+    listed = runs.fit(list(responses))
+    pooled = runs.fit([response[:, :7] for response in responses], n_jobs=2)
+    t_stacked, p_stacked = runs.ttest(stacked[0], stacked[2])
+    t_listed, p_listed = runs.ttest(listed[0], listed[2])
+    assert t_stacked.shape == (3, 4, 12) and len(t_listed) == 3
+    for run in range(3):
+        model = glm_model(designs[run])
+        beta, RSS, MRSS = model.fit(responses[run])
+        t_stat, p_value = model.ttest(beta, MRSS)
+        for outputs in [stacked, listed]:
+            assert_allclose(outputs[0][run], beta, atol=1e-12)
+            assert_allclose(outputs[2][run], MRSS)
+        assert_allclose(pooled[0][run], beta[:, :7], atol=1e-12)
+        assert_allclose(t_stacked[run], t_stat)
+        assert_allclose(p_listed[run], p_value)
+
+def test_fixed_effects():
+
+    # Two runs of different lengths share two of their three regressors
+    np.random.seed(8)
+    designs = [np.ones((30, 3)), np.ones((20, 3))]
+    for design in designs:
+        design[:, 1:] = np.random.normal(size=(design.shape[0], 2))
+    X = fixed_effects_design(designs, [1, 2])
+    assert X.shape == (50, 4)
+    assert_array_equal(X[:30, 2:], np.column_stack([np.ones(30), np.zeros(30)]))
+    assert_array_equal(X[30:, 2:], np.column_stack([np.zeros(20), np.ones(20)]))
+    assert_array_equal(X[30:, :2], designs[1][:, 1:])
+    assert_raises(AssertionError, fixed_effects_design,
+                  [designs[0], designs[1][:, :2]], [1])
+
+    # The fit matches the concatenated model
+    responses = [np.random.normal(size=(30, 6)), np.random.normal(size=(20, 6))]
+    model, beta, MRSS = fixed_effects(designs, responses, [1, 2])
+    expected = glm_util(X, np.concatenate(responses))
+    assert model.df == 46
+    assert_allclose(beta, expected[0])
+    assert_allclose(MRSS, expected[2])
+
+def test_glm_model_censored():
+
+    # Censoring volumes matches dropping them from the design and appending a
+    # spike regressor for each of them
+    np.random.seed(9)
+    design_matrix = np.ones((40, 3))
+    design_matrix[:, 1:] = np.random.normal(size=(40, 2))
+    response = np.random.normal(size=(40, 10))
+    censor = [3, 17, 17, 39]
+    kept = np.setdiff1d(np.arange(40), censor)
+    model = glm_model(design_matrix)
+    censored = model.censored(censor)
+    assert censored.kept.sum() == 37 and model.kept.all()
+    assert censored.rank == 3 and censored.df == 34
+    beta, RSS, MRSS = censored.fit(response)
+    dropped = glm_model(design_matrix[kept])
+    expected = dropped.fit(response[kept])
+    assert_allclose(beta, expected[0])
+    assert_allclose(RSS, expected[1])
+    assert_allclose(MRSS, expected[2])
+    assert_allclose(censored.cov, dropped.cov)
+    spikes = spike_regressors(censor, 40)
+    assert spikes.shape == (40, 3) and list(spikes.sum(0)) == [1, 1, 1]
+    spiked = glm_util(np.column_stack([design_matrix, spikes]), response)
+    assert_allclose(beta, spiked[0][:3])
+    assert spiked[1] == censored.df
+    assert_allclose(MRSS, spiked[2])
+    assert_allclose(censored.ttest(beta, MRSS)[0],
+                    dropped.ttest(*expected[::2])[0])
+
+    # Censoring in steps gives the same model as censoring at once
+    twice = model.censored([3]).censored([17, 39])
+    assert_allclose(twice.pinv, censored.pinv, atol=1e-12)
+    assert twice.df == censored.df
+
+    # A censored model can lose rank, in which case it is refactorized
+    spiked_design = design_matrix.copy()
+    spiked_design[:, 2] = 0
+    spiked_design[5, 2] = 1
+    deficient = glm_model(spiked_design).censored([5])
+    assert deficient.rank == 2 and deficient.df == 37
+    assert_allclose(deficient.fit(response)[0],
+                    npl.pinv(np.delete(spiked_design, 5, 0)).dot(
+                        np.delete(response, 5, 0)), atol=1e-12)
+    assert_raises(AssertionError, censored.fit_ar1, response)
+
+    # Fitting several models in one pass matches fitting each on its own, and
+    # glm_util() accepts the censored volumes directly
+    fits = fit_models([model, censored], response, block_size=3)
+    for fitted, expected in zip(fits, [model.fit(response), (beta, RSS, MRSS)]):
+        for actual, value in zip(fitted, expected):
+            assert_allclose(actual, value)
+    assert_raises(AssertionError, fit_models, [model, deficient], response)
+    util = glm_util(np.column_stack([np.ones(40), design_matrix[:, 1]]),
+                    response, censor)
+    assert util[1] == 35
@@ -0,0 +1,191 @@
+"""
+This script contains tools that keep uncompressed copies of the ds005 images on
+disk, so that the BOLD data can be memory-mapped instead of being decompressed
+every time they are loaded. Each copy is named after the MD5 hash of the file it
+was made from, so that it is invalidated as soon as that file changes. Hashes
+are recorded in an index next to the copies, along with the size and the
+modification time of each file, so that a file is only hashed again once it has
+changed. Future Python scripts can take advantage of these tools by including
+the command
+    sys.path.append("code/utils")
+    from cache_tool import *
+Running this script from the main project directory converts every image of the
+dataset at once:
+    python code/utils/cache_tool.py
+"""
+from __future__ import absolute_import, division, print_function
+import json
+import nibabel as nib
+import numpy as np
+import os, sys, tempfile, threading
+
+sys.path.append(".")
+from data.data import generate_file_md5
+
+
+# Directory to which the uncompressed copies are saved
+cache_dir = "data/cache/"
+
+# Hash dictionary of the complete data set, which lists the images to convert
+path_hashes = "data/ds005_hashes.json"
+
+# Index of the hashed files of each cache directory, loaded on first use. The
+# lock keeps threads of the same process (such as the one that prefetches runs
+# in run_tool.iter_ds005()) from changing an index while it is being saved
+_indices = {}
+_index_lock = threading.Lock()
+
+
+def _load_index():
+    """
+    Returns the index of the current cache directory, which maps the path of
+    each hashed file to its size, its modification time, and its MD5 hash.
+    """
+    if cache_dir not in _indices:
+        index = {}
+        if os.path.isfile(cache_dir + "index.json"):
+            with open(cache_dir + "index.json", "r") as infile:
+                index = json.load(infile)
+        _indices[cache_dir] = index
+    return _indices[cache_dir]
+
+def file_hash(file_path):
+    """
+    Returns the MD5 hash of a file from the data set. The hash is computed once
+    and recorded in the index of the cache directory, from which it is reused
+    for as long as the size and the modification time of the file are unchanged.
+
+    Parameters
+    ----------
+    file_path : str
+        Path leading from the main project directory to the file of interest
+
+    Return
+    ------
+    md5 : str
+        Hexadecimal digest of the MD5 hash of the file
+    """
+    stat = os.stat(file_path)
+    signature = [stat.st_size, stat.st_mtime]
+    with _index_lock:
+        entry = _load_index().get(file_path)
+    if entry is not None and entry[:2] == signature:
+        return entry[2]
+    # The file is hashed outside of the lock, which other threads only need
+    # for as long as it takes to update and save the index
+    entry = signature + [generate_file_md5(file_path)]
+    with _index_lock:
+        index = _load_index()
+        index[file_path] = entry
+        _save_json(cache_dir + "index.json", index)
+    return entry[2]
+
+def cache_path(file_path, suffix=""):
+    """
+    Returns the path of the cache file that belongs to a file from the data set.
+
+    Parameters
+    ----------
+    file_path : str
+        Path leading from the main project directory to the source file
+    suffix : str, optional
+        Tag that distinguishes different arrays computed from the same file
+
+    Return
+    ------
+    path : str
+        Path leading from the main project directory to the .npy cache file
+    """
+    return cache_dir + file_hash(file_path) + suffix + ".npy"
+
+def _make_cache_dir(path):
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(path)):
+            raise # pragma: no cover
+
+def _temp_file(path, mode):
+    """
+    Opens a new temporary file in the directory of path, with a name that no
+    other process or thread can be given, and returns it with its path.
+    """
+    _make_cache_dir(path)
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(".tmp", name + ".", directory)
+    return os.fdopen(fd, mode), temp_path
+
+def _save_json(path, obj):
+    """
+    Saves an object to a JSON file, renaming a temporary file as save_cache()
+    does.
+    """
+    outfile, temp_path = _temp_file(path, "w")
+    with outfile:
+        json.dump(obj, outfile)
+    os.rename(temp_path, path)
+
+def save_cache(path, arr):
+    """
+    Saves an array to a cache file. The array is first written to a temporary
+    file of its own and then renamed, so that other processes and threads never
+    read a partial file or write to the same one.
+
+    Parameters
+    ----------
+    path : str
+        Path returned by cache_path()
+    arr : np.ndarray
+        Array to be saved
+    """
+    outfile, temp_path = _temp_file(path, "wb")
+    with outfile:
+        np.save(outfile, arr)
+    os.rename(temp_path, path)
+
+def cache_image(file_path):
+    """
+    Writes an uncompressed copy of the data of an image to the cache directory,
+    unless an up-to-date copy already exists.
+
+    Parameters
+    ----------
+    file_path : str
+        Path leading from the main project directory to a .nii or .nii.gz file
+
+    Return
+    ------
+    path : str
+        Path leading from the main project directory to the .npy cache file
+    """
+    path = cache_path(file_path)
+    if not os.path.isfile(path):
+        save_cache(path, np.asanyarray(nib.load(file_path).dataobj))
+    return path
+
+def load_image(file_path):
+    """
+    Memory-maps the uncompressed copy of the data of an image, creating the copy
+    first if necessary.
+
+    Parameters
+    ----------
+    file_path : str
+        Path leading from the main project directory to a .nii or .nii.gz file
+
+    Return
+    ------
+    data : np.memmap
+        Read-only array containing the data of the image
+    """
+    return np.load(cache_image(file_path), mmap_mode="r")
+
+
+if __name__ == "__main__":
+    with open(path_hashes, "r") as hashes: # pragma: no cover
+        paths = sorted(json.load(hashes)) # pragma: no cover
+    for path in paths: # pragma: no cover
+        if path.endswith(("bold.nii.gz", "filtered_func_data_mni.nii.gz")):
+            if os.path.isfile(path):
+                print("Caching {0}".format(path))
+                cache_image(path)
@@ -0,0 +1,282 @@
+"""
+This script contains tools that find the principal components of fMRI data
+without forming or decomposing a full covariance matrix. The top components are
+found with a randomized range finder: a few random combinations of the time
+points are refined by power iterations, each of which is a single pass over
+blocks of voxels, and only a matrix with one column per component is ever
+decomposed. It also contains the group_pca() class, which combines the
+components of many runs without holding more than one run in memory. Future
+Python scripts can take advantage of these tools by including the command
+    sys.path.append("code/utils")
+    from decomposition import *
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import numpy.linalg as npl
+
+
+def _voxel_blocks(data, mask, block_size):
+    """
+    Yields blocks of rows of the voxel-by-time matrix of 2- or 4-D data, with
+    only the voxels inside a mask, so that the masked matrix is never copied as
+    a whole.
+    """
+    voxels = data.reshape(-1, data.shape[-1])
+    if mask is None:
+        for start in range(0, voxels.shape[0], block_size):
+            yield voxels[start:(start + block_size)]
+    else:
+        indices = np.flatnonzero(mask)
+        for start in range(0, len(indices), block_size):
+            yield voxels[indices[start:(start + block_size)]]
+
+def _centered_blocks(data, mask, block_size, center, volume_mean):
+    """
+    Yields the blocks of _voxel_blocks() in double precision, centered as
+    described in randomized_pca().
+    """
+    for block in _voxel_blocks(data, mask, block_size):
+        block = block.astype(float)
+        if center is not None:
+            block -= volume_mean
+        if center == "both":
+            block -= block.mean(1)[:, np.newaxis]
+        yield block
+
+def randomized_pca(data, n_components=5, mask=None, center="both",
+                   n_oversamples=10, n_iter=2, block_size=4096, seed=0):
+    """
+    Finds the top principal components of fMRI data, treating voxels as
+    observations and time points as variables, as sklearn.decomposition.PCA
+    would with the voxel-by-time matrix. The data are read in blocks of voxels,
+    in 3 + n_iter passes.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Array of shape (..., T), such as 4-D fMRI data or a 2-D voxel-by-time
+        matrix. Memory-mapped data are only read one block at a time
+    n_components : int, optional
+        Number of components to return
+    mask : np.ndarray, optional
+        Boolean array of shape data.shape[:-1] selecting the voxels to analyze,
+        such as a brain mask. Defaults to all voxels
+    center : str, optional
+        "volume" subtracts the mean of each volume over voxels, "both" also
+        subtracts the mean of each voxel over time afterwards, and None leaves
+        the data as they are
+    n_oversamples : int, optional
+        Number of random directions sampled in addition to n_components, which
+        make the top components more accurate
+    n_iter : int, optional
+        Number of power iterations, each of which is one pass over the data
+    block_size : int, optional
+        Number of voxels processed at a time
+    seed : int, optional
+        Seed of the random directions, for reproducible results
+
+    Return
+    ------
+    spatial_maps : np.ndarray
+        Array of shape data.shape[:-1] + (n_components,) containing the
+        projection of each voxel onto each component (0 outside of the mask)
+    time_courses : np.ndarray
+        Array of shape (T, n_components) whose orthonormal columns are the
+        principal axes
+    explained_variance : np.ndarray
+        Array of shape (n_components,) containing the variance along each
+        component
+    explained_variance_ratio : np.ndarray
+        Array of shape (n_components,) containing the fraction of the total
+        variance explained by each component
+    """
+    assert center in [None, "volume", "both"], \
+           "invalid input to argument center"
+    n_volumes = data.shape[-1]
+    assert 0 < n_components <= n_volumes, "invalid number of components"
+    if mask is not None:
+        assert mask.shape == data.shape[:-1], "mask shape mismatch"
+    n_voxels = int(mask.sum()) if mask is not None else data.size // n_volumes
+    assert n_voxels > 1, "at least two voxels are needed"
+    size = min(n_components + n_oversamples, n_volumes)
+
+    # The first pass computes the mean of each volume over voxels
+    volume_mean = np.zeros(n_volumes)
+    if center is not None:
+        for block in _voxel_blocks(data, mask, block_size):
+            volume_mean += block.sum(0, dtype=float)
+        volume_mean /= n_voxels
+
+    def blocks():
+        return _centered_blocks(data, mask, block_size, center, volume_mean)
+
+    # The range of A'A (A being the centered voxel-by-time matrix) is sampled
+    # with random directions, refined by each pass, and kept orthonormal
+    directions = np.random.RandomState(seed).normal(size=(n_volumes, size))
+    total_variance = 0
+    for i in range(n_iter + 1):
+        projected = np.zeros((n_volumes, size))
+        for block in blocks():
+            projected += block.T.dot(block.dot(directions))
+            if i == 0:
+                total_variance += np.sum(block ** 2)
+        directions = npl.qr(projected)[0]
+
+    # The last pass projects the data onto the sampled range, a matrix with one
+    # column per direction whose thin SVD gives the components
+    projections = np.concatenate([block.dot(directions) for block in blocks()])
+    U, S, Vt = npl.svd(projections, full_matrices=False)
+    U, S = U[:, :n_components], S[:n_components]
+    time_courses = directions.dot(Vt[:n_components].T)
+
+    # Make the largest entry of each time course positive, so that the signs of
+    # the components do not depend on the random directions
+    signs = np.sign(time_courses[np.abs(time_courses).argmax(0),
+                                 np.arange(n_components)])
+    signs[signs == 0] = 1
+    time_courses *= signs
+    scores = U * (S * signs)
+
+    spatial_maps = np.zeros(data.shape[:-1] + (n_components,))
+    if mask is None:
+        spatial_maps.reshape(-1, n_components)[:] = scores
+    else:
+        spatial_maps[mask] = scores
+    explained_variance = S ** 2 / (n_voxels - 1)
+    return (spatial_maps, time_courses, explained_variance,
+            S ** 2 / total_variance)
+
+
+class group_pca(object):
+    """
+    This class finds principal components shared by many runs, without ever
+    holding more than one run in memory. Each run added is first reduced to its
+    own top components, as in randomized_pca(), and the projections of its
+    voxels onto them are appended to the group matrix as new columns. Rather
+    than keeping that matrix, the class keeps only its truncated singular value
+    decomposition, which is updated with every run (Brand's incremental SVD).
+    """
+
+    def __init__(self, mask, n_components=20, n_run_components=None):
+        """
+        Parameters
+        ----------
+        mask : np.ndarray
+            Boolean array selecting the voxels shared by every run, such as the
+            intersection of their brain masks. All runs must be in the same
+            space (e.g., MNI)
+        n_components : int, optional
+            Number of group components kept
+        n_run_components : int, optional
+            Number of components to which each run is reduced. Defaults to
+            n_components
+        """
+        self.mask = np.asarray(mask, dtype=bool)
+        self.n_components = n_components
+        if n_run_components is None:
+            n_run_components = n_components
+        self.n_run_components = n_run_components
+        n_voxels = int(self.mask.sum())
+        # Truncated SVD of the group matrix, U S V', and the reduced time
+        # courses of each run
+        self._U, self._S = np.zeros((n_voxels, 0)), np.zeros(0)
+        self._V = np.zeros((0, 0))
+        self.IDs, self._time_courses = [], []
+        self.total_variance = 0
+
+    def __len__(self):
+        return len(self.IDs)
+
+    def add_run(self, data, ID=None, **kwargs):
+        """
+        Reduces a run to its top components and updates the group components.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            4-D fMRI data of the run, in the same space as the mask
+        ID : tuple, optional
+            (run ID, subject ID) tuple, such as ("001", "016"), that identifies
+            the run among the projections
+        **kwargs
+            Keyword arguments passed on to randomized_pca(), such as block_size
+        """
+        maps, time_courses = randomized_pca(data, self.n_run_components,
+                                            self.mask, **kwargs)[:2]
+        columns = maps[self.mask]
+        self.total_variance += np.sum(columns ** 2)
+
+        # Split the new columns into their part in the span of the current
+        # components and an orthonormal basis of the rest, then rotate both
+        # bases by the SVD of a small square matrix
+        U, S, V = self._U, self._S, self._V
+        P = U.T.dot(columns)
+        residual = columns - U.dot(P)
+        # A second pass of Gram-Schmidt keeps the components orthogonal, and
+        # directions of the rest that are at the level of rounding errors are
+        # dropped, as they are noise that would undo this
+        correction = U.T.dot(residual)
+        residual -= U.dot(correction)
+        P += correction
+        Q, R = npl.qr(residual)
+        keep = np.abs(np.diag(R)) > 1e-10 * npl.norm(columns)
+        Q, R = Q[:, keep], R[keep]
+        k, size = len(S), columns.shape[1]
+        M = np.zeros((k + len(R), k + size))
+        M[:k, :k] = np.diag(S)
+        M[:k, k:], M[k:, k:] = P, R
+        U_M, S_M, Vt_M = npl.svd(M, full_matrices=False)
+        rank = min(self.n_components, len(S_M))
+        V_new = np.zeros((V.shape[0] + size, k + size))
+        V_new[:V.shape[0], :k], V_new[V.shape[0]:, k:] = V, np.eye(size)
+        self._U = np.column_stack([U, Q]).dot(U_M[:, :rank])
+        self._S = S_M[:rank]
+        self._V = V_new.dot(Vt_M[:rank].T)
+        self.IDs.append(ID)
+        self._time_courses.append(time_courses)
+
+    def _signs(self):
+        # Make the largest entry of each spatial map positive
+        signs = np.sign(self._U[np.abs(self._U).argmax(0),
+                                np.arange(len(self._S))])
+        signs[signs == 0] = 1
+        return signs
+
+    @property
+    def spatial_maps(self):
+        """
+        Array of shape mask.shape + (n_components,) containing the group
+        spatial maps, scaled by their singular values (0 outside of the mask).
+        Fewer maps are returned if the runs span fewer dimensions
+        """
+        spatial_maps = np.zeros(self.mask.shape + (len(self._S),))
+        spatial_maps[self.mask] = self._U * (self._S * self._signs())
+        return spatial_maps
+
+    @property
+    def explained_variance_ratio(self):
+        """
+        Fraction of the variance of the reduced runs explained by each group
+        component
+        """
+        return self._S ** 2 / self.total_variance
+
+    def projections(self):
+        """
+        Projects the data of each run onto the group spatial maps (normalized
+        to unit length), using only the reduced runs rather than their data.
+
+        Return
+        ------
+        projections : list
+            List (one element per run, in the order in which they were added)
+            of arrays of shape (T, n_components), the time course of each group
+            component in that run
+        """
+        projections, start = [], 0
+        for time_courses in self._time_courses:
+            stop = start + time_courses.shape[1]
+            projections.append(time_courses.dot(self._V[start:stop]) *
+                               (self._S * self._signs()))
+            start = stop
+        return projections
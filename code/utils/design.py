@@ -0,0 +1,259 @@
+"""
+This script contains tools that build the predicted neural time courses of many
+conditions and runs at once. Rather than painting each trial in a Python loop,
+every trial is expanded into the indices of the samples it covers, and its
+amplitude is added to all of them at once. It also contains the
+design_store() class, which keeps the convolved regressors of every run in a
+single binary file. Future Python scripts can take advantage of these tools by
+including the command
+    sys.path.append("code/utils")
+    from design import *
+"""
+from __future__ import absolute_import, division, print_function
+import json
+import numpy as np
+import os
+from scipy import sparse as sp
+
+# Regressor names may be byte or unicode strings under Python 2
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def stack_conditions(tables):
+    """
+    Stacks condition tables of different lengths into one array. Missing events
+    are padded with rows of zeros, which do not contribute to any time course.
+
+    Parameters
+    ----------
+    tables : list
+        List (one element per run) of lists (one element per regressor) of 2-D
+        arrays of shape (n_events, 3), whose columns hold the onsets, durations,
+        and amplitudes of the events, as in ds005().cond_gain
+
+    Return
+    ------
+    conditions : np.ndarray
+        Array of shape (n_runs, n_regressors, max_events, 3)
+    """
+    n_runs, n_regressors = len(tables), len(tables[0])
+    assert all(len(run) == n_regressors for run in tables), \
+           "every run must have the same number of regressors"
+    max_events = max([np.asarray(table).shape[0] for run in tables
+                      for table in run] + [0])
+    conditions = np.zeros((n_runs, n_regressors, max_events, 3))
+    for i, run in enumerate(tables):
+        for j, table in enumerate(run):
+            table = np.asarray(table, dtype=float).reshape(-1, 3)
+            conditions[i, j, :table.shape[0]] = table
+    return conditions
+
+def event_samples(conditions, n_samples, step_size=2):
+    """
+    Converts the onsets and durations of events into sample indices. Onsets are
+    rounded down and durations up, and every interval is clipped to the range
+    of samples.
+
+    Parameters
+    ----------
+    conditions : np.ndarray
+        Array of shape (..., n_events, 3), such as the return value of
+        stack_conditions()
+    n_samples : int
+        Number of samples in each time course
+    step_size : float, optional
+        Size of temporal steps (in seconds) between samples
+
+    Return
+    ------
+    starts, stops : np.ndarray
+        Integer arrays of shape conditions.shape[:-1] holding the first sample
+        of each event and the sample after its last one
+    """
+    conditions = np.asarray(conditions, dtype=float)
+    starts = np.floor(conditions[..., 0] / step_size).astype(int)
+    stops = starts + np.ceil(conditions[..., 1] / step_size).astype(int)
+    return np.clip(starts, 0, n_samples), np.clip(stops, 0, n_samples)
+
+def time_courses(conditions, n_samples, step_size=2, sparse=False):
+    """
+    Generates the predicted neural time courses of every regressor of every run
+    in one pass. Each time course is 0 between events and equal to the amplitude
+    of an event during it. Where events overlap, their amplitudes add up.
+
+    Parameters
+    ----------
+    conditions : np.ndarray
+        Array of shape (n_runs, n_regressors, n_events, 3), such as the return
+        value of stack_conditions()
+    n_samples : int
+        Number of samples in each time course
+    step_size : float, optional
+        Size of temporal steps (in seconds) between samples
+    sparse : bool, optional
+        If True, returns a scipy.sparse.csr_matrix of shape
+        (n_runs * n_regressors, n_samples), whose rows list the regressors of
+        the first run before moving on to the next run
+
+    Return
+    ------
+    time_courses : np.ndarray
+        Array of shape (n_runs, n_regressors, n_samples), or sparse matrix
+    """
+    conditions = np.asarray(conditions, dtype=float)
+    assert conditions.ndim == 4 and conditions.shape[3] == 3, \
+           "conditions must be of shape (n_runs, n_regressors, n_events, 3)"
+    n_runs, n_regressors, n_events = conditions.shape[:3]
+    starts, stops = event_samples(conditions, n_samples, step_size)
+    amplitudes = conditions[..., 2]
+    rows = np.arange(n_runs * n_regressors).repeat(n_events)
+    starts, stops = starts.ravel(), stops.ravel()
+    amplitudes = amplitudes.ravel()
+    # Expand each event into the column indices of the samples it covers. Only
+    # amplitudes are ever added, so samples between events are exactly 0
+    lengths = stops - starts
+    first = np.cumsum(lengths) - lengths
+    offsets = np.arange(lengths.sum()) - first.repeat(lengths)
+    rows, cols = rows.repeat(lengths), starts.repeat(lengths) + offsets
+    values = amplitudes.repeat(lengths)
+    if sparse:
+        # The conversion to CSR sums the values of overlapping events
+        matrix = sp.coo_matrix((values, (rows, cols)),
+                               shape=(n_runs * n_regressors, n_samples))
+        return matrix.tocsr()
+    courses = np.zeros((n_runs * n_regressors, n_samples))
+    np.add.at(courses, (rows, cols), values)
+    return courses.reshape(n_runs, n_regressors, n_samples)
+
+
+class design_store(object):
+    """
+    This class collects the convolved regressors of many runs into one array of
+    shape (n_runs, n_volumes, n_regressors), indexed by (run ID, subject ID)
+    and regressor name, and saves it along with its metadata to a single .npz
+    file.
+    """
+
+    def __init__(self, path, names=("gain", "loss", "dist2indiff"),
+                 **metadata):
+        """
+        Creates an empty store. Use load_designs() to read a saved one.
+
+        Parameters
+        ----------
+        path : str
+            Path leading from the main project directory to the .npz file
+        names : tuple, optional
+            Names of the regressors, in the order of the columns of each design
+        **metadata
+            Values describing how the regressors were computed, such as the
+            step size or the parameters of the hemodynamic response function.
+            They must be serializable to JSON
+        """
+        self.path, self.names, self.metadata = path, list(names), metadata
+        self.IDs, self._designs = [], []
+
+    def __len__(self):
+        return len(self.IDs)
+
+    def __contains__(self, ID):
+        return tuple(ID) in self.IDs
+
+    @property
+    def designs(self):
+        """
+        Array of shape (n_runs, n_volumes, n_regressors) whose runs are ordered
+        as in the attribute IDs
+        """
+        if not self._designs:
+            return np.zeros((0, 0, len(self.names)))
+        return np.array(self._designs)
+
+    def append(self, ID, design):
+        """
+        Adds the design of a run to the store, replacing any previous one.
+
+        Parameters
+        ----------
+        ID : tuple
+            (run ID, subject ID) tuple, such as ("001", "016")
+        design : np.ndarray
+            Array of shape (n_volumes, n_regressors), whose columns are the
+            regressors listed in the attribute names
+        """
+        design = np.asarray(design, dtype=float)
+        assert design.ndim == 2 and design.shape[1] == len(self.names), \
+               "design must have one column per regressor"
+        assert not self._designs or design.shape == self._designs[0].shape, \
+               "every run must have the same number of volumes"
+        ID = tuple(ID)
+        if ID in self.IDs:
+            self._designs[self.IDs.index(ID)] = design
+        else:
+            self.IDs.append(ID)
+            self._designs.append(design)
+
+    def get(self, ID, regressor=None):
+        """
+        Returns the design of a run.
+
+        Parameters
+        ----------
+        ID : tuple
+            (run ID, subject ID) tuple, such as ("001", "016")
+        regressor : str or list, optional
+            Name(s) of the regressor(s) of interest. Defaults to all of them
+
+        Return
+        ------
+        design : np.ndarray
+            Array of shape (n_volumes, n_regressors), or (n_volumes,) if a
+            single regressor name is given
+        """
+        assert tuple(ID) in self.IDs, "run not in store"
+        design = self._designs[self.IDs.index(tuple(ID))]
+        if regressor is None:
+            return design
+        if isinstance(regressor, string_types):
+            return design[:, self.names.index(regressor)]
+        return design[:, [self.names.index(name) for name in regressor]]
+
+    def save(self):
+        """
+        Writes the store to its path. The file is first written under a
+        temporary name and then renamed, so that it is never left incomplete.
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(temp_path, "wb") as outfile:
+            np.savez(outfile, designs=self.designs,
+                     IDs=np.array(self.IDs, dtype=str).reshape(-1, 2),
+                     names=np.array(self.names, dtype=str),
+                     metadata=np.array(json.dumps(self.metadata)))
+        os.rename(temp_path, self.path)
+
+def load_designs(path):
+    """
+    Reads a store saved by design_store().save() in a single pass.
+
+    Parameters
+    ----------
+    path : str
+        Path leading from the main project directory to the .npz file
+
+    Return
+    ------
+    store : design_store
+        Store holding the designs, regressor names, and metadata of the file
+    """
+    with np.load(path) as saved:
+        names = [str(name) for name in saved["names"]]
+        store = design_store(path, names, **json.loads(str(saved["metadata"])))
+        store.IDs = [tuple(str(i) for i in ID) for ID in saved["IDs"]]
+        store._designs = list(saved["designs"])
+    return store
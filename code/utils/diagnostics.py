@@ -1,7 +1,8 @@
 """
-This script contains tools for performing diagnostics analyses on fMRI data.
-Future Python scripts can take advantage of these functions by including the
-command:
+This script contains tools for performing diagnostics analyses on fMRI data,
+including vol_stats(), which computes every per-volume statistic in a single
+pass over the data. Future Python scripts can take advantage of these functions
+by including the command:
     sys.path.append("code/utils")
     from diagnostics import *
 """
@@ -28,6 +29,84 @@ def vol_std(data):
     data2d = np.reshape(data, (np.prod(data.shape[:3]), data.shape[3]))
     return np.std(data2d, axis=0)
 
+def _merge_moments(count, mean, M2, count_b, mean_b, M2_b):
+    """
+    Combines the counts, means, and sums of squared deviations from the mean of
+    two groups of values (Chan et al.'s parallel algorithm).
+    """
+    total = count + count_b
+    delta = mean_b - mean
+    mean = mean + delta * (count_b / total)
+    M2 = M2 + M2_b + delta ** 2 * (count * count_b / total)
+    return total, mean, M2
+
+def vol_stats(data, chunk_size=4, mask=None, dtype=None):
+    """
+    Computes statistics of each volume in a single pass over 4-D fMRI data. The
+    data are read a few planes (along the first axis) at a time: since volumes
+    are the last axis, each plane holds every volume of its voxels contiguously,
+    and only the running sums of each volume and slice are kept in memory.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        4-D array of fMRI data with last axis indexing volumes. Call the shape
+        of this array (M, N, P, T) where T is the number of volumes.
+    chunk_size : int, optional
+        Number of planes along the first axis read at a time
+    mask : np.ndarray, optional
+        Boolean array of shape (M, N, P) of the voxels whose mean makes up the
+        global signal. Defaults to all voxels
+    dtype : np.dtype, optional
+        Data type of the returned arrays: np.float64 by default, or np.float32.
+        The statistics are always accumulated in double precision
+
+    Return
+    ------
+    stats : dict
+        Dictionary of arrays:
+        - "mean": shape (T,), mean over all voxels of each volume
+        - "std": shape (T,), standard deviation over all voxels, as vol_std()
+        - "dvars": shape (T - 1,), root-mean-square of differences between
+          sequential volumes, as vol_rms_diff()
+        - "global_signal": shape (T,), mean over the voxels of the mask
+        - "slice_mean": shape (P, T), mean of each slice (along the third axis)
+          of each volume
+        - "slice_std": shape (P, T), standard deviation of each slice of each
+          volume
+    """
+    assert data.ndim == 4, "data must be 4-D"
+    M, N, P, T = data.shape
+    mask = np.ones((M, N, P), dtype=bool) if mask is None else mask
+    assert mask.shape == (M, N, P), "mask shape mismatch"
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    assert dtype in [np.float32, np.float64], \
+           "dtype must be np.float32 or np.float64"
+    count, mean, M2 = 0, np.zeros((P, T)), np.zeros((P, T))
+    diff_squares, masked_sum = np.zeros(max(T - 1, 0)), np.zeros(T)
+    for start in range(0, M, chunk_size):
+        chunk = np.asarray(data[start:(start + chunk_size)], dtype=float)
+        # Moments of each slice of the chunk, merged into the running moments
+        chunk_mean = chunk.mean((0, 1))
+        chunk_M2 = np.sum((chunk - chunk_mean) ** 2, (0, 1))
+        count, mean, M2 = _merge_moments(count, mean, M2,
+                                         chunk.shape[0] * N, chunk_mean,
+                                         chunk_M2)
+        diff_squares += np.sum(np.diff(chunk, axis=3) ** 2, (0, 1, 2))
+        masked_sum += chunk[mask[start:(start + chunk_size)]].sum(0)
+    # Merge the moments of the slices into those of whole volumes
+    vol_count, vol_mean, vol_M2 = 0, np.zeros(T), np.zeros(T)
+    for k in range(P):
+        vol_count, vol_mean, vol_M2 = _merge_moments(vol_count, vol_mean,
+                                                     vol_M2, count, mean[k],
+                                                     M2[k])
+    n_masked = max(mask.sum(), 1)
+    stats = {"mean": vol_mean, "std": np.sqrt(vol_M2 / vol_count),
+             "dvars": np.sqrt(diff_squares / (M * N * P)),
+             "global_signal": masked_sum / n_masked,
+             "slice_mean": mean, "slice_std": np.sqrt(M2 / count)}
+    return dict((key, value.astype(dtype)) for key, value in stats.items())
+
 def iqr_outliers(arr_1d, iqr_scale=1.5):
     """
     Return the indices of outliers identified by interquartile range.
@@ -49,13 +128,49 @@ def iqr_outliers(arr_1d, iqr_scale=1.5):
         - Low threshold = first quartile - iqr_scale * IQR
         - High threshold = third quartile + iqr_scale * IQR
     """
-    IQR = np.percentile(arr_1d, 75) - np.percentile(arr_1d, 25)
-    low_threshold = np.percentile(arr_1d, 25) - iqr_scale * IQR
-    high_threshold = np.percentile(arr_1d, 75) + iqr_scale * IQR
+    q1, q3 = np.percentile(arr_1d, [25, 75])
+    low_threshold = q1 - iqr_scale * (q3 - q1)
+    high_threshold = q3 + iqr_scale * (q3 - q1)
     outlier_indices = np.nonzero((arr_1d < low_threshold) +
                                  (arr_1d > high_threshold))[0]
     return (outlier_indices, (low_threshold, high_threshold))
 
+def iqr_outliers_batch(arr_2d, iqr_scale=1.5):
+    """
+    Identifies outliers by interquartile range in each row of a 2-D array at
+    once, such as the volume standard deviations of every run of the dataset.
+
+    Parameters
+    ----------
+    arr_2d : np.ndarray
+        2-D array of shape (n_series, T) with one series per row
+    iqr_scale : float, optional
+        Coefficient used to determine the weight of the IQR in determining the
+        high and low thresholds.
+
+    Return
+    ------
+    outlier_indices : np.ndarray
+        1-D array containing the indices of the outliers of every series in
+        turn. The outliers of series i are
+        outlier_indices[offsets[i]:offsets[i + 1]], as returned by
+        iqr_outliers(arr_2d[i], iqr_scale)[0]
+    offsets : np.ndarray
+        Array of shape (n_series + 1,) delimiting the outliers of each series
+    thresholds : np.ndarray
+        Array of shape (n_series, 2) containing the low and high thresholds of
+        each series
+    """
+    arr_2d = np.asarray(arr_2d)
+    assert arr_2d.ndim == 2, "arr_2d must be 2-D"
+    q1, q3 = np.percentile(arr_2d, [25, 75], axis=1)
+    thresholds = np.column_stack([q1 - iqr_scale * (q3 - q1),
+                                  q3 + iqr_scale * (q3 - q1)])
+    outliers = ((arr_2d < thresholds[:, [0]]) + (arr_2d > thresholds[:, [1]]))
+    outlier_indices = np.nonzero(outliers)[1]
+    offsets = np.append(0, np.cumsum(outliers.sum(1)))
+    return outlier_indices, offsets, thresholds
+
 def vol_rms_diff(arr_4d):
     """
     Computes the root-mean-square of differences between sequential volumes.
@@ -101,3 +216,36 @@ def extend_diff_outliers(diff_indices):
     np.array([3, 4, 7, 8, 9, 12, 13, 20, 21])
     """
     return np.unique(np.append(diff_indices, diff_indices + 1))
+
+def extend_diff_outliers_batch(diff_indices, offsets, n_diffs):
+    """
+    Extends the difference-based outlier indices of many series at once, as
+    extend_diff_outliers() does for one series.
+
+    Parameters
+    ----------
+    diff_indices : np.ndarray
+        1-D array of difference outlier indices of every series in turn, as
+        returned by iqr_outliers_batch()
+    offsets : np.ndarray
+        Array of shape (n_series + 1,) delimiting the indices of each series
+    n_diffs : int
+        Number of differences in each series
+
+    Return
+    ------
+    extended_indices : np.ndarray
+        1-D array of the extended indices of every series in turn
+    extended_offsets : np.ndarray
+        Array of shape (n_series + 1,) delimiting the extended indices of each
+        series
+    """
+    offsets = np.asarray(offsets)
+    n_series = len(offsets) - 1
+    series = np.repeat(np.arange(n_series), np.diff(offsets))
+    outliers = np.zeros((n_series, n_diffs + 1), dtype=bool)
+    outliers[series, diff_indices] = True
+    outliers[:, 1:] |= outliers[:, :-1].copy()
+    extended_indices = np.nonzero(outliers)[1]
+    extended_offsets = np.append(0, np.cumsum(outliers.sum(1)))
+    return extended_indices, extended_offsets
@@ -1,13 +1,17 @@
 """
 This script contains the hrf() function, which is a utility for computing values
 of the hemodynamic response function at given times. This is a necessary tool
-for predicting BOLD signals. Future Python scripts can take advantage of the
-hrf() function by including the command
+for predicting BOLD signals. It also contains hrf_integral(), which computes the
+response to a trial of any duration in closed form, and tools that convolve
+many neural time courses with sampled responses at once. Future Python scripts
+can take advantage of these functions by including the command
     sys.path.append("code/utils")
     from hrf import *
 """
 from __future__ import absolute_import, division, print_function
 import numpy as np
+from scipy.optimize import brentq
+from scipy.special import gammainc
 from scipy.stats import gamma
 
 def hrf(times):
@@ -34,4 +38,134 @@ def hrf(times):
     values = peak_values - 0.35 * undershoot_values
     # Scale max to 0.6
     return values / np.max(values) * 0.6
-    
\ No newline at end of file
+
+def _unscaled_hrf(times):
+    """
+    Computes the difference of the two gamma densities behind hrf(), before it
+    is scaled to a maximum of 0.6.
+    """
+    return gamma.pdf(times, 6) - 0.35 * gamma.pdf(times, 12)
+
+# Time (in seconds) at which the hemodynamic response peaks: the derivative of a
+# gamma density with shape k is gamma.pdf(t, k) * ((k - 1) / t - 1)
+_peak_time = brentq(lambda t: gamma.pdf(t, 6) * (5 / t - 1) -
+                              0.35 * gamma.pdf(t, 12) * (11 / t - 1), 1, 10)
+_hrf_scale = 0.6 / _unscaled_hrf(_peak_time)
+
+def hrf_integral(times, duration=30, step_size=None):
+    """
+    Computes the integral of the canonical hemodynamic response function from
+    onset to the specified times, for a response that lasts `duration` seconds.
+    The convolution of the response with a trial of amplitude a lasting from
+    time s to time e, evaluated at time t, is then given in closed form by
+    a * (hrf_integral(t - s) - hrf_integral(t - e)).
+
+    Parameters
+    ----------
+    times : np.ndarray
+        Array of time points (in seconds) relative to the onset of the response
+    duration : float, optional
+        Time (in seconds) after which the response is truncated to 0
+    step_size : float, optional
+        If given, the integral is replaced by the sum of the values of the
+        response sampled every step_size seconds up to (and including) each
+        time, times step_size. This matches discrete convolution on a grid of
+        that resolution, and is approximated using the trapezoidal rule
+
+    Return
+    ------
+    integral : np.ndarray
+        Array of shape times.shape, which is 0 for negative times and constant
+        after `duration`. It is scaled so that its derivative, the hemodynamic
+        response function, peaks at 0.6
+    """
+    times = np.asarray(times, dtype=float)
+    # Most time points fall before onset or after the end of the response,
+    # where the integral is constant, so only the others need to be evaluated
+    integral = np.zeros(times.shape)
+    integral[times >= duration] = (gammainc(6, duration) -
+                                   0.35 * gammainc(12, duration))
+    during = (times > 0) & (times < duration)
+    t_during = times[during]
+    integral[during] = gammainc(6, t_during) - 0.35 * gammainc(12, t_during)
+    if step_size is not None:
+        # A sum of samples exceeds the integral by half of the last sample
+        integral[during] += step_size / 2 * _unscaled_hrf(t_during)
+    return integral * _hrf_scale
+
+# Sampled responses computed so far, keyed by (step_size, duration)
+_kernels = {}
+
+def hrf_kernel(step_size, duration=30):
+    """
+    Returns the canonical hemodynamic response function sampled every step_size
+    seconds, i.e., hrf(np.arange(0, duration, step_size)). Each kernel is only
+    computed the first time it is requested.
+
+    Parameters
+    ----------
+    step_size : float
+        Time (in seconds) between samples
+    duration : float, optional
+        Time (in seconds) covered by the kernel
+
+    Return
+    ------
+    kernel : np.ndarray
+        Read-only 1-D array of sampled response values
+    """
+    key = (float(step_size), float(duration))
+    if key not in _kernels:
+        kernel = hrf(np.arange(0, duration, step_size))
+        kernel.flags.writeable = False
+        _kernels[key] = kernel
+    return _kernels[key]
+
+def convolve(signals, kernel, method="auto"):
+    """
+    Convolves one or more signals with a kernel, keeping as many values as there
+    are in each signal, as in np.convolve(signal, kernel)[:len(signal)].
+
+    Parameters
+    ----------
+    signals : np.ndarray
+        Array of shape (..., N) in which the last axis indexes time, such as a
+        stack of neural time courses for several regressors and runs
+    kernel : np.ndarray
+        1-D array of shape (M,), such as the return value of hrf_kernel()
+    method : str, optional
+        "direct" calls np.convolve() on each signal, "fft" multiplies the real
+        Fourier transforms of all signals with that of the kernel at once, and
+        "auto" picks "fft" when both signals and kernel are long
+
+    Return
+    ------
+    convolution : np.ndarray
+        Array of shape signals.shape. With "fft", values at the level of the
+        rounding errors of the transforms are set to 0, so that the convolution
+        is exactly 0 wherever the signal has not started yet
+    """
+    assert method in ["auto", "direct", "fft"], "invalid method"
+    signals = np.asarray(signals, dtype=float)
+    kernel = np.asarray(kernel, dtype=float)
+    n, m = signals.shape[-1], kernel.shape[0]
+    if method == "auto":
+        # Direct convolution costs O(N * M) per signal against O(L * log(L))
+        # for the transforms, so it only wins for short signals or kernels
+        method = "fft" if min(n, m) > 64 else "direct"
+    if method == "direct":
+        rows = signals.reshape(-1, n)
+        convolution = np.empty(rows.shape)
+        for i, row in enumerate(rows):
+            convolution[i] = np.convolve(row, kernel)[:n]
+        return convolution.reshape(signals.shape)
+    # Zero-padding to a power of two at least N + M - 1 long avoids wrapping
+    length = 2 ** int(np.ceil(np.log2(n + m - 1)))
+    spectrum = np.fft.rfft(signals, length) * np.fft.rfft(kernel, length)
+    convolution = np.fft.irfft(spectrum, length)[..., :n]
+    # The rounding errors of the transforms grow with log2(L) and with the
+    # largest value the convolution of a signal could take
+    tolerance = (np.finfo(float).eps * np.log2(length) * np.abs(kernel).sum() *
+                 np.abs(signals).max(-1, keepdims=True))
+    convolution[np.abs(convolution) <= tolerance] = 0
+    return convolution
@@ -7,12 +7,17 @@ advantage of this module by including the command
     from hypothesis import *
 """
 from __future__ import division, print_function, absolute_import
-from scipy.stats import norm, t
+from multiprocessing import Pool
+from scipy.stats import norm
 import numpy as np
 import numpy.linalg as npl
+import sys
 
+sys.path.append("code/utils")
+from stat_utils import glm_model, voxel_blocks
 
-def ttest(X, beta, response):
+
+def ttest(X, beta, response, censor=None, dtype=None):
     """
     Performs a t-test on the results of a multiple linear regression.
 
@@ -25,6 +30,12 @@ def ttest(X, beta, response):
         values of beta
     response : np.ndarray
         2-D array of BOLD data
+    censor : np.ndarray, optional
+        Indices of the volumes left out of the fit that gave beta (see
+        stat_utils.glm_util()). They are also left out of the residuals
+    dtype : np.dtype, optional
+        np.float32 computes the statistics in single precision (see
+        stat_utils.float_dtype())
 
     Return
     ------
@@ -35,19 +46,225 @@ def ttest(X, beta, response):
         Array of shape (num_regressors, num_voxels) containing p-values that
         correspond to the given t-statistics
     """
-    resids = response.T - X.dot(beta)
-    RSS = np.sum(resids ** 2, axis=0)
-    df = X.shape[0] - npl.matrix_rank(X)
-    MSE = RSS / df
-    MSE.shape = (MSE.shape[0], 1, 1)
-    temp = np.diagonal(npl.pinv(X.T.dot(X)))
-    st_err = np.sqrt(MSE * np.tile(temp, MSE.shape))
-    st_err.shape = beta.shape
-    zeros = np.where(st_err == 0)
-    st_err[zeros] = 1
-    t_stat = beta / st_err
-    p_value = 2 * (1 - t.cdf(abs(t_stat), df))
-    return t_stat, p_value
+    model = glm_model(X, dtype)
+    if censor is not None:
+        model = model.censored(censor)
+    dtype = model.dtype
+    beta = np.asarray(beta, dtype)
+    resids = (np.asarray(response, dtype).T -
+              model.design_matrix.astype(dtype).dot(beta))
+    resids = resids[model.kept]
+    MSE = np.sum(resids ** 2, axis=0) / model.df
+    return model.ttest(beta, MSE)
+
+# Data shared with the workers that compute permutation batches: with forked
+# processes, they are inherited rather than sent with every batch
+_permutation_data = None
+
+def _set_permutation_data(*data):
+    global _permutation_data
+    _permutation_data = data
+
+def _nuisance_residual_makers(model, contrasts):
+    """
+    Returns, for each contrast c, the matrix that maps the response to its
+    residuals under the reduced model of the null hypothesis c'b = 0, whose
+    design is X times a basis of the null space of c (Freedman & Lane, 1983).
+    """
+    X = model.design_matrix
+    makers = []
+    for contrast in contrasts:
+        Vt = npl.svd(contrast[np.newaxis])[2]
+        Z = X.dot(Vt[1:].T)
+        makers.append(np.eye(X.shape[0]) - Z.dot(npl.pinv(Z)))
+    return makers
+
+def _permutation_batch(batch):
+    """
+    Computes the maximum absolute t-statistic of each contrast over all voxels,
+    for each permutation of a batch, following Freedman and Lane: the residuals
+    of the reduced model of each contrast are permuted (or their signs flipped),
+    the fitted values of the reduced model are added back, and the full model
+    is refitted. The fitted values lie in the span of the design and in the null
+    space of the contrast, so they change neither the contrast nor the residuals
+    of the refit, and the statistics are computed from the permuted residuals
+    alone. The statistics of every permutation are obtained at once by stacking
+    the correspondingly permuted pseudoinverses of the design, and the residual
+    sums of squares follow from RSS = e'e - b'X'Xb, since permuting or flipping
+    the signs of the residuals e does not change e'e. Both terms are summed in
+    double precision, and the residuals carry neither the baseline nor the
+    drift of the data, so the difference does not cancel.
+    """
+    model, data, mask, contrasts, makers, sign_flip, block_size = \
+        _permutation_data
+    seed, size = batch
+    random = np.random.RandomState(seed)
+    n_volumes = data.shape[-1]
+    dtype = model.dtype
+    if sign_flip:
+        signs = 2 * random.randint(0, 2, (size, n_volumes)) - 1
+        pinvs = model.pinv[np.newaxis] * signs[:, np.newaxis, :]
+    else:
+        # pinv.dot(Y[order]) equals pinv[:, inverse of order].dot(Y)
+        orders = np.array([random.permutation(n_volumes) for _ in range(size)])
+        pinvs = model.pinv[:, np.argsort(orders, 1)].transpose(1, 0, 2)
+    pinvs = pinvs.astype(dtype)
+    XtX = model.design_matrix.T.dot(model.design_matrix)
+    variance = np.sum(contrasts.dot(model.cov) * contrasts, 1)
+    maxima = np.zeros((size, len(contrasts)))
+    n_regressors = pinvs.shape[1]
+    pinvs = pinvs.reshape(size * n_regressors, n_volumes)
+    makers = [maker.astype(dtype) for maker in makers]
+    for block, response in voxel_blocks(data, mask, block_size):
+        Y = np.asarray(response, dtype)
+        for k, (contrast, maker) in enumerate(zip(contrasts, makers)):
+            residuals = maker.dot(Y)
+            # One matrix product fits every permutation of the block
+            coefficients = pinvs.dot(residuals).reshape(size, n_regressors, -1)
+            coefficients = coefficients.astype(float)
+            # b'X'Xb of every permutation and voxel, with np.tensordot()
+            # rather than np.matmul(), which numpy 1.9 does not have
+            XtX_coefficients = np.tensordot(coefficients, XtX, (1, 0))
+            explained = np.sum(coefficients.transpose(0, 2, 1) *
+                               XtX_coefficients, 2)
+            RSS = np.sum(residuals.astype(float) ** 2, 0) - explained
+            st_err = np.sqrt(variance[k] * np.maximum(RSS, 0) / model.df)
+            st_err[st_err == 0] = 1
+            t_stat = contrast.dot(coefficients) / st_err
+            maxima[:, k] = np.maximum(maxima[:, k], abs(t_stat).max(1))
+    return maxima.astype(dtype)
+
+def fwe_p_value(t_stat, max_null):
+    """
+    Computes p-values corrected for the family-wise error rate over voxels from
+    the maximum absolute t-statistics of a permutation test, counting the
+    observed labeling as one of the permutations.
+
+    Parameters
+    ----------
+    t_stat : np.ndarray
+        Array of shape (num_contrasts, num_voxels) containing the observed
+        t-statistics
+    max_null : np.ndarray
+        Array of shape (n_permutations, num_contrasts) containing the maximum
+        absolute t-statistic of each permutation, over all voxels tested
+
+    Return
+    ------
+    p_value : np.ndarray
+        Array of shape (num_contrasts, num_voxels) containing the corrected
+        p-values
+    """
+    n_permutations = max_null.shape[0]
+    assert max_null.shape[1] == t_stat.shape[0], "shape mismatch"
+    p_value = np.empty(t_stat.shape)
+    for k, null in enumerate(np.sort(max_null, 0).T):
+        exceed = n_permutations - np.searchsorted(null, abs(t_stat[k]), "left")
+        p_value[k] = (exceed + 1) / (n_permutations + 1)
+    return p_value
+
+def permutation_test(X, response, contrasts=None, n_permutations=1000,
+                     sign_flip=False, seed=0, batch_size=100, block_size=4096,
+                     n_jobs=1, dtype=None, mask=None):
+    """
+    Performs a nonparametric test of contrasts of a multiple linear regression,
+    controlling the family-wise error rate over voxels with the distribution of
+    the maximum absolute t-statistic under permutations (or random sign flips,
+    for errors that are symmetric about 0). As in the method of Freedman and
+    Lane, what is permuted is not the response but its residuals under the
+    model without the tested effect, so that the other columns of the design,
+    such as the intercept and drift terms, are kept out of the null
+    distribution. The data are read one block of voxels at a time, both for the
+    observed statistics and for each batch of permutations, so that 4-D data
+    (which may be memory-mapped) are never copied as a whole, and the design
+    is factorized and the processes started only once.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Design matrix of shape (num_volumes, num_regressors)
+    response : np.ndarray
+        2-D array of BOLD data of shape (num_volumes, num_voxels), or 4-D data
+        whose last axis indexes volumes, such as smoothed fMRI data
+    contrasts : np.ndarray, optional
+        Array of shape (num_contrasts, num_regressors) with one contrast vector
+        per row. Defaults to testing every regressor separately
+    n_permutations : int, optional
+        Number of random permutations (or sign flips) of the volumes
+    sign_flip : bool, optional
+        If True, flips the signs of random volumes instead of permuting them
+    seed : int, optional
+        Seed of the random permutations. Batch i draws from the stream seeded by
+        [seed, i], so results do not depend on n_jobs, and tests of different
+        blocks of voxels with the same seed use the same permutations
+    batch_size : int, optional
+        Number of permutations whose statistics are computed at once
+    block_size : int, optional
+        Number of voxels processed at a time
+    n_jobs : int, optional
+        Number of processes among which the batches are divided
+    dtype : np.dtype, optional
+        np.float32 computes the statistics in single precision (see
+        stat_utils.float_dtype()). Residual sums of squares are always summed
+        in double precision
+    mask : np.ndarray, optional
+        For 4-D data, boolean array of shape response.shape[:3] selecting the
+        voxels to test, such as a brain mask. Defaults to all voxels
+
+    Return
+    ------
+    t_stat : np.ndarray
+        Array of shape (num_contrasts, num_voxels) containing the observed
+        t-statistics. For 4-D data, the voxels are those inside the mask, in
+        the order of response[mask]
+    p_value : np.ndarray
+        Array of shape (num_contrasts, num_voxels) containing p-values that are
+        corrected for the family-wise error rate over voxels (see fwe_p_value())
+    max_null : np.ndarray
+        Array of shape (n_permutations, num_contrasts) containing the maximum
+        absolute t-statistic of each permutation. The maxima of tests of
+        several blocks of voxels with the same seed can be combined with
+        np.maximum() before being passed to fwe_p_value()
+    """
+    if response.ndim == 2:
+        assert mask is None, "a mask needs 4-D data"
+        # The voxels of a 2-D response are its columns
+        data = response.T
+    else:
+        assert response.ndim == 4, "response must be 2- or 4-D"
+        data = response
+    assert X.shape[0] == data.shape[-1], "shape mismatch"
+    model = glm_model(X, dtype)
+    if contrasts is None:
+        contrasts = np.eye(X.shape[1])
+    contrasts = np.atleast_2d(np.asarray(contrasts, dtype=float))
+    t_stat = []
+    for block, Y in voxel_blocks(data, mask, block_size):
+        beta, RSS, MRSS = model.fit(Y, block_size)
+        t_stat.append(model.t_contrast(contrasts, beta, MRSS)[1])
+    t_stat = np.concatenate(t_stat + [np.zeros((len(contrasts), 0),
+                                               model.dtype)], 1)
+    sizes = [min(batch_size, n_permutations - start)
+             for start in range(0, n_permutations, batch_size)]
+    batches = [([seed, i], size) for i, size in enumerate(sizes)]
+    shared = (model, data, mask, contrasts,
+              _nuisance_residual_makers(model, contrasts), sign_flip,
+              block_size)
+    if n_jobs == 1:
+        _set_permutation_data(*shared)
+        try:
+            maxima = list(map(_permutation_batch, batches))
+        finally:
+            _set_permutation_data()
+    else:
+        pool = Pool(n_jobs, _set_permutation_data, shared)
+        try:
+            maxima = pool.map(_permutation_batch, batches)
+        finally:
+            pool.close()
+    max_null = np.concatenate(maxima + [np.zeros((0, len(contrasts)),
+                                                 model.dtype)])
+    return t_stat, fwe_p_value(t_stat, max_null), max_null
 
 def waldtest(design_matrix, beta_hat, prob_estimates):
     """
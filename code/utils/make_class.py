@@ -7,14 +7,19 @@ advantage of the img() and ds005() classes by including the command
     from make_class import *
 """
 from __future__ import absolute_import, division, print_function
+from collections import OrderedDict
+import hashlib
 import matplotlib.pyplot as plt
 import nibabel as nib
 import numpy as np
-import os, sys
+import os, sys, threading
 from scipy.ndimage.filters import gaussian_filter
 
 sys.path.append("code/utils")
+from cache_tool import *
+from design import *
 from hrf import *
+from smooth_tool import *
 
 
 class img(object):
@@ -23,7 +28,7 @@ class img(object):
     to extract crucial information necessary for later statistical analyses.
     """
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, cache=True, dtype=None):
         """
         Each object of this class created will contain the fMRI data that comes
         from a single file. While keeping the original image, it also saves
@@ -35,22 +40,66 @@ class img(object):
         file_path : str
             Path leading from the main project directory to the file containing
             the fMRI BOLD signal data of interest
+        cache : bool, optional
+            True reads the BOLD data from a memory-mapped, uncompressed copy of
+            the file, which is created the first time it is needed
+        dtype : np.dtype, optional
+            Data type of the BOLD data (e.g., np.float32 to halve the memory
+            used by float64 data). None keeps the data type stored in the file
         """
-        # Load the fMRI image saved to the specified file
+        # Load the fMRI image saved to the specified file. Note that nib.load()
+        # only reads the header: the BOLD data stay on disk until requested
         assert os.path.isfile(file_path), "nonexistent file for subject/run"
+        self.file_path, self.cache = file_path, cache
+        self.dtype = None if dtype is None else np.dtype(dtype)
         self.img = nib.load(file_path)
-        
-        # Extract the BOLD data enclosed within the image
-        self.data = self.img.get_data()
-        
-        # Extract the affine of the fMRI image
+        self._data, self._masks = None, {}
+
+        # Extract the shape and the affine of the fMRI image
+        self.shape = self.img.shape
         self.affine = self.img.affine
 
         # Extract the voxel to mm conversion rate from the image affine
         mm_per_voxel = abs(self.affine.diagonal()[:3])
         self.voxels_per_mm = np.append(np.reciprocal(mm_per_voxel), 0)
 
-    def smooth(self, fwhm=5):
+    @property
+    def data(self):
+        """
+        BOLD data enclosed within the image, read from disk the first time it is
+        accessed and kept in memory until release() is called. If the image is
+        cached, this is a read-only memory map of the uncompressed copy, unless
+        it must be converted to another data type.
+        """
+        if self._data is None and self.cache:
+            self._data = load_image(self.file_path)
+        elif self._data is None:
+            # Unlike get_data(), this does not keep a second reference to the
+            # array within self.img, so release() really frees the memory
+            self._data = np.asanyarray(self.img.dataobj)
+        if self.dtype is not None and self._data.dtype != self.dtype:
+            self._data = self._data.astype(self.dtype)
+        return self._data
+
+    def release(self):
+        """
+        Frees the memory held by the BOLD data. The data will be read from disk
+        again if they are accessed afterward.
+        """
+        self._data = None
+
+    @property
+    def nbytes(self):
+        """
+        Number of bytes of memory held by the BOLD data: 0 if they have not been
+        loaded, or if they are memory-mapped from the cache, as the operating
+        system pages them in and out as needed
+        """
+        if self._data is None or getattr(self._data, "_mmap", None) is not None:
+            return 0
+        return self._data.nbytes
+
+    def smooth(self, fwhm=5, dtype=None, n_threads=1, mask=None, cache=False):
         """
         Returns a given volume of the BOLD data after application of a Gaussian
         filter with a standard deviation parameter of `sigma`
@@ -61,20 +110,144 @@ class img(object):
             Millimeter measurement of the full-width-at-half-maximum of the
             Gaussian distribution whose kernel will be used in smoothing. If
             np.ndarray(), shape must be (4,)
+        dtype : np.dtype, optional
+            Data type of the smoothed data. Defaults to the data type of
+            self.data
+        n_threads : int, optional
+            Number of threads among which the volumes are divided
+        mask : np.ndarray, optional
+            Boolean array of shape self.shape[:3], such as the return value of
+            brain_mask(). If given, only voxels near the mask are smoothed and
+            voxels far outside of it are set to 0
+        cache : bool, optional
+            If True and the image is cached, the smoothed data are saved to the
+            cache directory the first time they are computed, and read from
+            there afterwards, so that scripts that smooth the same run more
+            than once compute the smoothing only once
 
         Return
         ------
         smooth_data : np.ndarray
-           Array of shape self.data.shape
+           Array of shape self.data.shape. If cache is True and the image is
+           cached, this is a read-only memory map of the copy in the cache
+           directory
+        """
+        sigma_in_voxels = self._sigma_in_voxels(fwhm)
+        if not (cache and self.cache):
+            return smooth_4d(self.data, sigma_in_voxels, dtype, n_threads,
+                             mask=mask)
+        # The cached copy is identified by the kernel, the output data type, and
+        # the mask that restricted the work, if any
+        dtype = self.data.dtype if dtype is None else np.dtype(dtype)
+        tag = "_smooth_%s_%s" % ("_".join("%g" % f for f in np.ravel(fwhm)),
+                                 dtype.str.lstrip("<>=|"))
+        if mask is not None:
+            tag += "_" + hashlib.md5(np.packbits(mask).tobytes()).hexdigest()
+        path = cache_path(self.file_path, tag)
+        if not os.path.isfile(path):
+            save_cache(path, smooth_4d(self.data, sigma_in_voxels, dtype,
+                                       n_threads, mask=mask))
+        return np.load(path, mmap_mode="r")
+
+    def _sigma_in_voxels(self, fwhm):
+        """
+        Validates a full-width-at-half-maximum measurement in millimeters and
+        converts it to the standard deviation of the Gaussian kernel in voxels.
         """
         if type(fwhm) == np.ndarray:
             assert fwhm.shape == (4,), "invalid shape in fwhm"
             assert fwhm.dtype in ["float_", "int_"], "invalid dtype in fwhm"
         else:
             assert type(fwhm) in [float, int], "invalid type in fwhm"
-        sigma_in_voxels = fwhm / np.sqrt(8 * np.log(2)) * self.voxels_per_mm
-        smooth_data = gaussian_filter(self.data, sigma_in_voxels)
-        return smooth_data
+        return fwhm / np.sqrt(8 * np.log(2)) * self.voxels_per_mm
+
+    def brain_mask(self, fwhm=5, percentile=80):
+        """
+        Identifies the voxels inside the brain as those whose mean smoothed BOLD
+        signal over time exceeds a given percentile. The mask is computed once
+        per image and, if the image is cached, saved next to its cached data.
+
+        Parameters
+        ----------
+        fwhm : float or np.ndarray(..., dtype=float), optional
+            Full-width-at-half-maximum of the Gaussian kernel used in smoothing,
+            as in smooth()
+        percentile : float, optional
+            Percentile of the mean smoothed signal above which voxels are
+            considered to be inside the brain
+
+        Return
+        ------
+        mask : np.ndarray
+            Boolean array of shape self.shape[:3], True for voxels in the brain
+        """
+        sigma_in_voxels = self._sigma_in_voxels(fwhm)
+        tag = "_mask_%s_%g" % ("_".join("%g" % f for f in np.ravel(fwhm)),
+                               percentile)
+        if tag not in self._masks:
+            path = cache_path(self.file_path, tag) if self.cache else None
+            if path is not None and os.path.isfile(path):
+                mask = np.load(path)
+            else:
+                # Smoothing does not act on the time axis, so the mean of the
+                # smoothed data equals the smoothed mean volume: there is no
+                # need to smooth every volume to find the mask
+                voxel_means = gaussian_filter(np.mean(self.data, axis=3),
+                                              sigma_in_voxels[:3])
+                mask = voxel_means > np.percentile(voxel_means, percentile)
+                if path is not None:
+                    save_cache(path, mask)
+            self._masks[tag] = mask
+        return self._masks[tag]
+
+    def mask_data(self, data=None, mask=None):
+        """
+        Restricts 4-D data to the voxels inside a mask.
+
+        Parameters
+        ----------
+        data : np.ndarray, optional
+            Array whose first three dimensions match self.shape[:3], such as
+            the return value of smooth(). Defaults to self.data
+        mask : np.ndarray, optional
+            Boolean array of shape self.shape[:3]. Defaults to brain_mask()
+
+        Return
+        ------
+        masked_data : np.ndarray
+            C-contiguous array of shape (n_voxels_in_mask, T), whose rows
+            follow the order of np.flatnonzero(mask)
+        """
+        data = self.data if data is None else data
+        mask = self.brain_mask() if mask is None else mask
+        data2d = np.reshape(data, (-1,) + data.shape[3:])
+        return data2d[np.flatnonzero(mask)]
+
+    def unmask(self, values, mask=None, fill=0):
+        """
+        Scatters values computed for the voxels inside a mask back to 3-D space.
+        This is the inverse of mask_data().
+
+        Parameters
+        ----------
+        values : np.ndarray
+            Array of shape (n_voxels_in_mask, ...)
+        mask : np.ndarray, optional
+            Boolean array of shape self.shape[:3]. Defaults to brain_mask()
+        fill : float, optional
+            Value given to the voxels outside of the mask
+
+        Return
+        ------
+        volume : np.ndarray
+            Array of shape self.shape[:3] + values.shape[1:]
+        """
+        mask = self.brain_mask() if mask is None else mask
+        volume = np.empty(mask.shape + values.shape[1:],
+                          np.result_type(values, fill))
+        volume.fill(fill)
+        volume[mask] = values
+        return volume
 
 
 class ds005(object):
@@ -83,7 +256,7 @@ class ds005(object):
     behavioral data, it also contains as subobjects the raw and filtered data.
     """
 
-    def __init__(self, sub_id, run_id, rm_nonresp=True):
+    def __init__(self, sub_id, run_id, rm_nonresp=True, cache=True, dtype=None):
         """
         Each object of this class created contains both sets of fMRI data along
         with the corresponding behavioral data.
@@ -96,6 +269,10 @@ class ds005(object):
             Unique key used to identify the run number (i.e, 001, ..., 003)
         rm_nonresp : bool, optional
             True removes trials that resulted in subject nonresponse
+        cache : bool, optional
+            True memory-maps the fMRI data from uncompressed copies of the files
+        dtype : np.dtype, optional
+            Data type of the fMRI data. None keeps the data type of the files
         """
         # Save parts of the paths to the directories containing the data
         path_sub = "data/ds005/sub%s/" % sub_id
@@ -134,10 +311,53 @@ class ds005(object):
             conditions += (cond,)
         self.cond_gain, self.cond_loss, self.cond_dist2indiff = conditions
 
-        # Load raw and filtered fMRI images
-        self.raw = img(path_sub + "BOLD/" + path_run + "/bold.nii.gz")
-        self.filtered = img(path_sub + "model/model001/" + path_run +
-                            ".feat/filtered_func_data_mni.nii.gz")
+        # Save the paths to the raw and filtered fMRI images, which are only
+        # loaded once they are accessed
+        self.path_raw = path_sub + "BOLD/" + path_run + "/bold.nii.gz"
+        self.path_filtered = (path_sub + "model/model001/" + path_run +
+                              ".feat/filtered_func_data_mni.nii.gz")
+        self._raw, self._filtered = None, None
+        self.cache, self.dtype = cache, dtype
+
+    @property
+    def raw(self):
+        """
+        Instance of class img containing the raw fMRI data
+        """
+        if self._raw is None:
+            self._raw = img(self.path_raw, self.cache, self.dtype)
+        return self._raw
+
+    @property
+    def filtered(self):
+        """
+        Instance of class img containing the filtered fMRI data
+        """
+        if self._filtered is None:
+            self._filtered = img(self.path_filtered, self.cache,
+                                 self.dtype)
+        return self._filtered
+
+    def release(self):
+        """
+        Frees the memory held by the raw and filtered fMRI data. Either will be
+        loaded again if it is accessed afterward.
+        """
+        self._raw, self._filtered = None, None
+
+    @property
+    def nbytes(self):
+        """
+        Number of bytes of memory held by the behavioral, condition, and loaded
+        fMRI data (see img.nbytes). Smoothed data are not held by the object,
+        so they do not count
+        """
+        arrays = [self.behav, self.cond_gain, self.cond_loss,
+                  self.cond_dist2indiff]
+        nbytes = sum(array.nbytes for array in arrays)
+        for image in [self._raw, self._filtered]:
+            nbytes += 0 if image is None else image.nbytes
+        return nbytes
 
     def design_matrix(self, gain=True, loss=True, dist2indiff=True,
                       resp_time=False):
@@ -175,9 +395,10 @@ class ds005(object):
         
         Parameters
         ----------
-        regressor : str
+        regressor : str or list
             Name of regressor whose amplitudes will be used to generate the
-            time course: select from "gain", "loss", "dist2indiff"
+            time course: select from "gain", "loss", "dist2indiff". A list of
+            names generates all of their time courses at once
         step_size : float, optional
             Size of temporal steps (in seconds) at which to generate predictions
             
@@ -185,19 +406,20 @@ class ds005(object):
         ------
         time_course : np.ndarray
             1-D numpy array, containing 0s for time between trials and values
-            defined by the specified regressor for time during trials
+            defined by the specified regressor for time during trials. For a
+            list of regressors, this array has one row per regressor
         """
-        assert regressor in ["gain", "loss", "dist2indiff"], "invalid regressor"
-        condition = {"gain": self.cond_gain, "loss": self.cond_loss,
-                     "dist2indiff": self.cond_dist2indiff}[regressor]
-        onsets = condition[:, 0] / step_size
-        periods, amplitudes = condition[:, 1] / step_size, condition[:, 2]
+        single = isinstance(regressor, string_types)
+        names = [regressor] if single else list(regressor)
+        assert set(names) <= set(["gain", "loss", "dist2indiff"]), \
+               "invalid regressor"
+        tables = {"gain": self.cond_gain, "loss": self.cond_loss,
+                  "dist2indiff": self.cond_dist2indiff}
+        conditions = stack_conditions([[tables[name] for name in names]])
         # The default time resolution in this study was two seconds
-        time_course = np.zeros(int(2 * self.raw.data.shape[3] / step_size))
-        for onset, period, amplitude in list(zip(onsets, periods, amplitudes)):
-            onset, period = int(np.floor(onset)), int(np.ceil(period))
-            time_course[onset:(onset + period)] = amplitude
-        return time_course
+        n_samples = int(2 * self.raw.shape[3] / step_size)
+        time_course = time_courses(conditions, n_samples, step_size)[0]
+        return time_course[0] if single else time_course
 
     def convolution(self, regressor, step_size=2):
         """
@@ -206,10 +428,10 @@ class ds005(object):
 
         Parameters
         ----------
-        regressor : str
+        regressor : str or list
             Name of the regressor whose predicted neural time course and whose
             hemodynamic response function will be convolved: select from "gain",
-            "loss", "dist2indiff"
+            "loss", "dist2indiff". A list of names convolves all of them at once
         step_size : float
             Size of temporal steps (in seconds) at which to generate signals
 
@@ -217,10 +439,180 @@ class ds005(object):
         ------
         convolution : np.ndarray
             Array containing the predicted hemodynamic response function values
-            for the given regressor
+            for the given regressor. For a list of regressors, this array has
+            one row per regressor
         """
         time_course = self.time_course(regressor, step_size)
         # Hemodynamic responses typically last 30 seconds
-        hr_func = hrf(np.arange(0, 30, step_size))
-        convolution = np.convolve(time_course, hr_func)[:len(time_course)]
+        convolution = convolve(time_course, hrf_kernel(step_size, 30))
         return convolution
+
+    def regressor(self, regressor, step_size=None):
+        """
+        Computes the predicted convolved hemodynamic response function signals
+        for a given regressor directly at the acquisition time of each volume,
+        without generating the neural time course at a finer time resolution.
+
+        Parameters
+        ----------
+        regressor : str
+            Name of the regressor whose trials will be convolved with the
+            hemodynamic response function: select from "gain", "loss",
+            "dist2indiff"
+        step_size : float, optional
+            If given, trial onsets and durations are rounded to multiples of
+            step_size as in time_course(), and signals are scaled to match
+            those of convolution(regressor, step_size) at the acquisition time
+            of each volume, up to discretization error. If None, signals are the
+            exact convolution of the trials with the response
+
+        Return
+        ------
+        signals : np.ndarray
+            Array of shape (number of volumes,) containing the predicted
+            hemodynamic response function values for the given regressor
+        """
+        assert regressor in ["gain", "loss", "dist2indiff"], "invalid regressor"
+        condition = {"gain": self.cond_gain, "loss": self.cond_loss,
+                     "dist2indiff": self.cond_dist2indiff}[regressor]
+        onsets, durations, amplitudes = condition.T
+        if step_size is not None:
+            onsets = np.floor(onsets / step_size) * step_size
+            durations = np.ceil(durations / step_size) * step_size
+        # The response to each trial is the integral of the hemodynamic response
+        # function over the duration of the trial
+        times = 2 * np.arange(self.raw.shape[3])
+        lags = times[:, np.newaxis] - onsets
+        responses = (hrf_integral(lags, step_size=step_size) -
+                     hrf_integral(lags - durations, step_size=step_size))
+        signals = responses.dot(amplitudes)
+        return signals if step_size is None else signals / step_size
+
+
+class ds005_cache(object):
+    """
+    This class keeps recently used ds005() objects in memory so that each run is
+    only built once per process. Least recently used runs are dropped whenever
+    the data held by all runs exceed a memory budget.
+
+    The budget only covers data held in memory, such as fMRI data read from the
+    original files or converted to another data type (see ds005.nbytes). Data
+    memory-mapped from the cache directory count as 0 bytes, since the
+    operating system pages them in and out as needed, and smoothed data are
+    returned to the caller rather than kept by the cached runs.
+    """
+
+    def __init__(self, max_bytes=2 * 2 ** 30):
+        """
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Memory budget, in bytes, for the data held by all cached runs. The
+            most recently used run is always kept, even if it exceeds the budget
+        """
+        self.max_bytes = max_bytes
+        self.runs = OrderedDict()
+        # Runs may be requested from a background thread (see iter_ds005())
+        self._lock = threading.Lock()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, sub_id, run_id, rm_nonresp=True, dtype=None):
+        """
+        Returns the ds005() object of a run, building it only if it is not
+        already cached.
+
+        Parameters
+        ----------
+        sub_id : str
+            Unique key used to identify the subject (i.e., 001, ..., 016)
+        run_id : str
+            Unique key used to identify the run number (i.e, 001, ..., 003)
+        rm_nonresp : bool, optional
+            True removes trials that resulted in subject nonresponse
+        dtype : np.dtype, optional
+            Data type of the fMRI data. None keeps the data type of the files
+
+        Return
+        ------
+        obj : ds005
+            Object containing the data of the specified run
+        """
+        dtype = None if dtype is None else np.dtype(dtype)
+        key = (sub_id, run_id, rm_nonresp, dtype)
+        with self._lock:
+            if key in self.runs:
+                self.hits += 1
+                obj = self.runs.pop(key)
+            else:
+                self.misses += 1
+                obj = ds005(sub_id, run_id, rm_nonresp, dtype=dtype)
+            self.runs[key] = obj
+            # Because fMRI data are loaded lazily, the size of a run is only
+            # known once it has been used, so the budget is enforced at every
+            # access
+            self.evict()
+        return obj
+
+    @property
+    def nbytes(self):
+        """
+        Number of bytes held by all cached runs
+        """
+        return sum(obj.nbytes for obj in self.runs.values())
+
+    def evict(self):
+        """
+        Drops least recently used runs until the cache fits its memory budget.
+        Objects that are still referenced elsewhere are left untouched.
+        """
+        while len(self.runs) > 1 and self.nbytes > self.max_bytes:
+            self.runs.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Drops all cached runs and resets the statistics.
+        """
+        self.runs.clear()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def stats(self):
+        """
+        Reports the usage of the cache.
+
+        Return
+        ------
+        stats : dict
+            Number of hits, misses, and evictions so far, as well as the number
+            of cached runs and the number of bytes they hold
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "runs": len(self.runs),
+                "bytes": self.nbytes}
+
+
+# Cache shared by all users of get_ds005() within the process
+run_cache = ds005_cache()
+
+def get_ds005(sub_id, run_id, rm_nonresp=True, dtype=None):
+    """
+    Returns the ds005() object of a run from the process-wide cache `run_cache`,
+    whose memory budget can be changed through `run_cache.max_bytes`.
+
+    Parameters
+    ----------
+    sub_id : str
+        Unique key used to identify the subject (i.e., 001, ..., 016)
+    run_id : str
+        Unique key used to identify the run number (i.e, 001, ..., 003)
+    rm_nonresp : bool, optional
+        True removes trials that resulted in subject nonresponse
+    dtype : np.dtype, optional
+        Data type of the fMRI data. None keeps the data type of the files
+
+    Return
+    ------
+    obj : ds005
+        Object containing the data of the specified run
+    """
+    return run_cache.get(sub_id, run_id, rm_nonresp, dtype)
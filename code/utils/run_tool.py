@@ -0,0 +1,136 @@
+"""
+This script contains tools that walk through the runs of the ds005 dataset. The
+iterator defined here loads upcoming runs in a background thread while the
+current run is being analyzed, so that reading and decompressing the fMRI data
+(or, for cached runs, reading their memory-mapped copies from disk) overlaps
+with computation. Future Python scripts can take advantage of these
+tools by including the command
+    sys.path.append("code/utils")
+    from run_tool import *
+"""
+from __future__ import absolute_import, division, print_function
+import mmap, sys, threading
+import numpy as np
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+sys.path.append("code/utils")
+from make_class import ds005, get_ds005
+
+
+def run_IDs(runs=range(1, 4), subjects=range(1, 17), order="run"):
+    """
+    Creates a collection of run IDs and subject IDs.
+
+    Parameters
+    ----------
+    runs : iterable, optional
+        Numbers of the runs of interest
+    subjects : iterable, optional
+        Numbers of the subjects of interest
+    order : str, optional
+        "run" lists all subjects of the first run before moving on to the next
+        run, "subject" lists all runs of the first subject before moving on to
+        the next subject
+
+    Return
+    ------
+    IDs : list
+        List of (run ID, subject ID) tuples, such as ("001", "016")
+    """
+    assert order in ["run", "subject"], "invalid input to argument order"
+    run_IDs = [str(i).zfill(3) for i in runs]
+    subject_IDs = [str(i).zfill(3) for i in subjects]
+    if order == "run":
+        return [(run, subject) for run in run_IDs for subject in subject_IDs]
+    return [(run, subject) for subject in subject_IDs for run in run_IDs]
+
+def _touch(data):
+    """
+    Reads one value from every page of memory-mapped data, so that the
+    operating system loads the pages from disk before they are needed. Arrays
+    in memory are left as they are.
+    """
+    if isinstance(data, np.memmap) and data.size > 0:
+        step = max(mmap.PAGESIZE // data.itemsize, 1)
+        np.ravel(data)[::step].sum()
+
+def iter_ds005(IDs=None, prefetch=1, images=("filtered",), cache=False,
+               **kwargs):
+    """
+    Yields the ds005() object of each run in turn. While a run is being
+    analyzed, the next ones are loaded in a background thread. The data of
+    cached images are memory-mapped, so the thread also reads every page of
+    them, which brings them into the page cache of the operating system; they
+    may still be evicted again if memory is short.
+
+    Parameters
+    ----------
+    IDs : list, optional
+        List of (run ID, subject ID) tuples in the order in which runs should be
+        yielded. Defaults to run_IDs()
+    prefetch : int, optional
+        Number of runs to load ahead of the current one. 0 loads every run in
+        the calling thread, only when it is needed
+    images : tuple, optional
+        Names of the images whose data should be read ahead of time: select
+        from "raw" and "filtered"
+    cache : bool, optional
+        If True, runs are taken from the process-wide cache of get_ds005(), and
+        kept there for later passes over the same runs
+    **kwargs
+        Keyword arguments passed on to ds005(), such as rm_nonresp or dtype
+
+    Return
+    ------
+    ID, obj : tuple, ds005
+        Yields the (run ID, subject ID) tuple and the object of each run
+    """
+    assert set(images) <= set(["raw", "filtered"]), "invalid image name"
+    IDs = run_IDs() if IDs is None else list(IDs)
+
+    def load(ID):
+        run, subject = ID
+        obj = (get_ds005 if cache else ds005)(subject, run, **kwargs)
+        for image in images:
+            _touch(getattr(obj, image).data)
+        return obj
+
+    if prefetch == 0:
+        for ID in IDs:
+            yield ID, load(ID)
+        return
+
+    # The background thread puts (ID, obj, error) triples on a bounded queue
+    # and stops early if the consumer no longer needs any more runs
+    loaded, stop = Queue(maxsize=prefetch), threading.Event()
+
+    def produce():
+        for ID in IDs:
+            try:
+                item = (ID, load(ID), None)
+            except Exception as error:
+                item = (ID, None, error)
+            while not stop.is_set():
+                try:
+                    loaded.put(item, timeout=0.1)
+                    break
+                except Full:
+                    pass
+            if stop.is_set() or item[2] is not None:
+                return
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        for _ in IDs:
+            ID, obj, error = loaded.get()
+            if error is not None:
+                raise error
+            yield ID, obj
+    finally:
+        stop.set()
@@ -0,0 +1,116 @@
+"""
+This script contains the smoothing engine behind img.smooth(). Rather than
+filtering a whole run in one call, it splits the run into chunks of volumes that
+are smoothed concurrently by a pool of threads, each of which applies the three
+1-D Gaussian filters in place into a preallocated output array. Future Python
+scripts can take advantage of this engine by including the command
+    sys.path.append("code/utils")
+    from smooth_tool import *
+"""
+from __future__ import absolute_import, division, print_function
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from scipy.ndimage.filters import gaussian_filter1d
+
+
+def mask_bounds(mask, sigma, truncate=4.0):
+    """
+    Computes the bounding box of a mask, padded by the radius of a Gaussian
+    kernel, so that smoothing within the padded box gives exact results for
+    every voxel inside the unpadded box.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        3-D boolean array
+    sigma : np.ndarray
+        Standard deviations, in voxels, of the Gaussian kernel along the first
+        three axes
+    truncate : float, optional
+        Number of standard deviations at which the kernel is truncated
+
+    Return
+    ------
+    bounds : tuple
+        Tuple of three slices that select the padded bounding box
+    """
+    bounds = ()
+    for axis in range(3):
+        other_axes = tuple(i for i in range(3) if i != axis)
+        indices = np.flatnonzero(np.any(mask, axis=other_axes))
+        if len(indices) == 0:
+            return (slice(0, 0),) * 3
+        radius = int(truncate * float(sigma[axis]) + 0.5)
+        bounds += (slice(max(indices[0] - radius, 0),
+                         min(indices[-1] + 1 + radius, mask.shape[axis])),)
+    return bounds
+
+def smooth_4d(data, sigma, dtype=None, n_threads=1, chunk_size=8, mask=None):
+    """
+    Applies a Gaussian filter to each volume of 4-D fMRI data. With the default
+    arguments, the result is identical to that of
+    scipy.ndimage.gaussian_filter(data, sigma) with no smoothing in time.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        4-D array with last axis indexing volumes. Call its shape (M, N, P, T)
+    sigma : np.ndarray
+        Standard deviations, in voxels, of the Gaussian kernel. If of shape
+        (4,), the last element must be 0, as volumes are not smoothed in time
+    dtype : np.dtype, optional
+        Data type of the output (e.g., np.float32). Defaults to data.dtype
+    n_threads : int, optional
+        Number of threads among which the chunks of volumes are divided
+    chunk_size : int, optional
+        Number of volumes smoothed at a time by a thread
+    mask : np.ndarray, optional
+        Boolean array of shape (M, N, P). If given, only the bounding box of the
+        mask (padded by the radius of the kernel) is smoothed, and voxels
+        outside of this box are set to 0. Voxels inside the mask are unaffected
+
+    Return
+    ------
+    smooth_data : np.ndarray
+        Array of shape (M, N, P, T)
+    """
+    sigma = np.asarray(sigma, dtype=float)
+    assert data.ndim == 4, "data must be 4-D"
+    assert sigma.shape in [(3,), (4,)], "invalid shape in sigma"
+    assert sigma.shape == (3,) or sigma[3] == 0, "cannot smooth in time"
+    dtype = data.dtype if dtype is None else np.dtype(dtype)
+    if mask is None:
+        smooth_data = np.empty(data.shape, dtype)
+        bounds = (slice(None),) * 3
+    else:
+        assert mask.shape == data.shape[:3], "mask shape mismatch"
+        smooth_data = np.zeros(data.shape, dtype)
+        bounds = mask_bounds(mask, sigma)
+    n_volumes = data.shape[3]
+    chunks = [bounds + (slice(start, min(start + chunk_size, n_volumes)),)
+              for start in range(0, n_volumes, chunk_size)]
+
+    def smooth_chunk(chunk):
+        # The first filter reads from the input and every later one filters the
+        # output in place, just as gaussian_filter() does
+        source, output = data[chunk], smooth_data[chunk]
+        if output.size == 0:
+            return
+        filtered = False
+        for axis in range(3):
+            if sigma[axis] > 1e-15:
+                gaussian_filter1d(source, sigma[axis], axis, output=output)
+                source, filtered = output, True
+        if not filtered:
+            output[...] = source
+
+    if n_threads == 1:
+        for chunk in chunks:
+            smooth_chunk(chunk)
+    else:
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(smooth_chunk, chunks)
+        finally:
+            pool.close()
+    return smooth_data
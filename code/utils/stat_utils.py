@@ -1,53 +1,143 @@
 """
 This script contains code that performs a number of computations that tend to be
-very useful in statistical analysis. Future Python scripts can take advantage of
-this module by including the command
+very useful in statistical analysis, including the glm_model() class, which fits
+linear models to many voxels from a single factorization of the design matrix,
+and the glm_runs() class, which does the same for many runs at once. Future
+Python scripts can take advantage of this module by including the command
     sys.path.append("code/utils")
     from stat_utils import *
 """
 from __future__ import absolute_import, division, print_function
+from multiprocessing import Pool
+import copy
 import matplotlib.pyplot as plt
 import nibabel as nib
 import numpy as np
 import numpy.linalg as npl
 import os, sys
+from scipy import stats
 from scipy.ndimage.filters import gaussian_filter
 
 
-def correlation(obj, img, regressor):
+def correlation(obj, img, regressor, mask=None, block_size=4096):
     """
-    Calculates the correlation coefficient of the BOLD signal with a single
-    regressor for each voxel across time.
+    Calculates the correlation coefficient of the BOLD signal with one or more
+    regressors for each voxel across time, with correlation_map().
     
     Parameters
     ----------
-    ds005_obj : object
+    obj : object
         Instance of class ds005
-    img_type : str
+    img : str
         Dataset of interest: select from "raw" and "filtered"
-    regressor : str
+    regressor : str or list
         Name of regressor whose correlation with the BOLD data is of interest:
-        select from "gain", "loss", "dist2indiff"
+        select from "gain", "loss", "dist2indiff". A list of names computes the
+        correlations with all of them at once
+    mask : np.ndarray, optional
+        Boolean array of shape data.shape[:3]. If given, only voxels inside the
+        mask are considered, and the others are set to np.nan
+    block_size : int, optional
+        Number of voxels whose correlations are computed at a time
         
     Return
     ------
     corr : np.ndarray
         Array of shape (run.data.shape[:3],), where each value in 3-D space
         is the corresponding voxel's correlation coefficient of the BOLD
-        signal with the specified regressor over time
+        signal with the specified regressor over time. For a list of
+        regressors, the last axis indexes the regressors
     """
-    type_obj = str(type(obj))
-    assert type_obj == "<class 'make_class.ds005'>", "not an instance of ds005"
+    # Imported here so that the rest of this module does not depend on the
+    # data directory and its cache
+    from make_class import ds005
+    assert isinstance(obj, ds005), "not an instance of ds005"
     assert img in ["raw", "filtered"], "invalid input to argument img"
     data = obj.raw.data if img == "raw" else obj.filtered.data
-    time_course = obj.time_course(regressor)
-    n_voxels, n_volumes = np.prod(data.shape[:3]), data.shape[3]
-    voxels = data.reshape(n_voxels, n_volumes)
-    corr_1d = [np.corrcoef(voxel, time_course)[0, 1] for voxel in voxels]
-    corr = np.reshape(corr_1d, data.shape[:3])
-    return corr
+    return correlation_map(data, obj.time_course(regressor).T, mask,
+                           block_size)
 
-def glm_util(design_matrix, response):
+def correlation_map(data, time_courses, mask=None, block_size=4096):
+    """
+    Calculates the correlation coefficient of 4-D BOLD data with one or more
+    time courses for each voxel across time. The time courses are centered
+    once, and the correlations of a block of voxels are computed with one
+    matrix product.
+    
+    Parameters
+    ----------
+    data : np.ndarray
+        4-D array of BOLD data with last axis indexing volumes, such as
+        ds005().filtered.data. Memory-mapped data are only read one block of
+        voxels at a time
+    time_courses : np.ndarray
+        Array of shape (T,) or (T, K) holding the time courses of one or K
+        regressors, such as ds005().time_course("gain")
+    mask : np.ndarray, optional
+        Boolean array of shape data.shape[:3]. If given, only voxels inside the
+        mask are considered, and the others are set to np.nan
+    block_size : int, optional
+        Number of voxels whose correlations are computed at a time
+        
+    Return
+    ------
+    corr : np.ndarray
+        Array of shape data.shape[:3], where each value in 3-D space is the
+        corresponding voxel's correlation coefficient of the BOLD signal with
+        the regressor over time. For 2-D time_courses, the last axis indexes
+        the regressors. Voxels whose signal is constant have a correlation of
+        np.nan
+    """
+    assert data.ndim == 4, "data must be 4-D"
+    n_volumes = data.shape[3]
+    time_courses = np.asarray(time_courses, dtype=float)
+    assert time_courses.ndim in [1, 2], "time_courses must be 1- or 2-D"
+    assert time_courses.shape[0] == n_volumes, "shape mismatch"
+    single = time_courses.ndim == 1
+    time_courses = time_courses.reshape(n_volumes, -1)
+    time_courses = time_courses - time_courses.mean(0)
+    time_courses_ss = np.sum(time_courses ** 2, 0)
+    voxels = data.reshape(-1, n_volumes)
+    if mask is None:
+        indices = np.arange(voxels.shape[0])
+    else:
+        assert mask.shape == data.shape[:3], "mask shape mismatch"
+        indices = np.flatnonzero(mask)
+    corr = np.full((voxels.shape[0], time_courses.shape[1]), np.nan)
+    for start in range(0, len(indices), block_size):
+        block = indices[start:(start + block_size)]
+        signals = voxels[block].astype(float)
+        signals -= signals.mean(1)[:, np.newaxis]
+        ss = np.sum(signals ** 2, 1)[:, np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr[block] = np.clip(signals.dot(time_courses) /
+                                  np.sqrt(ss * time_courses_ss), -1, 1)
+    if single:
+        return corr.reshape(data.shape[:3])
+    return corr.reshape(data.shape[:3] + (time_courses.shape[1],))
+
+def float_dtype(dtype=None):
+    """
+    Returns the floating-point type in which the models of this module are
+    fitted: double precision, unless single precision is asked for explicitly.
+    The data type of the data never lowers the precision by itself.
+
+    Parameters
+    ----------
+    dtype : np.dtype, optional
+        np.float32 or np.float64. Defaults to np.float64
+
+    Return
+    ------
+    dtype : np.dtype
+        np.dtype(np.float32) or np.dtype(np.float64)
+    """
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    assert dtype in [np.float32, np.float64], \
+           "dtype must be np.float32 or np.float64"
+    return dtype
+
+def glm_util(design_matrix, response, censor=None, dtype=None):
     """
     Fits a generalized linear model to a set of training data.
 
@@ -59,6 +149,10 @@ def glm_util(design_matrix, response):
     response : np.ndarray
         1- or 2-D array representing the response variable. Let the shape of
         response be (N, X)
+    censor : np.ndarray, optional
+        Indices of observations (e.g., outlier volumes) left out of the fit
+    dtype : np.dtype, optional
+        np.float32 fits the model in single precision (see float_dtype())
 
     Return
     ------
@@ -72,10 +166,834 @@ def glm_util(design_matrix, response):
         Mean residual sum of squares, a commmonly used measure of a predictive
         model's accuracy (lower is better)
     """
-    regression_coefficients = npl.pinv(design_matrix).dot(response)
-    prediction = design_matrix.dot(regression_coefficients)
-    error = response - prediction
-    RSS = (error ** 2).sum(0)
-    df = int(design_matrix.shape[0] - npl.matrix_rank(design_matrix))
-    MRSS = RSS / df
-    return (regression_coefficients, df, MRSS)
+    model = glm_model(design_matrix, dtype)
+    if censor is not None:
+        model = model.censored(censor)
+    regression_coefficients, RSS, MRSS = model.fit(response)
+    return (regression_coefficients, model.df, MRSS)
+
+def spike_regressors(censor, n_volumes):
+    """
+    Creates one regressor per censored volume, equal to 1 at that volume and 0
+    elsewhere. Appending these columns to a design matrix gives the same
+    coefficients and residuals for the other columns as leaving the censored
+    volumes out of the fit, as glm_model.censored() does.
+
+    Parameters
+    ----------
+    censor : np.ndarray
+        Indices of the censored volumes
+    n_volumes : int
+        Number of volumes in the run
+
+    Return
+    ------
+    spikes : np.ndarray
+        Array of shape (n_volumes, number of distinct censored volumes)
+    """
+    censor = np.unique(np.asarray(censor, dtype=int))
+    spikes = np.zeros((n_volumes, len(censor)))
+    spikes[censor, np.arange(len(censor))] = 1
+    return spikes
+
+def voxel_blocks(data, mask=None, block_size=4096):
+    """
+    Yields the voxels of 4-D fMRI data one block at a time, as the columns of a
+    response that a model can be fitted to, so that the data inside the mask
+    are never copied as a whole.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Array of shape (..., T) with last axis indexing volumes, which may be
+        memory-mapped
+    mask : np.ndarray, optional
+        Boolean array of shape data.shape[:-1]. If given, only voxels inside the
+        mask are yielded
+    block_size : int, optional
+        Number of voxels in each block
+
+    Return
+    ------
+    indices, response : np.ndarray, np.ndarray
+        Yields the flat indices of the voxels of each block into
+        data.shape[:-1], in increasing order, and an array of shape
+        (T, len(indices)) holding their time courses
+    """
+    n_volumes = data.shape[-1]
+    voxels = data.reshape(-1, n_volumes)
+    if mask is None:
+        indices = np.arange(voxels.shape[0])
+    else:
+        assert mask.shape == data.shape[:-1], "mask shape mismatch"
+        indices = np.flatnonzero(mask)
+    for start in range(0, len(indices), block_size):
+        block = indices[start:(start + block_size)]
+        yield block, voxels[block].T
+
+def fit_models(models, response, block_size=4096):
+    """
+    Fits several models that share a design matrix, such as a glm_model() and
+    its censored versions, to a response in a single pass over its columns.
+
+    Parameters
+    ----------
+    models : list
+        List of glm_model() objects with the same design matrix
+    response : np.ndarray
+        1- or 2-D array representing the response variable. Let the shape of
+        response be (N, X)
+    block_size : int, optional
+        Number of columns of the response processed at a time
+
+    Return
+    ------
+    fits : list
+        List of (regression_coefficients, RSS, MRSS) tuples, one per model, as
+        returned by glm_model.fit()
+    """
+    X, dtype = models[0].design_matrix, models[0].dtype
+    assert all(np.array_equal(model.design_matrix, X) for model in models), \
+           "models must share their design matrix"
+    assert all(model.dtype == dtype for model in models), \
+           "models must share their data type"
+    outputs = _fit_blocks(X, [model.pinv for model in models],
+                          [None if model.kept.all() else model.kept
+                           for model in models], response, block_size, dtype)
+    shape = response.shape[1:]
+    fits = []
+    for model, (regression_coefficients, RSS) in zip(models, outputs):
+        MRSS = RSS / model.df
+        fits.append((regression_coefficients.reshape((-1,) + shape),
+                     RSS.reshape(shape)[()], MRSS.reshape(shape)[()]))
+    return fits
+
+def _factorize(X):
+    """
+    Computes the rank, the pseudoinverse, and pinv(X'X) of a design matrix, or
+    of each of a stack of design matrices of shape (..., N, P), from a single
+    singular value decomposition.
+    """
+    U, s, Vt = npl.svd(X, full_matrices=False)
+    # Designs without columns have no singular values, hence no maximum
+    if s.shape[-1] == 0:
+        largest = np.zeros(s.shape[:-1] + (1,))
+    else:
+        largest = s.max(-1)[..., np.newaxis]
+    # Same tolerances as npl.matrix_rank() and npl.pinv() respectively
+    rank = (s > largest * max(X.shape[-2:]) * np.finfo(float).eps).sum(-1)
+    s_inv = np.zeros_like(s)
+    kept = s > 1e-15 * largest
+    s_inv[kept] = 1 / s[kept]
+    # pinv = V diag(1 / s) U' and pinv(X'X) = V diag(1 / s^2) V', the latter
+    # of which scales the covariance of the coefficients. np.einsum() rather
+    # than np.matmul() multiplies the stacks, as numpy 1.9 has no np.matmul()
+    V_scaled = np.swapaxes(Vt, -1, -2) * s_inv[..., np.newaxis, :]
+    pinv = np.einsum("...ik,...jk->...ij", V_scaled, U)
+    cov = np.einsum("...ik,...kj->...ij", V_scaled * s_inv[..., np.newaxis, :],
+                    Vt)
+    return rank, pinv, cov
+
+def _fit_blocks(X, pinvs, kept, response, block_size, dtype):
+    """
+    Computes the coefficients and residual sums of squares of one or more
+    linear models that share a design matrix X, but not necessarily their
+    censored rows, for the columns of a response, one block of columns at a
+    time. Each model is given by its pseudoinverse and by the rows it keeps
+    (None for all rows). The response is fitted in the given data type.
+    """
+    # The factorization is computed in double precision, and only cast to the
+    # working data type before it touches the response
+    X = X.astype(dtype)
+    pinvs = [pinv.astype(dtype) for pinv in pinvs]
+    Y = response.reshape(response.shape[0], -1)
+    outputs = [(np.empty((X.shape[1], Y.shape[1]), dtype),
+                np.empty(Y.shape[1], dtype)) for pinv in pinvs]
+    for start in range(0, Y.shape[1], block_size):
+        block = slice(start, start + block_size)
+        for pinv, rows, (regression_coefficients, RSS) in zip(pinvs, kept,
+                                                              outputs):
+            Y_block = np.asarray(Y[:, block], dtype)
+            coefficients = pinv.dot(Y_block)
+            error = Y_block - X.dot(coefficients)
+            if rows is not None:
+                error = error[rows]
+            regression_coefficients[:, block] = coefficients
+            RSS[block] = (error ** 2).sum(0)
+    return outputs
+
+def _t_stats(regression_coefficients, MRSS, cov_diag, df, dtype):
+    """
+    Computes t-statistics and two-sided p-values of coefficients whose variances
+    are MRSS times the diagonal of (X'X)^-1, in the given data type.
+    """
+    regression_coefficients = np.asarray(regression_coefficients, dtype)
+    extra_axes = (1,) * (regression_coefficients.ndim - 1)
+    cov_diag = cov_diag.astype(dtype).reshape((-1,) + extra_axes)
+    st_err = np.sqrt(cov_diag * np.asarray(MRSS, dtype))
+    # Coefficients with no error are compared with a standard error of 1
+    st_err[st_err == 0] = 1
+    t_stat = regression_coefficients / st_err
+    p_value = (2 * stats.t.sf(abs(t_stat), df)).astype(dtype)
+    return t_stat, p_value
+
+def _prais_winsten(arr, rho, dtype=np.float64):
+    """
+    Whitens the rows of an array (observations by columns) for AR(1) noise with
+    coefficient rho, keeping the first observation.
+    """
+    whitened = np.empty(arr.shape, dtype)
+    whitened[0] = np.sqrt(1 - rho ** 2) * arr[0]
+    whitened[1:] = arr[1:] - rho * arr[:-1]
+    return whitened
+
+
+class glm_model(object):
+    """
+    This class factorizes a design matrix once, by singular value decomposition,
+    and keeps everything that fitting a linear model to any number of responses
+    and testing any number of contrasts need: the pseudoinverse, (X'X)^-1, the
+    rank, and the degrees of freedom.
+    """
+
+    def __init__(self, design_matrix, dtype=None):
+        """
+        Parameters
+        ----------
+        design_matrix : np.ndarray
+            2-D array with rows that correspond to observations and columns that
+            correspond to regressors. Let the shape of design_matrix be (N, P)
+        dtype : np.dtype, optional
+            Data type in which responses are fitted and tested: np.float64 by
+            default, or np.float32 to halve the memory used by large blocks of
+            voxels (see float_dtype()). The design is always factorized in
+            double precision
+        """
+        self.dtype = float_dtype(dtype)
+        X = np.asarray(design_matrix, dtype=float)
+        assert X.ndim == 2, "design_matrix must be 2-D"
+        rank, self.pinv, self.cov = _factorize(X)
+        self.design_matrix, self.rank = X, int(rank)
+        self.df = X.shape[0] - self.rank
+        self.cov_diag = np.diagonal(self.cov).copy()
+        # Observations that contribute to the fit (see .censored())
+        self.kept = np.ones(X.shape[0], dtype=bool)
+
+    def censored(self, censor):
+        """
+        Returns the model fitted without some observations (e.g., outlier
+        volumes). Rather than refactorizing the design, (X'X)^-1 is downdated
+        for the censored rows X_C with the Woodbury identity
+            (X'X - X_C'X_C)^-1 = A + A X_C' (I - X_C A X_C')^-1 X_C A,
+        where A = (X'X)^-1. If censoring makes the design rank-deficient, the
+        kept rows are factorized instead.
+
+        Parameters
+        ----------
+        censor : np.ndarray
+            Indices of the observations to leave out, in addition to those
+            already left out of this model
+
+        Return
+        ------
+        model : glm_model
+            Model with the same design matrix, whose pseudoinverse ignores the
+            censored observations, which are also left out of its residuals
+        """
+        model = copy.copy(self)
+        model.kept = self.kept.copy()
+        model.kept[np.asarray(censor, dtype=int)] = False
+        dropped = np.flatnonzero(self.kept & ~model.kept)
+        X, X_C = self.design_matrix, self.design_matrix[dropped]
+        downdate = self.rank == X.shape[1] and len(dropped) > 0
+        if downdate:
+            A = self.cov
+            S = np.eye(len(dropped)) - X_C.dot(A).dot(X_C.T)
+            # The eigenvalues of S are 1 minus the leverages of the censored
+            # rows, which reach 0 when censoring them loses rank
+            downdate = np.linalg.eigvalsh(S).min() > 1e-8
+        if downdate:
+            A_X_C = A.dot(X_C.T)
+            model.cov = A + A_X_C.dot(npl.solve(S, A_X_C.T))
+            model.rank = self.rank
+        else:
+            X_kept = X[model.kept]
+            model.cov = npl.pinv(X_kept.T.dot(X_kept))
+            model.rank = int(npl.matrix_rank(X_kept))
+        model.pinv = model.cov.dot(X.T) * model.kept
+        model.df = int(model.kept.sum()) - model.rank
+        model.cov_diag = np.diagonal(model.cov).copy()
+        return model
+
+    def fit(self, response, block_size=4096):
+        """
+        Estimates the coefficients and residual sums of squares of the model for
+        every column of the response, one block of columns at a time.
+
+        Parameters
+        ----------
+        response : np.ndarray
+            1- or 2-D array representing the response variable. Let the shape of
+            response be (N, X)
+        block_size : int, optional
+            Number of columns of the response processed at a time, which bounds
+            the size of the temporary residual array
+
+        Return
+        ------
+        regression_coefficients : np.ndarray
+            Array of shape (P, X) containing the estimated coefficients
+        RSS : np.ndarray
+            Array of shape (X,) containing the residual sums of squares
+        MRSS : np.ndarray
+            Array of shape (X,) containing the mean residual sums of squares
+        """
+        return fit_models([self], response, block_size)[0]
+
+    def fit_volume(self, data, mask=None, block_size=4096, fill=0):
+        """
+        Fits the model to every voxel of 4-D fMRI data, reading one block of
+        voxels at a time and writing the results into maps allocated up front,
+        so that at most one block of the data and its residuals is held in
+        memory besides the data itself (which may be memory-mapped).
+
+        Parameters
+        ----------
+        data : np.ndarray
+            4-D array with last axis indexing volumes. Call its shape
+            (M, N, P, T), where T must equal the number of rows of the design
+        mask : np.ndarray, optional
+            Boolean array of shape (M, N, P). If given, only voxels inside the
+            mask are fitted
+        block_size : int, optional
+            Number of voxels fitted at a time
+        fill : float, optional
+            Value of the maps at voxels outside the mask
+
+        Return
+        ------
+        regression_coefficients : np.ndarray
+            Array of shape (M, N, P, number of regressors)
+        MRSS : np.ndarray
+            Array of shape (M, N, P)
+        t_stat : np.ndarray
+            Array of shape (M, N, P, number of regressors)
+        p_value : np.ndarray
+            Array of shape (M, N, P, number of regressors)
+        """
+        n_volumes, n_regressors = self.design_matrix.shape
+        assert data.shape[-1] == n_volumes, "data and design shape mismatch"
+        shape = data.shape[:-1]
+        n_voxels = int(np.prod(shape))
+        dtype = self.dtype
+        maps = [np.full((n_voxels, n_regressors), fill, dtype),
+                np.full(n_voxels, fill, dtype),
+                np.full((n_voxels, n_regressors), fill, dtype),
+                np.full((n_voxels, n_regressors), fill, dtype)]
+        for block, response in voxel_blocks(data, mask, block_size):
+            coefficients, RSS, MRSS = self.fit(response, len(block))
+            t_stat, p_value = self.ttest(coefficients, MRSS)
+            maps[0][block], maps[1][block] = coefficients.T, MRSS
+            maps[2][block], maps[3][block] = t_stat.T, p_value.T
+        return (maps[0].reshape(shape + (n_regressors,)),
+                maps[1].reshape(shape),
+                maps[2].reshape(shape + (n_regressors,)),
+                maps[3].reshape(shape + (n_regressors,)))
+
+    def fit_ar1(self, response, bin_width=0.02, block_size=4096,
+                regression_coefficients=None):
+        """
+        Fits the model under first-order autoregressive (AR(1)) noise. The AR(1)
+        coefficient of each voxel is estimated from the lag-1 autocorrelation of
+        its ordinary least squares residuals and rounded to a multiple of
+        bin_width, which is kept within [-0.99, 0.99]. The voxels of each bin
+        are then prewhitened and refitted together, with a single factorization
+        of the whitened design matrix.
+
+        Parameters
+        ----------
+        response : np.ndarray
+            2-D array of shape (N, X) representing the response variable
+        bin_width : float, optional
+            Width of the bins into which the AR(1) coefficients are rounded
+        block_size : int, optional
+            Number of columns of the response processed at a time
+        regression_coefficients : np.ndarray, optional
+            Array of shape (P, X) containing the ordinary least squares
+            coefficients, as returned by fit(). If given, the residuals are
+            computed from them instead of refitting the model
+
+        Return
+        ------
+        regression_coefficients : np.ndarray
+            Array of shape (P, X) containing the generalized least squares
+            estimates of the coefficients
+        MRSS : np.ndarray
+            Array of shape (X,) containing the mean residual sums of squares of
+            the whitened model
+        t_stat : np.ndarray
+            Array of shape (P, X) containing t-statistics, as hypothesis.ttest()
+        p_value : np.ndarray
+            Array of shape (P, X) containing the corresponding p-values
+        rho : np.ndarray
+            Array of shape (X,) containing the binned AR(1) coefficients
+        """
+        assert self.kept.all(), "cannot prewhiten a censored model"
+        dtype = self.dtype
+        X, pinv = self.design_matrix.astype(dtype), self.pinv.astype(dtype)
+        n_regressors, n_voxels = X.shape[1], response.shape[1]
+        rho = np.empty(n_voxels)
+        for start in range(0, n_voxels, block_size):
+            block = slice(start, start + block_size)
+            Y = np.asarray(response[:, block], dtype)
+            if regression_coefficients is None:
+                error = Y - X.dot(pinv.dot(Y))
+            else:
+                error = Y - X.dot(np.asarray(regression_coefficients[:, block],
+                                             dtype))
+            numerator = np.sum(error[1:] * error[:-1], 0)
+            denominator = np.sum(error ** 2, 0)
+            denominator[denominator == 0] = 1
+            rho[block] = numerator / denominator
+        # Bins are kept away from 1, where whitening is singular: clipping the
+        # coefficients before rounding them could still round them up to 1
+        limit = int(np.floor(0.99 / bin_width))
+        bins = np.clip(np.round(rho / bin_width), -limit, limit).astype(int)
+        rho = bins * bin_width
+        outputs = [np.empty((n_regressors, n_voxels), dtype),
+                   np.empty(n_voxels, dtype),
+                   np.empty((n_regressors, n_voxels), dtype),
+                   np.empty((n_regressors, n_voxels), dtype)]
+        for value in np.unique(bins):
+            voxels = np.flatnonzero(bins == value)
+            model = glm_model(_prais_winsten(self.design_matrix,
+                                             value * bin_width), dtype)
+            whitened = _prais_winsten(response[:, voxels], value * bin_width,
+                                      dtype)
+            coefficients, RSS, MRSS = model.fit(whitened, block_size)
+            t_stat, p_value = model.ttest(coefficients, MRSS)
+            outputs[0][:, voxels], outputs[1][voxels] = coefficients, MRSS
+            outputs[2][:, voxels], outputs[3][:, voxels] = t_stat, p_value
+        return tuple(outputs) + (rho,)
+
+    def ttest(self, regression_coefficients, MRSS):
+        """
+        Computes t-statistics and two-sided p-values for each coefficient of the
+        model, without refactorizing the design matrix.
+
+        Parameters
+        ----------
+        regression_coefficients : np.ndarray
+            Array of shape (P, X) returned by .fit()
+        MRSS : np.ndarray
+            Array of shape (X,) returned by .fit()
+
+        Return
+        ------
+        t_stat : np.ndarray
+            Array of shape (P, X) containing t-statistics
+        p_value : np.ndarray
+            Array of shape (P, X) containing the corresponding p-values
+        """
+        return _t_stats(regression_coefficients, MRSS, self.cov_diag, self.df,
+                        self.dtype)
+
+    def t_contrast(self, contrasts, regression_coefficients, MRSS):
+        """
+        Tests one or more linear combinations of the coefficients of the model,
+        such as the neural loss aversion [0, -1, -1, 0, 0, 0], for all voxels
+        at once.
+
+        Parameters
+        ----------
+        contrasts : np.ndarray
+            Array of shape (P,) or (C, P), with one contrast vector per row
+        regression_coefficients : np.ndarray
+            Array of shape (P, X) returned by .fit()
+        MRSS : np.ndarray
+            Array of shape (X,) returned by .fit()
+
+        Return
+        ------
+        effect : np.ndarray
+            Array of shape (C, X) containing the estimated value of each
+            contrast, or (X,) if a single contrast vector is given
+        t_stat : np.ndarray
+            Array of the same shape containing t-statistics
+        p_value : np.ndarray
+            Array of the same shape containing two-sided p-values
+        """
+        C = np.atleast_2d(np.asarray(contrasts, dtype=float))
+        assert C.shape[1] == self.cov.shape[0], "contrast length mismatch"
+        dtype = self.dtype
+        effect = C.astype(dtype).dot(np.asarray(regression_coefficients,
+                                                dtype))
+        variance = np.sum(C.dot(self.cov) * C, 1).astype(dtype)
+        extra_axes = (1,) * (effect.ndim - 1)
+        st_err = np.sqrt(variance.reshape((-1,) + extra_axes) *
+                         np.asarray(MRSS, dtype))
+        # Contrasts with no error are compared with a standard error of 1
+        st_err[st_err == 0] = 1
+        t_stat = effect / st_err
+        p_value = (2 * stats.t.sf(abs(t_stat), self.df)).astype(dtype)
+        if np.ndim(contrasts) == 1:
+            return effect[0], t_stat[0], p_value[0]
+        return effect, t_stat, p_value
+
+    def f_contrast(self, contrast_matrix, regression_coefficients, MRSS):
+        """
+        Tests whether several linear combinations of the coefficients of the
+        model are jointly 0, such as all drift terms, for all voxels at once.
+
+        Parameters
+        ----------
+        contrast_matrix : np.ndarray
+            Array of shape (Q, P), with one contrast vector per row
+        regression_coefficients : np.ndarray
+            Array of shape (P, X) returned by .fit()
+        MRSS : np.ndarray
+            Array of shape (X,) returned by .fit()
+
+        Return
+        ------
+        effect : np.ndarray
+            Array of shape (Q, X) containing the estimated value of each row of
+            the contrast matrix
+        F_stat : np.ndarray
+            Array of shape (X,) containing F-statistics
+        p_value : np.ndarray
+            Array of shape (X,) containing the corresponding p-values
+        """
+        C = np.atleast_2d(np.asarray(contrast_matrix, dtype=float))
+        assert C.shape[1] == self.cov.shape[0], "contrast length mismatch"
+        dtype = self.dtype
+        effect = C.astype(dtype).dot(np.asarray(regression_coefficients,
+                                                dtype))
+        # The numerator degrees of freedom are the number of independent rows
+        # of the contrast matrix, relative to the design
+        C_cov = C.dot(self.cov).dot(C.T)
+        q = npl.matrix_rank(C_cov)
+        weighted = npl.pinv(C_cov).astype(dtype).dot(effect.reshape(len(C), -1))
+        SS = np.sum(effect.reshape(len(C), -1) * weighted, 0)
+        denominator = q * np.asarray(MRSS, dtype).reshape(-1)
+        denominator[denominator == 0] = 1
+        F_stat = (SS / denominator).reshape(effect.shape[1:])
+        p_value = stats.f.sf(F_stat, q, self.df).astype(dtype)
+        return effect, F_stat, p_value
+
+
+class online_glm(object):
+    """
+    This class fits a linear model one volume at a time, by recursive least
+    squares, so that coefficients, mean residual sums of squares, and
+    t-statistics are available while the rest of a run is still being read.
+    Until the volumes seen so far determine every coefficient, only X'X, X'Y,
+    and Y'Y are accumulated. From then on, each volume updates the coefficients
+    of all voxels and the inverse of X'X with rank-one corrections.
+    """
+
+    def __init__(self, n_regressors):
+        """
+        Parameters
+        ----------
+        n_regressors : int
+            Number of columns of the design matrix
+        """
+        self.n_regressors, self.n_volumes = n_regressors, 0
+        self.XtX = np.zeros((n_regressors, n_regressors))
+        self.XtY, self.YtY = None, None
+        self.inverse, self.coefficients, self.RSS = None, None, None
+
+    def update(self, design_row, volume):
+        """
+        Adds one volume to the model.
+
+        Parameters
+        ----------
+        design_row : np.ndarray
+            Row of the design matrix for this volume, of shape (P,)
+        volume : np.ndarray
+            Values of the response at every voxel for this volume. Arrays of
+            any shape are flattened to shape (X,)
+        """
+        x = np.asarray(design_row, dtype=float).ravel()
+        y = np.asarray(volume, dtype=float).ravel()
+        assert x.shape == (self.n_regressors,), "design row length mismatch"
+        self.n_volumes += 1
+        if self.inverse is not None:
+            # Sherman-Morrison update of (X'X)^-1, and the matching update of
+            # the coefficients and residual sums of squares of every voxel
+            Px = self.inverse.dot(x)
+            denominator = 1 + x.dot(Px)
+            error = y - x.dot(self.coefficients)
+            gain = Px / denominator
+            self.coefficients += np.outer(gain, error)
+            self.inverse -= np.outer(gain, Px)
+            self.RSS += error ** 2 / denominator
+            return
+        if self.XtY is None:
+            self.XtY = np.zeros((self.n_regressors, y.size))
+            self.YtY = np.zeros(y.size)
+        self.XtX += np.outer(x, x)
+        self.XtY += np.outer(x, y)
+        self.YtY += y ** 2
+        if npl.matrix_rank(self.XtX) == self.n_regressors:
+            self.inverse = npl.inv(self.XtX)
+            self.coefficients = self.inverse.dot(self.XtY)
+            self.RSS = np.maximum(self.YtY - np.sum(self.coefficients *
+                                                    self.XtY, 0), 0)
+            self.XtY, self.YtY = None, None
+
+    @property
+    def rank(self):
+        if self.inverse is not None:
+            return self.n_regressors
+        return int(npl.matrix_rank(self.XtX))
+
+    @property
+    def df(self):
+        return self.n_volumes - self.rank
+
+    def results(self):
+        """
+        Returns the fit of the model to the volumes seen so far, as glm_util()
+        would for the same data. If the volumes never determine every
+        coefficient, the minimum-norm least squares solution is returned. At
+        least one more volume than the rank of the design is needed, so that
+        the residuals have a degree of freedom.
+
+        Return
+        ------
+        regression_coefficients : np.ndarray
+            Array of shape (P, X) containing the estimated coefficients
+        df : int
+            Degrees of freedom
+        MRSS : np.ndarray
+            Array of shape (X,) containing the mean residual sums of squares
+        """
+        assert self.n_volumes > 0, "no volume has been added"
+        assert self.df > 0, "as many volumes as coefficients leave no residual"
+        if self.inverse is not None:
+            coefficients, RSS = self.coefficients.copy(), self.RSS
+        else:
+            coefficients = npl.pinv(self.XtX).dot(self.XtY)
+            RSS = np.maximum(self.YtY - np.sum(coefficients * self.XtY, 0), 0)
+        return coefficients, self.df, RSS / self.df
+
+    def ttest(self):
+        """
+        Computes t-statistics and two-sided p-values for each coefficient of the
+        model fitted to the volumes seen so far.
+
+        Return
+        ------
+        t_stat : np.ndarray
+            Array of shape (P, X) containing t-statistics
+        p_value : np.ndarray
+            Array of shape (P, X) containing the corresponding p-values
+        """
+        coefficients, df, MRSS = self.results()
+        inverse = self.inverse
+        if inverse is None:
+            inverse = npl.pinv(self.XtX)
+        return _t_stats(coefficients, MRSS, np.diagonal(inverse), df,
+                        np.float64)
+
+
+# Responses shared with the workers that fit runs: with forked processes, they
+# are inherited rather than sent with every run
+_run_data = None
+
+def _set_run_data(*data):
+    global _run_data
+    _run_data = data
+
+def _fit_run(run):
+    """
+    Fits the model of one run of a glm_runs() object to its response.
+    """
+    X, pinv, df, responses, block_size, dtype = _run_data
+    regression_coefficients, RSS = _fit_blocks(X[run], [pinv[run]], [None],
+                                               responses[run], block_size,
+                                               dtype)[0]
+    return regression_coefficients, RSS, RSS / df[run]
+
+def fixed_effects_design(designs, shared):
+    """
+    Concatenates the designs of several runs into a single fixed-effects design,
+    in which the regressors of interest have one coefficient common to all runs
+    and every other regressor (e.g., intercept and drifts) has one coefficient
+    per run.
+
+    Parameters
+    ----------
+    designs : list
+        List of design matrices of shape (N_i, P), one per run
+    shared : list
+        Indices of the columns whose coefficients are common to all runs
+
+    Return
+    ------
+    design_matrix : np.ndarray
+        Array of shape (sum of N_i, len(shared) + number of runs * number of
+        other columns). The shared columns come first, followed by the other
+        columns of each run in turn, which are 0 outside of their run
+    """
+    designs = [np.asarray(design, dtype=float) for design in designs]
+    n_columns = designs[0].shape[1]
+    assert all(design.shape[1] == n_columns for design in designs), \
+           "designs must have the same columns"
+    others = [j for j in range(n_columns) if j not in shared]
+    n_rows = sum(design.shape[0] for design in designs)
+    design_matrix = np.zeros((n_rows, len(shared) + len(designs) * len(others)))
+    row = 0
+    for i, design in enumerate(designs):
+        rows = slice(row, row + design.shape[0])
+        first = len(shared) + i * len(others)
+        design_matrix[rows, :len(shared)] = design[:, shared]
+        design_matrix[rows, first:(first + len(others))] = design[:, others]
+        row += design.shape[0]
+    return design_matrix
+
+def fixed_effects(designs, responses, shared, block_size=4096, dtype=None):
+    """
+    Fits a fixed-effects model to the concatenated runs of a subject.
+
+    Parameters
+    ----------
+    designs : list
+        List of design matrices of shape (N_i, P), one per run
+    responses : list
+        List of responses of shape (N_i, X), one per run, whose columns
+        correspond to the same voxels
+    shared : list
+        Indices of the columns whose coefficients are common to all runs
+    block_size : int, optional
+        Number of voxels fitted at a time
+    dtype : np.dtype, optional
+        np.float32 fits the model in single precision (see float_dtype())
+
+    Return
+    ------
+    model : glm_model
+        Model of the fixed-effects design, whose first len(shared) coefficients
+        are those of the shared columns
+    regression_coefficients : np.ndarray
+        Array of shape (number of columns of the fixed-effects design, X)
+    MRSS : np.ndarray
+        Array of shape (X,) containing the mean residual sums of squares
+    """
+    assert len(designs) == len(responses), "one response per design needed"
+    model = glm_model(fixed_effects_design(designs, shared), dtype)
+    regression_coefficients, RSS, MRSS = model.fit(np.concatenate(responses),
+                                                   block_size)
+    return model, regression_coefficients, MRSS
+
+
+class glm_runs(object):
+    """
+    This class factorizes the designs of many runs with one batched singular
+    value decomposition, and fits each run's model to its own response, either
+    all at once on stacked arrays or run by run in a pool of processes.
+    """
+
+    def __init__(self, designs, dtype=None):
+        """
+        Parameters
+        ----------
+        designs : np.ndarray
+            Array of shape (R, N, P) containing the design matrix of each of R
+            runs, which share their number of volumes and column layout
+        dtype : np.dtype, optional
+            Data type in which responses are fitted, as in glm_model()
+        """
+        self.dtype = float_dtype(dtype)
+        X = np.asarray(designs, dtype=float)
+        assert X.ndim == 3, "designs must be of shape (R, N, P)"
+        self.rank, self.pinv, self.cov = _factorize(X)
+        self.designs = X
+        self.df = X.shape[1] - self.rank
+        self.cov_diag = np.diagonal(self.cov, axis1=1, axis2=2).copy()
+
+    def fit(self, responses, block_size=4096, n_jobs=1):
+        """
+        Estimates the coefficients and residual sums of squares of every run.
+
+        Parameters
+        ----------
+        responses : np.ndarray or list
+            Array of shape (R, N, X), fitted with batched matrix products, one
+            block of voxels at a time. Runs that are too large to stack can
+            instead be given as a list of R arrays of shape (N, X_i)
+        block_size : int, optional
+            Number of voxels fitted at a time
+        n_jobs : int, optional
+            Number of processes among which the runs of a list are divided
+
+        Return
+        ------
+        regression_coefficients : np.ndarray or list
+            Array of shape (R, P, X), or list of arrays of shape (P, X_i)
+        RSS : np.ndarray or list
+            Array of shape (R, X), or list of arrays of shape (X_i,)
+        MRSS : np.ndarray or list
+            Array of shape (R, X), or list of arrays of shape (X_i,)
+        """
+        R, n_volumes, n_regressors = self.designs.shape
+        assert len(responses) == R, "one response per run needed"
+        if isinstance(responses, np.ndarray):
+            assert responses.shape[1] == n_volumes, "shape mismatch"
+            dtype = self.dtype
+            X, pinv = self.designs.astype(dtype), self.pinv.astype(dtype)
+            n_voxels = responses.shape[2]
+            regression_coefficients = np.empty((R, n_regressors, n_voxels),
+                                               dtype)
+            RSS = np.empty((R, n_voxels), dtype)
+            for start in range(0, n_voxels, block_size):
+                block = slice(start, start + block_size)
+                for run in range(R):
+                    Y = np.asarray(responses[run, :, block], dtype)
+                    coefficients = pinv[run].dot(Y)
+                    error = Y - X[run].dot(coefficients)
+                    regression_coefficients[run, :, block] = coefficients
+                    RSS[run, block] = (error ** 2).sum(0)
+            return regression_coefficients, RSS, RSS / self.df[:, np.newaxis]
+        data = (self.designs, self.pinv, self.df, responses, block_size,
+                self.dtype)
+        if n_jobs == 1:
+            _set_run_data(*data)
+            try:
+                fits = list(map(_fit_run, range(R)))
+            finally:
+                _set_run_data()
+        else:
+            pool = Pool(n_jobs, _set_run_data, data)
+            try:
+                fits = pool.map(_fit_run, range(R))
+            finally:
+                pool.close()
+        return tuple(list(outputs) for outputs in zip(*fits))
+
+    def ttest(self, regression_coefficients, MRSS):
+        """
+        Computes t-statistics and two-sided p-values for each coefficient of
+        each run.
+
+        Parameters
+        ----------
+        regression_coefficients : np.ndarray or list
+            Coefficients returned by .fit()
+        MRSS : np.ndarray or list
+            Mean residual sums of squares returned by .fit()
+
+        Return
+        ------
+        t_stat, p_value : np.ndarray or list
+            Arrays (or lists of arrays) shaped as regression_coefficients
+        """
+        tests = [_t_stats(regression_coefficients[run], MRSS[run],
+                          self.cov_diag[run], self.df[run], self.dtype)
+                 for run in range(len(self.designs))]
+        if isinstance(regression_coefficients, np.ndarray):
+            return tuple(np.array(outputs) for outputs in zip(*tests))
+        return tuple(list(outputs) for outputs in zip(*tests))